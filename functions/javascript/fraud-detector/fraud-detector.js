@@ -373,7 +373,8 @@ const createEngineAndRunFactsAgainstRules = async (facts, rules) => {
     await logUserNotFlagged(userAccountInfo);
 };
 
-const fetchFactsFromUserBehaviourService = async (userId, accountId, formattedRulesWithLatestFlagTime) => {
+// recentTransactions are the rows just logged by user behaviour, forwarded so that its queries see them immediately
+const fetchFactsFromUserBehaviourService = async (userId, accountId, formattedRulesWithLatestFlagTime, recentTransactions) => {
     try {
         logger(
             `Fetching facts from user behaviour service for user id: ${userId} and account id: ${accountId}`
@@ -383,7 +384,8 @@ const fetchFactsFromUserBehaviourService = async (userId, accountId, formattedRu
             body: {
                 userId,
                 accountId,
-                ruleCutOffTimes: formattedRulesWithLatestFlagTime
+                ruleCutOffTimes: formattedRulesWithLatestFlagTime,
+                ...(recentTransactions ? { recentTransactions } : {})
             },
             method: POST
         };
@@ -437,7 +439,9 @@ const fetchFactsAboutUserAndRunEngine = async (req, res) => {
         }
 
         const formattedRulesWithLatestFlagTime = await obtainLastAlertTimesForUser(CUSTOM_RULES, payload.userId);
-        const factsAboutUser = await fetchFactsFromUserBehaviourService(payload.userId, payload.accountId, formattedRulesWithLatestFlagTime);
+        const factsAboutUser = await fetchFactsFromUserBehaviourService(
+            payload.userId, payload.accountId, formattedRulesWithLatestFlagTime, payload.recentTransactions
+        );
 
         await createEngineAndRunFactsAgainstRules(factsAboutUser, CUSTOM_RULES);
 
@@ -0,0 +1,85 @@
+# Shapes and streams rows into `ops.all_user_events`. It is used by `pubsub-to-big-query-for-sns` and by the router mode of
+# `update-user-behaviour`, so either function writes an event as the same row with the same row id. Each function is
+# deployed from its own directory, so this file, `schema_validator.py` and `schemas/all_user_events-table.json` are copied
+# into both. `user-behaviour/main_test.py` checks that the copies are identical.
+import hashlib
+import json
+import os
+import random
+import time
+import schema_validator
+
+from google.api_core import exceptions
+
+TABLE_ID = 'all_user_events'
+# the columns that identify an event, with a hash of its context
+ROW_ID_COLUMNS = ["user_id", "event_type", "time_transaction_occurred"]
+DEFAULT_INSERT_MAX_ATTEMPTS = 5
+INSERT_BASE_BACKOFF_IN_SECONDS = 0.5
+INSERT_MAX_BACKOFF_IN_SECONDS = 32
+# reasons of row errors for rows that were valid but not inserted, e.g. `stopped` when another row of the request was invalid
+RETRYABLE_ROW_ERROR_REASONS = ["stopped", "timeout", "backendError", "internalError", "rateLimitExceeded", "quotaExceeded"]
+
+# throttled or failed insert requests, and rows big query did not insert although they were valid, are retried with
+# exponential backoff up to `INSERT_MAX_ATTEMPTS` times. Only the rows not inserted are sent again
+INSERT_MAX_ATTEMPTS = int(os.getenv("INSERT_MAX_ATTEMPTS", DEFAULT_INSERT_MAX_ATTEMPTS))
+RETRYABLE_INSERT_EXCEPTIONS = (
+    exceptions.TooManyRequests,
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+)
+
+shape_all_user_events_row = schema_validator.compile_row_shaper_from_schema_file("{}-table.json".format(TABLE_ID))
+
+# splits rows into the shaped rows to write and the rejected rows, each with the reason it was rejected
+def shape_rows(rows):
+    return schema_validator.shape_rows(shape_all_user_events_row, rows)
+
+# The id of a row is a hash of the event's content, so an event redelivered by pub/sub, or an insert retried, is
+# de-duplicated by big query. It is computed from the shaped row, so an event whose `time_transaction_occurred` is sent
+# as a string gets the id of the same event sent as an integer
+def construct_row_id(row):
+    contextHash = hashlib.sha256(str(row.get("context")).encode('utf-8')).hexdigest()
+    identifyingValues = [row.get(column) for column in ROW_ID_COLUMNS] + [contextHash]
+    return hashlib.sha256(json.dumps(identifyingValues, default=str).encode('utf-8')).hexdigest()
+
+# full jitter: a random wait of up to the exponential backoff, so throttled instances do not retry in step
+def calculate_insert_backoff_in_seconds(attempt):
+    return random.uniform(0, min(INSERT_MAX_BACKOFF_IN_SECONDS, INSERT_BASE_BACKOFF_IN_SECONDS * 2 ** attempt))
+
+def is_retryable_row_error(rowError):
+    return all(error.get("reason") in RETRYABLE_ROW_ERROR_REASONS for error in rowError["errors"])
+
+# rows big query rejects as invalid are handed to `handleRejectedRows`, the other failed rows are retried. Returns the
+# rows still not inserted after the last attempt
+def insert_rows_with_retries(client, table, rows, handleRejectedRows):
+    rowsToInsert = rows
+
+    for attempt in range(INSERT_MAX_ATTEMPTS):
+        if attempt > 0:
+            backoffInSeconds = calculate_insert_backoff_in_seconds(attempt - 1)
+            print("Retrying insert of {count} rows in {backoff:.2f} seconds, attempt {attempt}".format(count=len(rowsToInsert), backoff=backoffInSeconds, attempt=attempt + 1))
+            time.sleep(backoffInSeconds)
+
+        try:
+            errors = client.insert_rows(table, rowsToInsert, row_ids=[construct_row_id(row) for row in rowsToInsert])
+        except RETRYABLE_INSERT_EXCEPTIONS as e:
+            print("Insert into table: {table} was throttled or failed. Error: {error}".format(table=TABLE_ID, error=e))
+            continue
+
+        if errors == []:
+            print("successfully inserted {count} rows into table: {table} of big query".format(count=len(rowsToInsert), table=TABLE_ID))
+            return []
+
+        rejectedRows = [{ "row": rowsToInsert[rowError["index"]], "error": json.dumps(rowError["errors"]) } for rowError in errors if not is_retryable_row_error(rowError)]
+        if rejectedRows:
+            print("Big query rejected {count} invalid rows inserted into table: {table}".format(count=len(rejectedRows), table=TABLE_ID))
+            handleRejectedRows(rejectedRows)
+
+        rowsToInsert = [rowsToInsert[rowError["index"]] for rowError in errors if is_retryable_row_error(rowError)]
+        if not rowsToInsert:
+            return []
+
+    return rowsToInsert
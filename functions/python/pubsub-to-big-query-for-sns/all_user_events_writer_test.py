@@ -0,0 +1,51 @@
+from mock import Mock
+from unittest.mock import patch
+
+from all_user_events_writer \
+    import construct_row_id, \
+    calculate_insert_backoff_in_seconds, \
+    insert_rows_with_retries, \
+    shape_rows
+
+import all_user_events_writer
+
+sampleRow = {
+    "user_id": "1a",
+    "event_type": "SAVING_PAYMENT_SUCCESSFUL",
+    "time_transaction_occurred": 1577836800000,
+    "source_of_event": "INTERNAL_SERVICES",
+    "created_at": 1577836800001,
+    "updated_at": 1577836800001,
+    "context": "{}"
+}
+
+def test_construct_row_id_is_deterministic_and_ignores_time_received():
+    redeliveredRow = { **sampleRow, "created_at": 1, "updated_at": 1 }
+    otherRow = { **sampleRow, "user_id": "2b" }
+
+    assert construct_row_id(sampleRow) == construct_row_id(redeliveredRow)
+    assert construct_row_id(sampleRow) != construct_row_id(otherRow)
+
+def test_construct_row_id_depends_on_context():
+    otherContextRow = { **sampleRow, "context": "{\"transactionId\": \"2\"}" }
+
+    assert construct_row_id(sampleRow) != construct_row_id(otherContextRow)
+
+def test_construct_row_id_of_shaped_row_does_not_depend_on_time_sent_as_string():
+    shapedRows, _ = shape_rows([{ **sampleRow, "time_transaction_occurred": str(sampleRow["time_transaction_occurred"]) }])
+
+    assert construct_row_id(shapedRows[0]) == construct_row_id(sampleRow)
+
+def test_calculate_insert_backoff_in_seconds_is_capped():
+    assert 0 <= calculate_insert_backoff_in_seconds(0) <= all_user_events_writer.INSERT_BASE_BACKOFF_IN_SECONDS
+    assert calculate_insert_backoff_in_seconds(100) <= all_user_events_writer.INSERT_MAX_BACKOFF_IN_SECONDS
+
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+def test_insert_rows_with_retries_returns_rows_not_inserted():
+    client = Mock()
+    client.insert_rows.return_value = [{ "index": 0, "errors": [{ "reason": "backendError" }] }]
+    handleRejectedRows = Mock()
+
+    assert insert_rows_with_retries(client, "table", [sampleRow], handleRejectedRows) == [sampleRow]
+    assert client.insert_rows.call_count == all_user_events_writer.INSERT_MAX_ATTEMPTS
+    handleRejectedRows.assert_not_called()
@@ -1,2 +1,12 @@
 SECOND_TO_MILLISECOND_FACTOR=1000
-SOURCE_OF_EVENT='INTERNAL_SERVICES'
\ No newline at end of file
+SOURCE_OF_EVENT='INTERNAL_SERVICES'
+INSERT_SINKS={"streaming": "STREAMING", "load_job": "LOAD_JOB"}
+STAGED_EVENTS_GCS_FOLDER='staged_all_user_events'
+LOADING_EVENTS_GCS_FOLDER='loading_all_user_events'
+MAXIMUM_SOURCE_URIS_PER_LOAD_JOB=10000
+DEFAULT_WORKER_MAX_OUTSTANDING_MESSAGES=1000
+DEFAULT_WORKER_MAX_OUTSTANDING_BYTES=10000000
+DEFAULT_WORKER_BATCH_SIZE=500
+DEFAULT_WORKER_MAX_BATCH_LATENCY_IN_SECONDS=1
+DEAD_LETTER_GCS_FOLDER='dead_letter_all_user_events'
+DEFAULT_DEAD_LETTER_FILE_NAME='dead_letter_all_user_events.json'
@@ -1,32 +1,106 @@
+import os
+import json
 import base64
+import hashlib
+import tempfile
+import threading
 import time
 import constant
+import all_user_events_writer
 
-from google.cloud import bigquery
+from google.cloud import bigquery, storage
+from google.api_core import exceptions
 from dotenv import load_dotenv
 load_dotenv()
 
 client = bigquery.Client()
 dataset_id = 'ops'
-table_id = 'all_user_events'
+table_id = all_user_events_writer.TABLE_ID
 table_ref = client.dataset(dataset_id).table(table_id)
 table = client.get_table(table_ref)
+storage_client = storage.Client()
 SOURCE_OF_EVENT = constant.SOURCE_OF_EVENT
 SECOND_TO_MILLISECOND_FACTOR=constant.SECOND_TO_MILLISECOND_FACTOR
+INSERT_SINKS=constant.INSERT_SINKS
+STAGED_EVENTS_GCS_FOLDER=constant.STAGED_EVENTS_GCS_FOLDER
+LOADING_EVENTS_GCS_FOLDER=constant.LOADING_EVENTS_GCS_FOLDER
+MAXIMUM_SOURCE_URIS_PER_LOAD_JOB=constant.MAXIMUM_SOURCE_URIS_PER_LOAD_JOB
 
-def insert_into_table(message):
+# `STREAMING` writes rows with streaming inserts. `LOAD_JOB` stages them as newline delimited JSON files in
+# `STAGED_EVENTS_CLOUD_STORAGE_BUCKET`, which `load_staged_events_into_all_user_events` loads with one load job per run
+INSERT_SINK = os.getenv("INSERT_SINK", INSERT_SINKS["streaming"])
+STAGED_EVENTS_CLOUD_STORAGE_BUCKET = os.getenv("STAGED_EVENTS_CLOUD_STORAGE_BUCKET")
+
+# rows are checked against the schema of `all_user_events` before they are written. Rejected rows are written to a dead
+# letter file, in `DEAD_LETTER_CLOUD_STORAGE_BUCKET` if set, else appended to the local file `DEAD_LETTER_FILE_PATH`
+DEAD_LETTER_GCS_FOLDER=constant.DEAD_LETTER_GCS_FOLDER
+DEAD_LETTER_CLOUD_STORAGE_BUCKET = os.getenv("DEAD_LETTER_CLOUD_STORAGE_BUCKET")
+DEAD_LETTER_FILE_PATH = os.getenv("DEAD_LETTER_FILE_PATH", os.path.join(tempfile.gettempdir(), constant.DEFAULT_DEAD_LETTER_FILE_NAME))
+deadLetterFileLock = threading.Lock()
+
+# rows are inserted with the retries and row ids shared with the router mode of `update-user-behaviour`. Rows still not
+# inserted after the last attempt are logged, or raised with `raiseOnErrors` for callers that must not acknowledge them
+def insert_into_table(message, raiseOnErrors=False):
     print("Inserting message: {msg} into table: {table} of big query".format(msg=message, table=table_id))
+    rowsNotInserted = all_user_events_writer.insert_rows_with_retries(client, table, message, write_rows_to_dead_letter_file)
+    if not rowsNotInserted:
+        return
 
-    try:
-        errors = client.insert_rows(table, message)
-        print("successfully inserted message: {msg} into table: {table} of big query".format(msg=message, table=table_id))
-        assert errors == []
-    except AssertionError as err:
-        print(
-            """
-            Error inserting message: {msg} into table: {table} of big query. Error: {error}
-            """.format(msg=message, table=table_id, error=err)
+    print(
+        """
+        Error inserting {count} rows into table: {table} of big query after {attempts} attempts. Rows: {rows}
+        """.format(count=len(rowsNotInserted), table=table_id, attempts=all_user_events_writer.INSERT_MAX_ATTEMPTS, rows=rowsNotInserted)
+    )
+    if raiseOnErrors:
+        raise Exception("{count} rows were not inserted into table: {table} after {attempts} attempts".format(
+            count=len(rowsNotInserted), table=table_id, attempts=all_user_events_writer.INSERT_MAX_ATTEMPTS
+        ))
+
+# the file is named after the ids of its rows, so staging the same rows again (a redelivered message or batch) overwrites it
+def construct_staged_events_file_name(rows):
+    rowIds = "".join(all_user_events_writer.construct_row_id(row) for row in rows)
+    return "{folder}/{digest}.json".format(folder=STAGED_EVENTS_GCS_FOLDER, digest=hashlib.sha256(rowIds.encode('utf-8')).hexdigest())
+
+def stage_rows_for_load_job(rows):
+    fileName = construct_staged_events_file_name(rows)
+    print("Staging {count} rows in file: {file} of bucket: {bucket}".format(count=len(rows), file=fileName, bucket=STAGED_EVENTS_CLOUD_STORAGE_BUCKET))
+    newlineDelimitedRows = "\n".join(json.dumps(row, default=str) for row in rows)
+    storage_client.bucket(STAGED_EVENTS_CLOUD_STORAGE_BUCKET).blob(fileName).upload_from_string(newlineDelimitedRows, content_type="application/json")
+    print("Successfully staged {count} rows in file: {file}".format(count=len(rows), file=fileName))
+
+def write_rows_to_sink(rows, raiseOnErrors=False):
+    if INSERT_SINK == INSERT_SINKS["load_job"]:
+        stage_rows_for_load_job(rows)
+    else:
+        insert_into_table(rows, raiseOnErrors)
+
+def write_rows_to_dead_letter_file(rejectedRows):
+    rejectedAt = fetch_current_time_in_milliseconds()
+    newlineDelimitedRows = "\n".join(json.dumps({ **rejectedRow, "rejected_at": rejectedAt }, default=str) for rejectedRow in rejectedRows) + "\n"
+
+    if DEAD_LETTER_CLOUD_STORAGE_BUCKET:
+        fileName = "{folder}/{time}-{digest}.json".format(
+            folder=DEAD_LETTER_GCS_FOLDER, time=rejectedAt, digest=hashlib.sha256(newlineDelimitedRows.encode('utf-8')).hexdigest()
         )
+        storage_client.bucket(DEAD_LETTER_CLOUD_STORAGE_BUCKET).blob(fileName).upload_from_string(newlineDelimitedRows, content_type="application/json")
+        print("Wrote {count} rejected rows to dead letter file: {file} of bucket: {bucket}".format(count=len(rejectedRows), file=fileName, bucket=DEAD_LETTER_CLOUD_STORAGE_BUCKET))
+        return
+
+    with deadLetterFileLock:
+        with open(DEAD_LETTER_FILE_PATH, "a") as deadLetterFile:
+            deadLetterFile.write(newlineDelimitedRows)
+    print("Wrote {count} rejected rows to dead letter file: {file}".format(count=len(rejectedRows), file=DEAD_LETTER_FILE_PATH))
+
+# a bad row is set aside instead of failing the insert of the whole batch
+def shape_rows_and_dead_letter_rejected(rows):
+    shapedRows, rejectedRows = all_user_events_writer.shape_rows(rows)
+    if rejectedRows:
+        print("Rejected {count} rows not matching the schema of table: {table}. Errors: {errors}".format(
+            count=len(rejectedRows), table=table_id, errors=[rejectedRow["error"] for rejectedRow in rejectedRows]
+        ))
+        write_rows_to_dead_letter_file(rejectedRows)
+
+    return shapedRows
 
 def decode_message_from_pubsub(event):
     print("decoding raw message 'data' from event: {evt}".format(evt=event))
@@ -62,10 +136,117 @@ def format_message_and_insert_into_all_user_events(event, context):
     try:
         messageList = decode_message_from_pubsub(event)
         time_in_milliseconds_now = fetch_current_time_in_milliseconds()
-        messageForAllEventsTable = add_extra_params_to_message(messageList, time_in_milliseconds_now)
-        insert_into_table(messageForAllEventsTable)
+        messageForAllEventsTable = shape_rows_and_dead_letter_rejected(add_extra_params_to_message(messageList, time_in_milliseconds_now))
+        if not messageForAllEventsTable:
+            print("No valid rows in message, acknowledging message to pub/sub")
+            return 'OK', 200
+
+        write_rows_to_sink(messageForAllEventsTable)
 
         print("Acknowledging message to pub/sub")
         return 'OK', 200
     except Exception as e:
-        print('Error decoding message and inserting into events table. Error: {}' .format(e))
\ No newline at end of file
+        print('Error decoding message and inserting into events table. Error: {}' .format(e))
+
+def construct_staged_events_uri(fileName):
+    return "gs://{bucket}/{file}".format(bucket=STAGED_EVENTS_CLOUD_STORAGE_BUCKET, file=fileName)
+
+# a load job is named after the folder its files were moved to, so the outcome of a load can be looked up by a later run
+def construct_load_job_id(loadingFolder):
+    return "load_staged_events_{}".format(loadingFolder.split("/")[-1])
+
+def load_staged_files_into_table(fileUris, jobId):
+    print("Loading {count} staged files into table: {table} of big query with job: {job_id}".format(count=len(fileUris), table=table_id, job_id=jobId))
+    job_config = bigquery.LoadJobConfig()
+    job_config.autodetect = False
+    job_config.source_format = 'NEWLINE_DELIMITED_JSON'
+    job_config.write_disposition = 'WRITE_APPEND'
+    job = client.load_table_from_uri(fileUris, table_ref, job_id=jobId, job_config=job_config)
+    job.result()
+    print("Successfully loaded {count} staged files into table: {table}. Job id: {job_id}".format(count=len(fileUris), table=table_id, job_id=job.job_id))
+
+def fetch_load_job(jobId):
+    try:
+        return client.get_job(jobId)
+    except exceptions.NotFound:
+        return None
+
+def delete_file_if_exists(stagedFile):
+    try:
+        stagedFile.delete()
+    except exceptions.NotFound:
+        print("File: {file} was already deleted".format(file=stagedFile.name))
+
+def group_files_by_loading_folder(loadingFiles):
+    filesByLoadingFolder = {}
+    for loadingFile in loadingFiles:
+        filesByLoadingFolder.setdefault(os.path.dirname(loadingFile.name), []).append(loadingFile)
+
+    return filesByLoadingFolder
+
+def move_files_into_loading_folder(bucket, stagedFiles):
+    fileNames = [stagedFile.name for stagedFile in stagedFiles]
+    loadingFolder = "{folder}/{time}-{digest}".format(
+        folder=LOADING_EVENTS_GCS_FOLDER,
+        time=fetch_current_time_in_milliseconds(),
+        digest=hashlib.sha256("".join(fileNames).encode('utf-8')).hexdigest()[:16]
+    )
+    print("Moving {count} staged files into folder: {folder}".format(count=len(stagedFiles), folder=loadingFolder))
+    return loadingFolder, [
+        bucket.rename_blob(stagedFile, "{folder}/{file}".format(folder=loadingFolder, file=os.path.basename(stagedFile.name)))
+        for stagedFile in stagedFiles
+    ]
+
+# The files of a folder are loaded by the job named after it, unless a previous run already started that job. They are
+# deleted once the job has succeeded, and moved back to be staged again if it failed
+def load_files_of_loading_folder(bucket, loadingFolder, loadingFiles):
+    jobId = construct_load_job_id(loadingFolder)
+    loadJob = fetch_load_job(jobId)
+    if loadJob is None:
+        load_staged_files_into_table([construct_staged_events_uri(loadingFile.name) for loadingFile in loadingFiles], jobId)
+    elif loadJob.state != 'DONE':
+        print("Load job: {job_id} of folder: {folder} is still running, leaving its files for the next run".format(job_id=jobId, folder=loadingFolder))
+        return
+    elif loadJob.error_result:
+        print("Load job: {job_id} of folder: {folder} failed, staging its files again. Error: {error}".format(job_id=jobId, folder=loadingFolder, error=loadJob.error_result))
+        for loadingFile in loadingFiles:
+            bucket.rename_blob(loadingFile, "{folder}/{file}".format(folder=STAGED_EVENTS_GCS_FOLDER, file=os.path.basename(loadingFile.name)))
+        return
+
+    for loadingFile in loadingFiles:
+        delete_file_if_exists(loadingFile)
+    print("Deleted {count} loaded files of folder: {folder}".format(count=len(loadingFiles), folder=loadingFolder))
+
+# Run on a schedule when `INSERT_SINK` is `LOAD_JOB`. Load jobs are free (unlike streaming inserts) but limited to 1500
+# per table per day and to `MAXIMUM_SOURCE_URIS_PER_LOAD_JOB` files each, so the files staged so far are loaded with one
+# job per chunk of that many. Load jobs do not use row ids, so each chunk is first moved into a folder of its own, and a
+# folder left behind by a run that stopped part way is finished from the state of its job rather than loaded again.
+# Files staged during the run are left for the next one
+def load_staged_events_into_all_user_events(event, context):
+    try:
+        bucket = storage_client.bucket(STAGED_EVENTS_CLOUD_STORAGE_BUCKET)
+        filesByLoadingFolder = group_files_by_loading_folder(bucket.list_blobs(prefix=LOADING_EVENTS_GCS_FOLDER + "/"))
+        loadingFileNames = set(os.path.basename(loadingFile.name) for loadingFiles in filesByLoadingFolder.values() for loadingFile in loadingFiles)
+
+        stagedFiles = []
+        for stagedFile in bucket.list_blobs(prefix=STAGED_EVENTS_GCS_FOLDER + "/"):
+            # a move copies the file before deleting it, so a move that stopped part way can leave the file in both places
+            if os.path.basename(stagedFile.name) in loadingFileNames:
+                delete_file_if_exists(stagedFile)
+            else:
+                stagedFiles.append(stagedFile)
+
+        if not filesByLoadingFolder and not stagedFiles:
+            print("No staged files to load into table: {}".format(table_id))
+            return 'OK', 200
+
+        for loadingFolder, loadingFiles in filesByLoadingFolder.items():
+            load_files_of_loading_folder(bucket, loadingFolder, loadingFiles)
+
+        for chunkStart in range(0, len(stagedFiles), MAXIMUM_SOURCE_URIS_PER_LOAD_JOB):
+            loadingFolder, loadingFiles = move_files_into_loading_folder(bucket, stagedFiles[chunkStart:chunkStart + MAXIMUM_SOURCE_URIS_PER_LOAD_JOB])
+            load_files_of_loading_folder(bucket, loadingFolder, loadingFiles)
+
+        return 'OK', 200
+    except Exception as e:
+        print('Error loading staged events into events table. Error: {}' .format(e))
@@ -1,19 +1,26 @@
+import os
 import time
+import json
 import constant
 import pytest
 import base64
 
 from mock import Mock
 from google.cloud import bigquery
+from unittest.mock import patch
+from google.api_core import exceptions
 
 from main \
     import insert_into_table, \
     decode_message_from_pubsub, \
     fetch_current_time_in_milliseconds, \
     add_extra_params_to_message, \
-    format_message_and_insert_into_all_user_events
+    format_message_and_insert_into_all_user_events, \
+    load_staged_events_into_all_user_events
+from all_user_events_writer import construct_row_id
 
 import main
+import all_user_events_writer
 
 dataset_id = main.dataset_id
 table_id = main.table_id
@@ -22,6 +29,9 @@ table_ref = main.table_ref
 table = main.table
 SOURCE_OF_EVENT = constant.SOURCE_OF_EVENT
 SECOND_TO_MILLISECOND_FACTOR=constant.SECOND_TO_MILLISECOND_FACTOR
+INSERT_SINKS=constant.INSERT_SINKS
+STAGED_EVENTS_GCS_FOLDER=constant.STAGED_EVENTS_GCS_FOLDER
+LOADING_EVENTS_GCS_FOLDER=constant.LOADING_EVENTS_GCS_FOLDER
 
 
 time_in_milliseconds_now = fetch_current_time_in_milliseconds()
@@ -68,9 +78,10 @@ def test_insert_into_table(mock_big_query):
     assert main.client.insert_rows.call_count == 1
     assert result is None
 
-    queryArgs = mock_big_query.insert_rows.call_args.args
+    queryArgs = mock_big_query.insert_rows.call_args[0]
     assert queryArgs[0] == table
     assert queryArgs[1] == sampleFormattedMessageForAllEventsTable
+    assert mock_big_query.insert_rows.call_args[1]["row_ids"] == [construct_row_id(sampleFormattedMessageForAllEventsTable[0])]
 
 
 def test_add_extra_params_to_message():
@@ -104,5 +115,204 @@ def test_format_message_and_insert_into_all_user_events(mock_big_query):
     assert main.client.insert_rows.call_count == 1
     assert result == ('OK', 200)
 
-    queryArgs = mock_big_query.insert_rows.call_args.args
+    queryArgs = mock_big_query.insert_rows.call_args[0]
     assert queryArgs[0] == table
+
+def construct_sample_raw_event(userId):
+    return {
+        "data": base64.b64encode(str([{ **sampleDecodedMessageFromPubSub, "user_id": userId }]).encode('utf-8'))
+    }
+
+def construct_sample_rows(userIds):
+    return [{ **sampleFormattedMessageForAllEventsTable[0], "user_id": userId } for userId in userIds]
+
+@patch('main.write_rows_to_dead_letter_file')
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+def test_insert_into_table_resubmits_only_failed_rows(write_rows_to_dead_letter_file_patch, mock_big_query):
+    main.client = mock_big_query
+    rows = construct_sample_rows(["1a", "2b", "3c"])
+    mock_big_query.insert_rows.side_effect = [
+        [{ "index": 0, "errors": [{ "reason": "invalid" }] }, { "index": 2, "errors": [{ "reason": "stopped" }] }],
+        [],
+    ]
+
+    assert insert_into_table(rows) is None
+
+    assert mock_big_query.insert_rows.call_count == 2
+    retryCall = mock_big_query.insert_rows.call_args_list[1]
+    assert retryCall[0][1] == [rows[2]]
+    assert retryCall[1]["row_ids"] == [construct_row_id(rows[2])]
+    assert [rejectedRow["row"] for rejectedRow in write_rows_to_dead_letter_file_patch.call_args[0][0]] == [rows[0]]
+
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+def test_insert_into_table_retries_throttled_inserts(mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.insert_rows.side_effect = [all_user_events_writer.exceptions.TooManyRequests("throttled"), all_user_events_writer.exceptions.ServiceUnavailable("unavailable"), []]
+
+    insert_into_table(sampleFormattedMessageForAllEventsTable, raiseOnErrors=True)
+
+    assert mock_big_query.insert_rows.call_count == 3
+    assert all(call[0][1] == sampleFormattedMessageForAllEventsTable for call in mock_big_query.insert_rows.call_args_list)
+
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+def test_insert_into_table_raises_after_max_attempts(mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.insert_rows.side_effect = all_user_events_writer.exceptions.TooManyRequests("throttled")
+
+    with pytest.raises(Exception, match="not inserted"):
+        insert_into_table(sampleFormattedMessageForAllEventsTable, raiseOnErrors=True)
+    assert mock_big_query.insert_rows.call_count == all_user_events_writer.INSERT_MAX_ATTEMPTS
+
+@patch('main.storage_client')
+def test_load_job_sink_stages_rows_with_same_shape(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    blob = storage_client_patch.bucket.return_value.blob
+
+    with patch('main.INSERT_SINK', INSERT_SINKS["load_job"]), patch('main.STAGED_EVENTS_CLOUD_STORAGE_BUCKET', 'staged-events'):
+        result = format_message_and_insert_into_all_user_events(sampleRawEventFromPubSub, {})
+
+    assert result == ('OK', 200)
+    mock_big_query.insert_rows.assert_not_called()
+    storage_client_patch.bucket.assert_called_once_with('staged-events')
+    fileName = blob.call_args[0][0]
+    assert fileName.startswith(STAGED_EVENTS_GCS_FOLDER + "/")
+    assert fileName == main.construct_staged_events_file_name(sampleFormattedMessageForAllEventsTable)
+
+    stagedRows = [json.loads(line) for line in blob.return_value.upload_from_string.call_args[0][0].splitlines()]
+    assert [sorted(row.keys()) for row in stagedRows] == [sorted(sampleFormattedMessageForAllEventsTable[0].keys())]
+    assert stagedRows[0]["source_of_event"] == SOURCE_OF_EVENT
+
+def construct_sample_files(folder, fileNames):
+    sampleFiles = []
+    for fileName in fileNames:
+        sampleFile = Mock()
+        sampleFile.name = "{}/{}".format(folder, fileName)
+        sampleFiles.append(sampleFile)
+
+    return sampleFiles
+
+def construct_sample_bucket(storage_client_patch, loadingFiles, stagedFiles):
+    bucket = storage_client_patch.bucket.return_value
+    bucket.list_blobs.side_effect = lambda prefix: iter(loadingFiles if prefix.startswith(LOADING_EVENTS_GCS_FOLDER) else stagedFiles)
+    # a moved file keeps its mock, so the test can follow it
+    def rename_blob(blob, newName):
+        blob.name = newName
+        return blob
+    bucket.rename_blob.side_effect = rename_blob
+    return bucket
+
+@patch('main.storage_client')
+def test_load_staged_events_moves_staged_files_then_loads_them_in_one_job_then_deletes_them(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.get_job.side_effect = exceptions.NotFound("Not found")
+    stagedFiles = construct_sample_files(STAGED_EVENTS_GCS_FOLDER, ["a.json", "b.json"])
+    construct_sample_bucket(storage_client_patch, [], stagedFiles)
+
+    with patch('main.STAGED_EVENTS_CLOUD_STORAGE_BUCKET', 'staged-events'):
+        assert load_staged_events_into_all_user_events({}, {}) == ('OK', 200)
+
+    mock_big_query.load_table_from_uri.assert_called_once()
+    loadingFolder = os.path.dirname(stagedFiles[0].name)
+    assert loadingFolder.startswith(LOADING_EVENTS_GCS_FOLDER + "/")
+    assert mock_big_query.load_table_from_uri.call_args[0][0] == [
+        "gs://staged-events/{}/a.json".format(loadingFolder),
+        "gs://staged-events/{}/b.json".format(loadingFolder)
+    ]
+    assert mock_big_query.load_table_from_uri.call_args[0][1] == table_ref
+    assert mock_big_query.load_table_from_uri.call_args[1]["job_id"] == main.construct_load_job_id(loadingFolder)
+    for stagedFile in stagedFiles:
+        stagedFile.delete.assert_called_once()
+
+@patch('main.MAXIMUM_SOURCE_URIS_PER_LOAD_JOB', 2)
+@patch('main.storage_client')
+def test_load_staged_events_loads_at_most_the_maximum_source_uris_per_job(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.get_job.side_effect = exceptions.NotFound("Not found")
+    construct_sample_bucket(storage_client_patch, [], construct_sample_files(STAGED_EVENTS_GCS_FOLDER, ["a.json", "b.json", "c.json"]))
+
+    load_staged_events_into_all_user_events({}, {})
+
+    assert [len(loadCall[0][0]) for loadCall in mock_big_query.load_table_from_uri.call_args_list] == [2, 1]
+    assert len(set(loadCall[1]["job_id"] for loadCall in mock_big_query.load_table_from_uri.call_args_list)) == 2
+
+@patch('main.storage_client')
+def test_load_staged_events_keeps_files_when_load_fails(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.get_job.side_effect = exceptions.NotFound("Not found")
+    stagedFiles = construct_sample_files(STAGED_EVENTS_GCS_FOLDER, ["a.json"])
+    construct_sample_bucket(storage_client_patch, [], stagedFiles)
+    mock_big_query.load_table_from_uri.return_value.result.side_effect = Exception("Load failed")
+
+    load_staged_events_into_all_user_events({}, {})
+
+    stagedFiles[0].delete.assert_not_called()
+
+@patch('main.storage_client')
+def test_load_staged_events_does_not_load_again_files_of_a_finished_job(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    loadingFiles = construct_sample_files(LOADING_EVENTS_GCS_FOLDER + "/1-abc", ["a.json", "b.json"])
+    # the previous run stopped after copying b.json into the folder without deleting it from the staged folder, and
+    # after loading the folder without deleting all of its files
+    stagedDuplicate = construct_sample_files(STAGED_EVENTS_GCS_FOLDER, ["b.json"])
+    construct_sample_bucket(storage_client_patch, loadingFiles, stagedDuplicate)
+    mock_big_query.get_job.return_value.state = 'DONE'
+    mock_big_query.get_job.return_value.error_result = None
+    loadingFiles[0].delete.side_effect = exceptions.NotFound("Not found")
+
+    assert load_staged_events_into_all_user_events({}, {}) == ('OK', 200)
+
+    mock_big_query.get_job.assert_called_once_with(main.construct_load_job_id(LOADING_EVENTS_GCS_FOLDER + "/1-abc"))
+    mock_big_query.load_table_from_uri.assert_not_called()
+    for stagedFile in loadingFiles + stagedDuplicate:
+        stagedFile.delete.assert_called_once()
+
+@patch('main.storage_client')
+def test_load_staged_events_stages_again_files_of_a_failed_job(storage_client_patch, mock_big_query):
+    main.client = mock_big_query
+    loadingFiles = construct_sample_files(LOADING_EVENTS_GCS_FOLDER + "/1-abc", ["a.json"])
+    construct_sample_bucket(storage_client_patch, loadingFiles, [])
+    mock_big_query.get_job.return_value.state = 'DONE'
+    mock_big_query.get_job.return_value.error_result = { "reason": "invalid" }
+
+    load_staged_events_into_all_user_events({}, {})
+
+    mock_big_query.load_table_from_uri.assert_not_called()
+    assert loadingFiles[0].name == STAGED_EVENTS_GCS_FOLDER + "/a.json"
+    loadingFiles[0].delete.assert_not_called()
+
+@patch('main.write_rows_to_dead_letter_file')
+def test_rows_not_matching_schema_are_dead_lettered_without_failing_the_message(write_rows_to_dead_letter_file_patch, mock_big_query):
+    main.client = mock_big_query
+    mock_big_query.insert_rows.return_value = []
+    badEvent = { **sampleDecodedMessageFromPubSub, "time_transaction_occurred": "yesterday" }
+    rawEvent = { "data": base64.b64encode(str([sampleDecodedMessageFromPubSub, badEvent]).encode('utf-8')) }
+
+    assert format_message_and_insert_into_all_user_events(rawEvent, {}) == ('OK', 200)
+
+    insertedRows = mock_big_query.insert_rows.call_args[0][1]
+    assert [row["time_transaction_occurred"] for row in insertedRows] == [time_in_milliseconds_now]
+    rejectedRows = write_rows_to_dead_letter_file_patch.call_args[0][0]
+    assert [rejectedRow["row"]["time_transaction_occurred"] for rejectedRow in rejectedRows] == ["yesterday"]
+    assert rejectedRows[0]["error"] == "column: time_transaction_occurred must be INTEGER, got: str"
+
+def test_write_rows_to_dead_letter_file_appends_to_local_file(tmp_path):
+    deadLetterFilePath = str(tmp_path / "dead_letter.json")
+    rejectedRow = { "row": { "user_id": 3 }, "error": "column: user_id must be STRING, got: int" }
+
+    with patch('main.DEAD_LETTER_CLOUD_STORAGE_BUCKET', None), patch('main.DEAD_LETTER_FILE_PATH', deadLetterFilePath):
+        main.write_rows_to_dead_letter_file([rejectedRow])
+        main.write_rows_to_dead_letter_file([rejectedRow])
+
+    with open(deadLetterFilePath) as deadLetterFile:
+        deadLetters = [json.loads(line) for line in deadLetterFile]
+    assert len(deadLetters) == 2
+    assert deadLetters[0]["row"] == rejectedRow["row"] and deadLetters[0]["error"] == rejectedRow["error"]
+    assert "rejected_at" in deadLetters[0]
+
+@patch('main.storage_client')
+def test_write_rows_to_dead_letter_file_uploads_to_bucket_when_set(storage_client_patch):
+    with patch('main.DEAD_LETTER_CLOUD_STORAGE_BUCKET', 'dead-letters'):
+        main.write_rows_to_dead_letter_file([{ "row": {}, "error": "missing required column: user_id" }])
+
+    storage_client_patch.bucket.assert_called_once_with('dead-letters')
+    assert storage_client_patch.bucket.return_value.blob.call_args[0][0].startswith(constant.DEAD_LETTER_GCS_FOLDER + "/")
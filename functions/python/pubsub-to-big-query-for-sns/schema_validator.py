@@ -0,0 +1,75 @@
+# Validates and shapes rows for a big query table from its schema file in `schemas/`. The schema is compiled once into
+# the source of a `shape_row` function with one inline check per column, so a row is checked and shaped in one call
+# instead of a loop over the schema. `shape_row(row)` returns `(shapedRow, None)`, where the shaped row only has the
+# columns of the schema, or `(None, error)` for a row big query would reject.
+import json
+import os
+
+SCHEMAS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+
+# `{value}` is replaced by the variable holding the column's value. bool is a subclass of int, hence the exact type checks
+SCHEMA_TYPE_CHECKS = {
+    "STRING": "type({value}) is str",
+    "INTEGER": "type({value}) is int",
+    "FLOAT": "type({value}) in (int, float)",
+    "BOOLEAN": "type({value}) is bool",
+}
+
+def load_schema_fields(schemaFileName):
+    with open(os.path.join(SCHEMAS_DIRECTORY, schemaFileName)) as schemaFile:
+        return json.load(schemaFile)
+
+def construct_column_check_source(schemaField, value):
+    name = schemaField["name"]
+    fieldType = schemaField["type"]
+    if fieldType not in SCHEMA_TYPE_CHECKS or schemaField.get("mode") == "REPEATED":
+        raise Exception("Unsupported type: {type} (mode: {mode}) of column: {name}".format(type=fieldType, mode=schemaField.get("mode"), name=name))
+
+    lines = ["    {value} = row.get({name!r})".format(value=value, name=name), "    if {value} is None:".format(value=value)]
+    if schemaField.get("mode") == "REQUIRED":
+        lines.append("        return None, {error!r}".format(error="missing required column: {}".format(name)))
+    else:
+        lines.append("        pass")
+
+    # big query accepts integers sent as strings, they are converted so the row id of an event does not depend on it
+    if fieldType == "INTEGER":
+        lines.append("    elif type({value}) is str and {value}.lstrip('-').isdigit():".format(value=value))
+        lines.append("        {value} = int({value})".format(value=value))
+
+    lines.append("    elif not ({check}):".format(check=SCHEMA_TYPE_CHECKS[fieldType].format(value=value)))
+    lines.append("        return None, {error!r} + type({value}).__name__".format(
+        error="column: {name} must be {type}, got: ".format(name=name, type=fieldType), value=value
+    ))
+    return lines
+
+def compile_row_shaper(schemaFields):
+    lines = ["def shape_row(row):"]
+    for index, schemaField in enumerate(schemaFields):
+        lines += construct_column_check_source(schemaField, "value{}".format(index))
+
+    shapedRow = ", ".join("{name!r}: value{index}".format(name=schemaField["name"], index=index) for index, schemaField in enumerate(schemaFields))
+    lines.append("    return {" + shapedRow + "}, None")
+
+    namespace = {}
+    exec(compile("\n".join(lines), "<row shaper>", "exec"), namespace)
+    return namespace["shape_row"]
+
+def compile_row_shaper_from_schema_file(schemaFileName):
+    return compile_row_shaper(load_schema_fields(schemaFileName))
+
+# splits rows into the shaped rows to write and the rejected rows, each with the reason it was rejected
+def shape_rows(shapeRow, rows):
+    shapedRows = []
+    rejectedRows = []
+    for row in rows:
+        try:
+            shapedRow, error = shapeRow(row)
+        except Exception as e:
+            shapedRow, error = None, "row is not an object: {}".format(e)
+
+        if error is None:
+            shapedRows.append(shapedRow)
+        else:
+            rejectedRows.append({ "row": row, "error": error })
+
+    return shapedRows, rejectedRows
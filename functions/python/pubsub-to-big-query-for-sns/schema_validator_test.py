@@ -0,0 +1,54 @@
+import pytest
+
+from schema_validator \
+    import compile_row_shaper, \
+    compile_row_shaper_from_schema_file, \
+    shape_rows
+
+shape_all_user_events_row = compile_row_shaper_from_schema_file("all_user_events-table.json")
+
+sampleRow = {
+    "user_id": "1a",
+    "event_type": "SAVING_PAYMENT_SUCCESSFUL",
+    "time_transaction_occurred": 1577836800000,
+    "source_of_event": "INTERNAL_SERVICES",
+    "created_at": 1577836800001,
+    "updated_at": 1577836800001,
+    "context": "{}"
+}
+
+def test_shape_row_keeps_only_schema_columns():
+    shapedRow, error = shape_all_user_events_row({ **sampleRow, "unknown_column": 1 })
+
+    assert error is None
+    assert shapedRow == sampleRow
+
+def test_shape_row_accepts_missing_nullable_column_and_integer_strings():
+    rowWithoutContext = { column: value for column, value in sampleRow.items() if column != "context" }
+
+    shapedRow, error = shape_all_user_events_row({ **rowWithoutContext, "time_transaction_occurred": "1577836800000" })
+
+    assert error is None
+    assert shapedRow == { **sampleRow, "context": None }
+
+def test_shape_row_rejects_missing_required_column_and_wrong_types():
+    rowWithoutUserId = { column: value for column, value in sampleRow.items() if column != "user_id" }
+
+    assert shape_all_user_events_row(rowWithoutUserId) == (None, "missing required column: user_id")
+    assert shape_all_user_events_row({ **sampleRow, "time_transaction_occurred": True }) == (
+        None, "column: time_transaction_occurred must be INTEGER, got: bool"
+    )
+    assert shape_all_user_events_row({ **sampleRow, "context": { "accountId": "a" } }) == (None, "column: context must be STRING, got: dict")
+
+def test_shape_rows_splits_rejected_rows_with_their_error():
+    badRow = { **sampleRow, "event_type": 3 }
+
+    shapedRows, rejectedRows = shape_rows(shape_all_user_events_row, [sampleRow, badRow, "not a row"])
+
+    assert shapedRows == [sampleRow]
+    assert [rejectedRow["row"] for rejectedRow in rejectedRows] == [badRow, "not a row"]
+    assert rejectedRows[0]["error"] == "column: event_type must be STRING, got: int"
+
+def test_compile_row_shaper_rejects_unsupported_types():
+    with pytest.raises(Exception):
+        compile_row_shaper([{ "name": "payload", "type": "RECORD", "mode": "NULLABLE" }])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Long running alternative to the `pubsub-to-big-query-for-sns` cloud function. It pulls the `sns-events` messages from a
+# subscription, with flow control on the messages held at once, and writes the rows of a batch of messages with one
+# write to `ops.all_user_events`. The messages of a batch are acknowledged only once their rows are written, and are
+# redelivered if the write fails (the row ids keep the retry from duplicating rows).
+#
+# Usage: python worker.py --subscription projects/<project>/subscriptions/<subscription> [--batch-size <n>] ...
+# Needs `google-cloud-pubsub`, which is not deployed with the cloud function. Set PUBSUB_EMULATOR_HOST to run it
+# against the pub/sub emulator.
+import argparse
+import base64
+import signal
+import threading
+
+import constant
+import main
+
+DEFAULT_WORKER_MAX_OUTSTANDING_MESSAGES = constant.DEFAULT_WORKER_MAX_OUTSTANDING_MESSAGES
+DEFAULT_WORKER_MAX_OUTSTANDING_BYTES = constant.DEFAULT_WORKER_MAX_OUTSTANDING_BYTES
+DEFAULT_WORKER_BATCH_SIZE = constant.DEFAULT_WORKER_BATCH_SIZE
+DEFAULT_WORKER_MAX_BATCH_LATENCY_IN_SECONDS = constant.DEFAULT_WORKER_MAX_BATCH_LATENCY_IN_SECONDS
+
+# messages that cannot be decoded are logged and acknowledged, as the cloud function does, so they are not redelivered forever
+def extract_rows_from_messages(messages, currentTime):
+    rows = []
+    for message in messages:
+        try:
+            rows += main.add_extra_params_to_message(main.decode_message_from_pubsub({ "data": base64.b64encode(message.data) }), currentTime)
+        except Exception as e:
+            print("Error decoding message: {id}, acknowledging it without a write. Error: {error}".format(id=message.message_id, error=e))
+
+    return rows
+
+def process_message_batch(messages):
+    print("Processing batch of {} messages".format(len(messages)))
+    try:
+        rows = main.shape_rows_and_dead_letter_rejected(extract_rows_from_messages(messages, main.fetch_current_time_in_milliseconds()))
+        if rows:
+            main.write_rows_to_sink(rows, raiseOnErrors=True)
+    except Exception as e:
+        print("Error writing batch of {count} messages, they will be redelivered. Error: {error}".format(count=len(messages), error=e))
+        for message in messages:
+            message.nack()
+        return
+
+    for message in messages:
+        message.ack()
+    print("Wrote and acknowledged batch of {} messages".format(len(messages)))
+
+# collects the messages delivered by the subscriber and processes them once `maxBatchSize` have arrived, or the first
+# of them has waited `maxBatchLatencyInSeconds`
+class MessageBatcher:
+    def __init__(self, processBatch, maxBatchSize, maxBatchLatencyInSeconds):
+        self.processBatch = processBatch
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchLatencyInSeconds = maxBatchLatencyInSeconds
+        self.lock = threading.Lock()
+        self.messages = []
+        self.latencyTimer = None
+
+    def add(self, message):
+        with self.lock:
+            self.messages.append(message)
+            if len(self.messages) == 1:
+                self.latencyTimer = threading.Timer(self.maxBatchLatencyInSeconds, self.flush)
+                self.latencyTimer.daemon = True
+                self.latencyTimer.start()
+            batch = self.take_messages() if len(self.messages) >= self.maxBatchSize else []
+
+        if batch:
+            self.processBatch(batch)
+
+    # called with `lock` held
+    def take_messages(self):
+        batch = self.messages
+        self.messages = []
+        if self.latencyTimer is not None:
+            self.latencyTimer.cancel()
+            self.latencyTimer = None
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take_messages()
+
+        if batch:
+            self.processBatch(batch)
+
+def create_subscriber_and_flow_control(maxOutstandingMessages, maxOutstandingBytes):
+    from google.cloud import pubsub_v1
+    flowControl = pubsub_v1.types.FlowControl(max_messages=maxOutstandingMessages, max_bytes=maxOutstandingBytes)
+    return pubsub_v1.SubscriberClient(), flowControl
+
+# blocks until the subscription stops or `stopEvent` is set, then processes the messages still batched
+def run_worker(subscriber, subscriptionPath, flowControl, batchSize, maxBatchLatencyInSeconds, stopEvent=None):
+    batcher = MessageBatcher(process_message_batch, batchSize, maxBatchLatencyInSeconds)
+    print("Pulling messages from subscription: {subscription} in batches of {size}".format(subscription=subscriptionPath, size=batchSize))
+    streamingPullFuture = subscriber.subscribe(subscriptionPath, callback=batcher.add, flow_control=flowControl)
+
+    try:
+        if stopEvent is None:
+            streamingPullFuture.result()
+        else:
+            stopEvent.wait()
+    except Exception as e:
+        print("Streaming pull from subscription: {subscription} stopped. Error: {error}".format(subscription=subscriptionPath, error=e))
+    finally:
+        streamingPullFuture.cancel()
+        batcher.flush()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Pull sns events from a pub/sub subscription into all_user_events")
+    parser.add_argument("--subscription", required=True, help="projects/<project>/subscriptions/<subscription>")
+    parser.add_argument("--max-outstanding-messages", type=int, default=DEFAULT_WORKER_MAX_OUTSTANDING_MESSAGES)
+    parser.add_argument("--max-outstanding-bytes", type=int, default=DEFAULT_WORKER_MAX_OUTSTANDING_BYTES)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_WORKER_BATCH_SIZE)
+    parser.add_argument("--max-batch-latency-in-seconds", type=float, default=DEFAULT_WORKER_MAX_BATCH_LATENCY_IN_SECONDS)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.batch_size > arguments.max_outstanding_messages:
+        print("Batch size is larger than the messages held at once, batches will only be written on latency")
+
+    subscriber, flowControl = create_subscriber_and_flow_control(arguments.max_outstanding_messages, arguments.max_outstanding_bytes)
+    stopEvent = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: stopEvent.set())
+    signal.signal(signal.SIGINT, lambda signalNumber, frame: stopEvent.set())
+
+    run_worker(subscriber, arguments.subscription, flowControl, arguments.batch_size, arguments.max_batch_latency_in_seconds, stopEvent)
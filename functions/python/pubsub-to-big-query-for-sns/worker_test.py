@@ -0,0 +1,123 @@
+import threading
+
+from mock import Mock
+from unittest.mock import patch
+
+from worker \
+    import MessageBatcher, \
+    process_message_batch, \
+    run_worker
+
+import main
+
+class FakeMessage:
+    def __init__(self, messageId, data):
+        self.message_id = messageId
+        self.data = data
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.nacked = True
+
+# stands in for `pubsub_v1.SubscriberClient`, delivering the given messages to the callback as the streaming pull would
+class FakeSubscriber:
+    def __init__(self, messages):
+        self.messages = messages
+        self.streamingPullFuture = Mock()
+
+    def subscribe(self, subscriptionPath, callback, flow_control):
+        self.subscriptionPath = subscriptionPath
+        self.flowControl = flow_control
+        for message in self.messages:
+            callback(message)
+        return self.streamingPullFuture
+
+def construct_sample_message(index, userId="1a"):
+    event = { "user_id": userId, "event_type": "SAVING_PAYMENT_SUCCESSFUL", "time_transaction_occurred": index, "context": "{}" }
+    return FakeMessage("message-{}".format(index), str([event]).encode('utf-8'))
+
+def test_message_batcher_processes_full_batches_and_flushes_the_rest():
+    processedBatches = []
+    batcher = MessageBatcher(processedBatches.append, maxBatchSize=2, maxBatchLatencyInSeconds=60)
+
+    for index in range(5):
+        batcher.add(index)
+    assert processedBatches == [[0, 1], [2, 3]]
+
+    batcher.flush()
+    assert processedBatches == [[0, 1], [2, 3], [4]]
+
+def test_message_batcher_processes_batch_after_max_latency():
+    processed = threading.Event()
+    batcher = MessageBatcher(lambda batch: processed.set(), maxBatchSize=100, maxBatchLatencyInSeconds=0.01)
+
+    batcher.add("message")
+
+    assert processed.wait(timeout=5)
+
+@patch('main.write_rows_to_sink')
+def test_process_message_batch_writes_once_then_acks(write_rows_to_sink_patch):
+    messages = [construct_sample_message(index, userId) for index, userId in enumerate(["1a", "2b", "3c"])]
+    messages.append(FakeMessage("undecodable", b"not an event"))
+
+    process_message_batch(messages)
+
+    write_rows_to_sink_patch.assert_called_once()
+    writtenRows = write_rows_to_sink_patch.call_args[0][0]
+    assert [row["user_id"] for row in writtenRows] == ["1a", "2b", "3c"]
+    assert all(row["source_of_event"] == main.SOURCE_OF_EVENT for row in writtenRows)
+    assert write_rows_to_sink_patch.call_args[1] == { "raiseOnErrors": True }
+    assert all(message.acked and not message.nacked for message in messages)
+
+@patch('main.write_rows_to_dead_letter_file')
+@patch('main.write_rows_to_sink')
+def test_process_message_batch_dead_letters_bad_rows_and_acks_the_batch(write_rows_to_sink_patch, write_rows_to_dead_letter_file_patch):
+    messages = [construct_sample_message(0), FakeMessage("not-a-list-of-events", str(["event"]).encode('utf-8'))]
+    badEvent = { "user_id": "2b", "event_type": "SAVING_PAYMENT_SUCCESSFUL", "time_transaction_occurred": "yesterday", "context": "{}" }
+    messages.append(FakeMessage("bad-event", str([badEvent]).encode('utf-8')))
+
+    process_message_batch(messages)
+
+    assert [row["user_id"] for row in write_rows_to_sink_patch.call_args[0][0]] == ["1a"]
+    assert [rejectedRow["row"]["user_id"] for rejectedRow in write_rows_to_dead_letter_file_patch.call_args[0][0]] == ["2b"]
+    assert all(message.acked for message in messages)
+
+@patch('main.write_rows_to_sink')
+def test_process_message_batch_nacks_when_write_fails(write_rows_to_sink_patch):
+    write_rows_to_sink_patch.side_effect = Exception("Big query rejected rows")
+    messages = [construct_sample_message(index) for index in range(2)]
+
+    process_message_batch(messages)
+
+    assert all(message.nacked and not message.acked for message in messages)
+
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+@patch('main.client')
+def test_insert_into_table_raises_rows_not_inserted_when_asked(client_patch):
+    client_patch.insert_rows.return_value = [{ "index": 0, "errors": [{ "reason": "backendError" }] }]
+
+    main.insert_into_table([{ "user_id": "1a" }])
+    try:
+        main.insert_into_table([{ "user_id": "1a" }], raiseOnErrors=True)
+        assert False, "rows not inserted should raise"
+    except Exception as e:
+        assert "not inserted" in str(e)
+
+@patch('main.write_rows_to_sink')
+def test_run_worker_writes_one_insert_per_batch_with_flow_control(write_rows_to_sink_patch):
+    messages = [construct_sample_message(index) for index in range(5)]
+    subscriber = FakeSubscriber(messages)
+    flowControl = Mock()
+    stopEvent = threading.Event()
+    stopEvent.set()
+
+    run_worker(subscriber, "projects/sample/subscriptions/sns-events-worker", flowControl, 2, 60, stopEvent)
+
+    assert subscriber.flowControl is flowControl
+    assert [len(call[0][0]) for call in write_rows_to_sink_patch.call_args_list] == [2, 2, 1]
+    assert all(message.acked for message in messages)
+    subscriber.streamingPullFuture.cancel.assert_called_once()
@@ -2,9 +2,12 @@
 # This script was written by Martijn Scheijbeler: https://github.com/martijnsch/amplitude-bigquery
 # Bolu Ajibawo extended it to serve JupiterSave's needs
 
+import concurrent.futures
+import functools
 import gzip
 import json
 import os
+import requests
 import zipfile
 import time
 
@@ -50,6 +53,27 @@ storage_client = storage.Client(project=PROJECT_ID)
 SOURCE_OF_EVENT = 'AMPLITUDE'
 SECOND_TO_MILLISECOND_FACTOR=1000
 
+# `LOCAL_FILES` downloads the export to /tmp, extracts it and reads each hourly file into memory. `STREAMING` streams the
+# export into cloud storage, reads the zip back with ranged reads and transforms each hourly file line by line into a
+# resumable upload, so memory and /tmp usage do not grow with the size of the export
+SYNC_PIPELINES = {"local_files": "LOCAL_FILES", "streaming": "STREAMING"}
+SYNC_PIPELINE = os.getenv("AMPLITUDE_SYNC_PIPELINE", SYNC_PIPELINES["local_files"])
+AMPLITUDE_EXPORT_URL = "https://amplitude.com/api/2/export"
+AMPLITUDE_EXPORT_TIMEOUT_IN_SECONDS = 300
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# resumable upload chunks must be a multiple of 256 KiB
+RESUMABLE_UPLOAD_CHUNK_SIZE = 16 * 256 * 1024
+RESUMABLE_UPLOAD_TIMEOUT_IN_SECONDS = 60
+# a chunk that fails with one of these statuses, or times out, is retried with exponential backoff
+RESUMABLE_UPLOAD_RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+RESUMABLE_UPLOAD_MAX_ATTEMPTS = 5
+RESUMABLE_UPLOAD_RETRY_BACKOFF_IN_SECONDS = 1
+RANGED_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# with more than one worker the hourly files are transformed and uploaded by a pool of processes, as transforming the
+# lines is CPU bound. The load jobs are started from the main process as files complete
+SYNC_WORKERS = int(os.getenv("AMPLITUDE_SYNC_WORKERS", "1"))
+
 def fetch_current_time_in_milliseconds():
     currentTimeInMilliseconds = int(round(time.time() * SECOND_TO_MILLISECOND_FACTOR))
     return currentTimeInMilliseconds
@@ -150,6 +174,9 @@ def upload_file_to_gcs(path_to_file, new_filename, folder=''):
     blob.upload_from_filename(path_to_file)
     print("Completed upload of file: {name} to gcs folder: {folder}".format(name=path_to_file, folder=folder))
     
+def construct_gcs_import_url(filename):
+    return f"gs://{CLOUD_STORAGE_BUCKET}/{FORMATTED_FILES_GCS_FOLDER}/{filename}"
+
 def value_def(value):
     value = None if value == 'null' else value
     return value
@@ -266,6 +293,243 @@ def process_line_json(line, current_time):
     return json.dumps(row_for_all_events_table)
 
 
+# the file object a resumable upload reads its chunks from. Bytes are dropped once sent, except the last chunk, which is
+# kept until the upload acknowledges it so the upload can resume from the last acknowledged byte
+class ResumableUploadBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.lastChunk = b''
+
+    def write(self, data):
+        self.buffer += data
+
+    def buffered_size(self):
+        return len(self.buffer)
+
+    def read(self, size=-1):
+        size = len(self.buffer) if size is None or size < 0 else size
+        self.lastChunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(self.lastChunk)
+        return self.lastChunk
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or position < self.position - len(self.lastChunk) or position > self.position:
+            raise Exception("Cannot seek resumable upload buffer to {position}, at: {current}".format(position=position, current=self.position))
+
+        unacknowledgedBytes = self.position - position
+        if unacknowledgedBytes > 0:
+            self.buffer[:0] = self.lastChunk[-unacknowledgedBytes:]
+            self.lastChunk = self.lastChunk[:-unacknowledgedBytes]
+        self.position = position
+        return self.position
+
+# writes a gcs object in chunks of `RESUMABLE_UPLOAD_CHUNK_SIZE` as it is written, without knowing its size up front.
+# The session is opened with `create_resumable_upload_session` and each chunk is sent to the session url, which needs no
+# other credentials. See https://cloud.google.com/storage/docs/performing-resumable-uploads
+class GcsResumableWriter:
+    def __init__(self, blobName, contentType, chunkSize=RESUMABLE_UPLOAD_CHUNK_SIZE):
+        print("Opening resumable upload to gcs: {name}".format(name=blobName))
+        self.blobName = blobName
+        self.chunkSize = chunkSize
+        self.stream = ResumableUploadBuffer()
+        self.bytesUploaded = 0
+        self.finished = False
+        blob = storage_client.get_bucket(CLOUD_STORAGE_BUCKET).blob(blobName)
+        self.sessionUrl = blob.create_resumable_upload_session(content_type=contentType, client=storage_client)
+
+    def write(self, data):
+        self.stream.write(data)
+        # only the last chunk of an upload may be shorter than `chunkSize`, so only full chunks are sent before `close`
+        while self.stream.buffered_size() >= self.chunkSize:
+            self.transmit_next_chunk()
+
+    # the last chunk carries the size of the object, which completes the upload. Bytes gcs did not acknowledge are sent
+    # again. When a chunk fails with a retryable status or a timeout, the offset gcs has persisted is queried with
+    # `bytes */*` after a backoff and the upload resumes from there
+    def transmit_next_chunk(self, lastChunk=False):
+        for attempt in range(1, RESUMABLE_UPLOAD_MAX_ATTEMPTS + 1):
+            start = self.stream.tell()
+            chunk = self.stream.read(self.chunkSize)
+            totalSize = str(start + len(chunk)) if lastChunk else "*"
+            contentRange = "bytes {start}-{end}/{total}".format(start=start, end=start + len(chunk) - 1, total=totalSize) if chunk else "bytes */{total}".format(total=totalSize)
+
+            response = self.put_to_session(chunk, contentRange)
+            if response is not None and response.status_code not in RESUMABLE_UPLOAD_RETRYABLE_STATUS_CODES:
+                self.handle_session_response(response)
+                return
+
+            if attempt == RESUMABLE_UPLOAD_MAX_ATTEMPTS:
+                break
+
+            backoffInSeconds = RESUMABLE_UPLOAD_RETRY_BACKOFF_IN_SECONDS * 2 ** (attempt - 1)
+            print("Resumable upload to gcs: {name} failed at byte: {start}, querying its persisted offset in {backoff} seconds".format(name=self.blobName, start=start, backoff=backoffInSeconds))
+            time.sleep(backoffInSeconds)
+            statusResponse = self.put_to_session(b"", "bytes */{total}".format(total=totalSize))
+            if statusResponse is None or statusResponse.status_code in RESUMABLE_UPLOAD_RETRYABLE_STATUS_CODES:
+                self.stream.seek(start)
+                continue
+
+            self.handle_session_response(statusResponse)
+            if self.finished:
+                return
+
+        raise Exception("Resumable upload to gcs: {name} failed after {attempts} attempts".format(name=self.blobName, attempts=RESUMABLE_UPLOAD_MAX_ATTEMPTS))
+
+    # a timed out or dropped request is returned as None, to be retried like a retryable status
+    def put_to_session(self, data, contentRange):
+        try:
+            return requests.put(self.sessionUrl, data=data, headers={ "Content-Range": contentRange }, timeout=RESUMABLE_UPLOAD_TIMEOUT_IN_SECONDS)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            print("Request to resumable upload to gcs: {name} failed. Error: {error}".format(name=self.blobName, error=error))
+            return None
+
+    def handle_session_response(self, response):
+        if response.status_code in [200, 201]:
+            self.bytesUploaded = self.stream.tell()
+            self.finished = True
+            return
+        if response.status_code != 308:
+            raise Exception("Resumable upload to gcs: {name} failed with status: {status}. Response: {text}".format(name=self.blobName, status=response.status_code, text=response.text))
+
+        # the `Range` header, e.g. `bytes=0-262143`, holds the bytes gcs has persisted, it is missing when there are none
+        acknowledgedRange = response.headers.get("Range")
+        self.bytesUploaded = int(acknowledgedRange.split("-")[1]) + 1 if acknowledgedRange else 0
+        if self.bytesUploaded != self.stream.tell():
+            self.stream.seek(self.bytesUploaded)
+
+    def close(self):
+        while not self.finished:
+            self.transmit_next_chunk(lastChunk=self.stream.buffered_size() <= self.chunkSize)
+        print("Completed resumable upload to gcs: {name}, bytes: {size}".format(name=self.blobName, size=self.bytesUploaded))
+
+    def __enter__(self):
+        return self
+
+    # an upload that failed part way is left unfinished, gcs discards it
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        if exceptionType is None:
+            self.close()
+
+# a seekable reader over a gcs object, each read is a ranged download, so `zipfile` can read the central directory
+# and the members of an export without downloading it
+class GcsRangedReader(io.RawIOBase):
+    def __init__(self, blob):
+        self.blob = blob
+        self.size = blob.size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+
+        end = min(self.position + len(buffer), self.size) - 1
+        data = self.blob.download_as_string(start=self.position, end=end)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def open_gcs_file_for_ranged_reads(blobName):
+    blob = storage_client.get_bucket(CLOUD_STORAGE_BUCKET).get_blob(blobName)
+    if blob is None:
+        raise Exception("File: {name} not found in gcs bucket: {bucket}".format(name=blobName, bucket=CLOUD_STORAGE_BUCKET))
+    return io.BufferedReader(GcsRangedReader(blob), buffer_size=RANGED_READ_BUFFER_SIZE)
+
+def construct_raw_download_blob_name(day):
+    return "{folder}/{day}.zip".format(folder=RAW_DOWNLOAD_GCS_FOLDER, day=day)
+
+# the export is stored as the raw download backup, without touching /tmp
+def stream_amplitude_export_to_gcs(day):
+    print("streaming data for {day} from amplitude to gcs".format(day=day))
+    response = requests.get(
+        AMPLITUDE_EXPORT_URL,
+        params={ "start": day + "T00", "end": day + "T23" },
+        auth=(API_KEY, API_SECRET),
+        stream=True,
+        timeout=AMPLITUDE_EXPORT_TIMEOUT_IN_SECONDS
+    )
+    try:
+        if response.status_code != 200:
+            raise Exception(
+                """
+                Amplitude export for {day} failed with status: {status}.
+                Note that amplitude responds with 404 when there was no user activity that day.
+                """.format(day=day, status=response.status_code)
+            )
+
+        blobName = construct_raw_download_blob_name(day)
+        with GcsResumableWriter(blobName, "application/zip") as writer:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+    finally:
+        response.close()
+
+    print("completed streaming data for {day} from amplitude to gcs: {name}".format(day=day, name=blobName))
+    return blobName
+
+# the hourly file is decompressed, transformed and uploaded one line at a time
+def transform_gzip_member_into_gcs_import_file(zipReader, member, filename):
+    print("Transforming .gz member: {member} of amplitude export into: {filename}".format(member=member.filename, filename=filename))
+    currentTime = fetch_current_time_in_milliseconds()
+    blobName = "{folder}/{file}".format(folder=FORMATTED_FILES_GCS_FOLDER, file=filename)
+
+    with zipReader.open(member) as memberStream, \
+            io.TextIOWrapper(gzip.GzipFile(fileobj=memberStream), encoding="utf-8") as lines, \
+            GcsResumableWriter(blobName, "application/json") as writer:
+        for line in lines:
+            line = line.strip()
+            if line:
+                writer.write((process_line_json(line, currentTime) + "\r\n").encode("utf-8"))
+
+    return construct_gcs_import_url(filename)
+
+def list_gzip_members_of_gcs_export(blobName):
+    with open_gcs_file_for_ranged_reads(blobName) as exportStream, zipfile.ZipFile(exportStream) as zipReader:
+        return [member.filename for member in zipReader.infolist() if member.filename.endswith('.gz')]
+
+# each call opens its own reader on the export, so members can be transformed by separate worker processes
+def transform_gzip_member_of_gcs_export(blobName, memberName):
+    with open_gcs_file_for_ranged_reads(blobName) as exportStream, zipfile.ZipFile(exportStream) as zipReader:
+        return transform_gzip_member_into_gcs_import_file(zipReader, zipReader.getinfo(memberName), file_json(os.path.basename(memberName)))
+
+def load_gzip_member_import_file(memberName, gcs_url):
+    load_gcs_file_into_bigquery(gcs_url, 'all_user_events')
+    print("======Completed Import from Amplitude to Big Query for: {file}======".format(file=file_json(os.path.basename(memberName))))
+
+def process_gzip_members_of_gcs_export(blobName, day):
+    print("Processing .gz members of export: {name} for day: {day}".format(name=blobName, day=day))
+    return process_hourly_files(
+        list_gzip_members_of_gcs_export(blobName),
+        functools.partial(transform_gzip_member_of_gcs_export, blobName),
+        load_gzip_member_import_file
+    )
+
+def sync_amplitude_data_to_big_query_by_streaming(day_to_sync):
+    blobName = stream_amplitude_export_to_gcs(day_to_sync)
+    process_gzip_members_of_gcs_export(blobName, day_to_sync)
+
 def final_clean_up(file_location, day):
     # Remove the original zipfile
     print("Removing the original zip file: {file_location} downloaded from Amplitude for {day}".format(day=day, file_location=file_location))
@@ -280,31 +544,70 @@ def remove_local_files_for_gz_extracts(file):
     print("===========================================================================")
     print("===========================================================================")
 
+# a worker process gets its own storage client, so it does not share the connections of the process it was forked from
+def initialize_file_worker():
+    global storage_client
+    storage_client = storage.Client(project=PROJECT_ID)
+
+def create_file_worker_pool(workers):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initialize_file_worker)
+
+def report_failed_files(failedFiles):
+    if failedFiles:
+        print("Failed to process {count} files: {files}".format(count=len(failedFiles), files=failedFiles))
+    return failedFiles
+
+# `transformFile(file)` returns the gcs url of the formatted file, `loadFile(file, gcs_url)` loads it. A file that fails
+# is reported without stopping the others. Returns the error of each failed file, by file
+def process_hourly_files(files, transformFile, loadFile):
+    failedFiles = {}
+    if SYNC_WORKERS <= 1:
+        for file in files:
+            try:
+                print("Parsing file: {name}".format(name=file))
+                loadFile(file, transformFile(file))
+            except Exception as err:
+                print("Error occurred while processing file: {file}. Error: {err}".format(file=file, err=err))
+                failedFiles[file] = str(err)
+        return report_failed_files(failedFiles)
+
+    print("Processing {count} files with {workers} worker processes".format(count=len(files), workers=SYNC_WORKERS))
+    with create_file_worker_pool(SYNC_WORKERS) as workerPool:
+        futures = { workerPool.submit(transformFile, file): file for file in files }
+        for future in concurrent.futures.as_completed(futures):
+            file = futures[future]
+            try:
+                loadFile(file, future.result())
+            except Exception as err:
+                print("Error occurred while processing file: {file}. Error: {err}".format(file=file, err=err))
+                failedFiles[file] = str(err)
+
+    return report_failed_files(failedFiles)
+
+def transform_and_upload_gzip_file(file):
+    lines = unzip_gzip(file)
+
+    FILE_NAME_JSON = file_json(file)
+    path_to_events_file_on_local = convert_text_to_json(FILE_NAME_JSON, lines)
+
+    upload_file_to_gcs(path_to_events_file_on_local, FILE_NAME_JSON, FORMATTED_FILES_GCS_FOLDER)
+    return construct_gcs_import_url(FILE_NAME_JSON)
+
+def load_gzip_file_and_clean_up(file, gcs_url):
+    # Import data from Google Cloud Storage into Google BigQuery
+    load_gcs_file_into_bigquery(gcs_url, 'all_user_events')
+    print("===========================================================================")
+    print("===========================================================================")
+    print("======Completed Import from Amplitude to Big Query for: {file}======".format(file=file_json(file)))
+    print("===========================================================================")
+    print("===========================================================================")
+
+    remove_local_files_for_gz_extracts(file)
+
 def process_gzip_files_in_root_location(day):
     # Loop through all new files, unzip them & remove the .gz
     print("Processing .gz files in root location: {name} for day: {day}".format(name=UNZIPPED_FILE_ROOT_LOCATION, day=day))
-    for file in file_list('.gz'):
-        try:
-            print("Parsing file: {name}".format(name=file))
-            lines = unzip_gzip(file)
-
-            FILE_NAME_JSON = file_json(file)
-            path_to_events_file_on_local = convert_text_to_json(FILE_NAME_JSON, lines)
-
-            upload_file_to_gcs(path_to_events_file_on_local, FILE_NAME_JSON, FORMATTED_FILES_GCS_FOLDER)
-
-            # Import data from Google Cloud Storage into Google BigQuery
-            gcs_url = f"gs://{CLOUD_STORAGE_BUCKET}/{FORMATTED_FILES_GCS_FOLDER}/{FILE_NAME_JSON}"
-            load_gcs_file_into_bigquery(gcs_url, 'all_user_events')
-            print("===========================================================================")
-            print("===========================================================================")
-            print("======Completed Import from Amplitude to Big Query for: {file}======".format(file=FILE_NAME_JSON))
-            print("===========================================================================")
-            print("===========================================================================")
-
-            remove_local_files_for_gz_extracts(file)
-        except Exception as err:
-            print("Error occurred while processing a .gz file. Error: {}".format(err))
+    return process_hourly_files(file_list('.gz'), transform_and_upload_gzip_file, load_gzip_file_and_clean_up)
 
 
 
@@ -340,6 +643,11 @@ def sync_amplitude_data_to_big_query(event, context):
 
     try:
         print("Trigger received from cloud scheduler")
+        if SYNC_PIPELINE == SYNC_PIPELINES["streaming"]:
+            sync_amplitude_data_to_big_query_by_streaming(day_to_sync)
+            signal_operation_complete(day_to_sync)
+            return
+
         download_from_amplitude_location = fetch_data_from_amplitude(day_to_sync)
 
         # backup the downloaded file because it might be needed in the future
@@ -5,6 +5,9 @@ from datetime import datetime, timedelta
 from google.cloud import bigquery, storage
 import zipfile
 import json
+import gzip
+import io
+import concurrent.futures
 
 from main \
     import signal_operation_complete, \
@@ -25,7 +28,11 @@ from main \
     convert_text_to_json, \
     process_line_json, \
     load_gcs_file_into_bigquery, \
-    sync_amplitude_data_to_big_query
+    sync_amplitude_data_to_big_query, \
+    ResumableUploadBuffer, \
+    GcsResumableWriter, \
+    process_gzip_members_of_gcs_export, \
+    process_hourly_files
 
 from unittest.mock import patch, call
 
@@ -33,7 +40,7 @@ import main
 
 TEMP = main.TEMP
 
-ACCOUNT_ID = main.ACCOUNT_ID
+AMPLITUDE_PROJECT_ID = main.AMPLITUDE_PROJECT_ID
 API_KEY = main.API_KEY
 API_SECRET = main.API_SECRET
 PROJECT_ID = main.PROJECT_ID
@@ -291,3 +298,241 @@ def test_sync_amplitude_data_to_big_query(
     signal_operation_complete_patch.assert_called()
 
     # TODO: assert call order of patched functions
+
+
+# stands in for the session url of a gcs resumable upload. `acknowledgedBytesPerChunk` makes it persist fewer bytes of a
+# chunk than were sent, as gcs may
+class SampleResumableUploadSession:
+    def __init__(self, acknowledgedBytesPerChunk=None, failedChunks=None):
+        self.acknowledgedBytesPerChunk = acknowledgedBytesPerChunk
+        # chunk number -> bytes of the chunk persisted before the request fails with a 503
+        self.failedChunks = dict(failedChunks or {})
+        self.data = b""
+        self.chunks = []
+        self.contentRanges = []
+        self.finished = False
+
+    def put(self, url, data, headers, timeout):
+        self.contentRanges.append(headers["Content-Range"])
+        byteRange, totalSize = headers["Content-Range"].replace("bytes ", "").split("/")
+        if byteRange != "*":
+            assert int(byteRange.split("-")[0]) == len(self.data)
+        if data and len(self.chunks) in self.failedChunks:
+            self.data += data[:self.failedChunks.pop(len(self.chunks))]
+            self.chunks.append(data)
+            response = Mock()
+            response.status_code = 503
+            return response
+        acknowledgedBytes = data if self.acknowledgedBytesPerChunk is None or totalSize != "*" else data[:self.acknowledgedBytesPerChunk]
+        self.chunks.append(data)
+        self.data += acknowledgedBytes
+
+        response = Mock()
+        if totalSize != "*" and len(self.data) == int(totalSize):
+            self.finished = True
+            response.status_code = 200
+        else:
+            response.status_code = 308
+            response.headers = { "Range": "bytes=0-{}".format(len(self.data) - 1) } if self.data else {}
+        return response
+
+class SampleRangedBlob:
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.ranges = []
+
+    def download_as_string(self, start, end):
+        self.ranges.append((start, end))
+        return self.data[start:end + 1]
+
+class SampleUploadBucket:
+    def __init__(self, exportBlob=None):
+        self.exportBlob = exportBlob
+
+    def get_blob(self, name):
+        return self.exportBlob
+
+    def blob(self, name):
+        blob = Mock()
+        blob.create_resumable_upload_session.return_value = "https://storage.googleapis.com/upload/{}".format(name)
+        return blob
+
+# routes each chunk sent to a session url to the upload of its object
+class SampleResumableUploads(dict):
+    def __init__(self, acknowledgedBytesPerChunk=None):
+        self.acknowledgedBytesPerChunk = acknowledgedBytesPerChunk
+
+    def put(self, url, data, headers, timeout):
+        name = url.replace("https://storage.googleapis.com/upload/", "")
+        if name not in self:
+            self[name] = SampleResumableUploadSession(self.acknowledgedBytesPerChunk)
+        return self[name].put(url, data, headers, timeout)
+
+def test_resumable_upload_buffer_resumes_from_acknowledged_byte():
+    stream = ResumableUploadBuffer()
+    stream.write(b"abcdef")
+
+    assert stream.read(4) == b"abcd"
+    stream.seek(2)
+
+    assert stream.tell() == 2
+    assert stream.read(10) == b"cdef"
+    with pytest.raises(Exception):
+        stream.seek(0)
+
+def test_gcs_resumable_writer_sends_full_chunks_until_closed(mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket()
+    uploads = SampleResumableUploads()
+
+    with patch('main.requests.put', side_effect=uploads.put):
+        with GcsResumableWriter("import/sample.json", "application/json", chunkSize=4) as writer:
+            writer.write(b"abc")
+            assert "import/sample.json" not in uploads
+            writer.write(b"defghij")
+            assert uploads["import/sample.json"].chunks == [b"abcd", b"efgh"]
+
+    assert uploads["import/sample.json"].chunks == [b"abcd", b"efgh", b"ij"]
+    assert uploads["import/sample.json"].finished
+
+def test_gcs_resumable_writer_resends_unacknowledged_bytes(mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket()
+    uploads = SampleResumableUploads(acknowledgedBytesPerChunk=3)
+
+    with patch('main.requests.put', side_effect=uploads.put):
+        with GcsResumableWriter("import/sample.json", "application/json", chunkSize=4) as writer:
+            writer.write(b"abcdefghij")
+
+    assert uploads["import/sample.json"].chunks == [b"abcd", b"defg", b"ghij", b"j"]
+    assert uploads["import/sample.json"].data == b"abcdefghij"
+    assert writer.bytesUploaded == 10
+
+@patch('main.time.sleep')
+@patch('main.requests.put')
+def test_gcs_resumable_writer_resumes_from_persisted_offset_when_chunk_fails(requests_put_patch, sleep_patch, mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket()
+    uploads = SampleResumableUploads()
+    uploads["import/sample.json"] = SampleResumableUploadSession(failedChunks={ 1: 2 })
+    requests_put_patch.side_effect = uploads.put
+
+    with GcsResumableWriter("import/sample.json", "application/json", chunkSize=4) as writer:
+        writer.write(b"abcdefghij")
+
+    assert uploads["import/sample.json"].contentRanges == ["bytes 0-3/*", "bytes 4-7/*", "bytes */*", "bytes 6-9/*", "bytes */10"]
+    assert uploads["import/sample.json"].data == b"abcdefghij"
+    assert writer.bytesUploaded == 10
+    sleep_patch.assert_called_once_with(main.RESUMABLE_UPLOAD_RETRY_BACKOFF_IN_SECONDS)
+
+@patch('main.time.sleep')
+@patch('main.requests.put')
+def test_gcs_resumable_writer_raises_when_chunk_keeps_failing(requests_put_patch, sleep_patch, mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket()
+    requests_put_patch.return_value.status_code = 503
+
+    with pytest.raises(Exception, match="failed after 5 attempts"):
+        with GcsResumableWriter("import/sample.json", "application/json", chunkSize=4) as writer:
+            writer.write(b"abcd")
+
+    assert sleep_patch.call_count == main.RESUMABLE_UPLOAD_MAX_ATTEMPTS - 1
+
+@patch('main.requests.put')
+def test_gcs_resumable_writer_raises_when_upload_fails(requests_put_patch, mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket()
+    requests_put_patch.return_value.status_code = 410
+
+    with pytest.raises(Exception, match="failed with status: 410"):
+        with GcsResumableWriter("import/sample.json", "application/json", chunkSize=4) as writer:
+            writer.write(b"abcd")
+
+def construct_sample_export(lines_per_hour):
+    exportFile = io.BytesIO()
+    with zipfile.ZipFile(exportFile, "w") as exportZip:
+        for hour, lines in lines_per_hour.items():
+            exportZip.writestr("240333/240333_2019-11-14_{hour}#327.json.gz".format(hour=hour), gzip.compress("\n".join(lines).encode("utf-8")))
+    return exportFile.getvalue()
+
+@patch('main.zipfile', zipfile)
+@patch('main.fetch_current_time_in_milliseconds', Mock(return_value=time_in_milliseconds_now))
+@patch('main.load_gcs_file_into_bigquery')
+def test_process_gzip_members_of_gcs_export_streams_each_hour_into_import_file(load_gcs_file_patch, mock_google_cloud_storage):
+    main.storage_client = mock_google_cloud_storage
+    exportBlob = SampleRangedBlob(construct_sample_export({ "01": [sample_line_from_json_file, ""], "02": ["not json", sample_line_from_json_file] }))
+    mock_google_cloud_storage.get_bucket.return_value = SampleUploadBucket(exportBlob)
+    uploads = SampleResumableUploads()
+
+    with patch('main.requests.put', side_effect=uploads.put):
+        process_gzip_members_of_gcs_export("export/{}.zip".format(sample_day), sample_day)
+
+    importedLines = b"".join(uploads["import/240333_2019-11-14_01#327.json"].chunks).decode("utf-8").split("\r\n")
+    assert [json.loads(line) for line in importedLines if line] == [sample_processed_line]
+    assert "import/240333_2019-11-14_02#327.json" not in uploads
+    load_gcs_file_patch.assert_called_once_with(
+        "gs://{bucket}/{folder}/240333_2019-11-14_01#327.json".format(bucket=CLOUD_STORAGE_BUCKET, folder=FORMATTED_FILES_GCS_FOLDER),
+        sample_table
+    )
+    assert all(end - start < main.RANGED_READ_BUFFER_SIZE for start, end in exportBlob.ranges)
+
+@patch('main.signal_operation_complete')
+@patch('main.fetch_data_from_amplitude')
+@patch('main.process_gzip_members_of_gcs_export')
+@patch('main.stream_amplitude_export_to_gcs')
+@patch('main.SYNC_PIPELINE', main.SYNC_PIPELINES["streaming"])
+def test_sync_amplitude_data_to_big_query_by_streaming(
+        stream_amplitude_export_to_gcs_patch,
+        process_gzip_members_of_gcs_export_patch,
+        fetch_data_from_amplitude_patch,
+        signal_operation_complete_patch
+):
+    stream_amplitude_export_to_gcs_patch.return_value = "export/{}.zip".format(sample_day)
+
+    sync_amplitude_data_to_big_query({ "day_to_sync": sample_day }, {})
+
+    stream_amplitude_export_to_gcs_patch.assert_called_once_with(sample_day)
+    process_gzip_members_of_gcs_export_patch.assert_called_once_with("export/{}.zip".format(sample_day), sample_day)
+    fetch_data_from_amplitude_patch.assert_not_called()
+    signal_operation_complete_patch.assert_called_once_with(sample_day)
+
+def fail_on_second_hour(file):
+    if file.startswith("02"):
+        raise Exception("Invalid gzip")
+    return "gs://{bucket}/import/{file}".format(bucket=CLOUD_STORAGE_BUCKET, file=file)
+
+def fail_to_load_third_hour(file, gcs_url):
+    if file.startswith("03"):
+        raise Exception("Load job failed")
+
+@patch('main.SYNC_WORKERS', 1)
+def test_process_hourly_files_reports_each_failed_file():
+    loadFile = Mock()
+
+    failedFiles = process_hourly_files(["01.gz", "02.gz", "03.gz"], fail_on_second_hour, loadFile)
+
+    assert failedFiles == { "02.gz": "Invalid gzip" }
+    assert [loadCall[0][0] for loadCall in loadFile.call_args_list] == ["01.gz", "03.gz"]
+
+@patch('main.create_file_worker_pool')
+@patch('main.SYNC_WORKERS', 3)
+def test_process_hourly_files_transforms_files_in_worker_pool(create_file_worker_pool_patch):
+    create_file_worker_pool_patch.side_effect = lambda workers: concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    loadFile = Mock(side_effect=fail_to_load_third_hour)
+
+    failedFiles = process_hourly_files(["01.gz", "02.gz", "03.gz", "04.gz"], fail_on_second_hour, loadFile)
+
+    create_file_worker_pool_patch.assert_called_once_with(3)
+    assert failedFiles == { "02.gz": "Invalid gzip", "03.gz": "Load job failed" }
+    assert sorted(loadCall[0] for loadCall in loadFile.call_args_list) == [
+        ("01.gz", fail_on_second_hour("01.gz")), ("03.gz", fail_on_second_hour("03.gz")), ("04.gz", fail_on_second_hour("04.gz"))
+    ]
+
+@patch('main.initialize_file_worker', Mock())
+@patch('main.SYNC_WORKERS', 2)
+def test_process_hourly_files_runs_transforms_in_separate_processes():
+    loadFile = Mock()
+
+    assert process_hourly_files([sample_gz_file], file_json, loadFile) == {}
+    loadFile.assert_called_once_with(sample_gz_file, sample_json_file)
@@ -0,0 +1,47 @@
+-- Rebuilds `ops.user_behaviour_monthly_aggregates` from `ops.user_behaviour`. `refresh-monthly-aggregates` builds the
+-- table on its first run too, this script is for when the saving_event benchmarks change. It recomputes every month,
+-- so it can be re-run safely. Rows written in the last five minutes (MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS) are
+-- left to the next refresh, as they may not be visible to queries yet.
+-- The benchmarks are FIRST_BENCHMARK_SAVING_EVENT and SECOND_BENCHMARK_SAVING_EVENT of `constant.py` in hundredth cents.
+declare computed_through int64 default unix_millis(current_timestamp()) - 300000;
+
+merge `ops.user_behaviour_monthly_aggregates` as `aggregates`
+using (
+    select `user_id`, `transaction_type`, `month_start`,
+    count(*) as `transaction_count`,
+    sum(`amount`) as `amount_sum`,
+    countif(`amount` > 1000000000) as `count_above_first_benchmark`,
+    countif(`amount` > 500000000) as `count_above_second_benchmark`,
+    array_agg(`amount` order by `time_transaction_occurred` desc limit 1)[offset(0)] as `latest_transaction_amount`,
+    max(`time_transaction_occurred`) as `latest_transaction_time`,
+    computed_through as `computed_through`,
+    unix_millis(current_timestamp()) as `updated_at`
+    from (
+        select `user_id`, `transaction_type`, `amount`, `time_transaction_occurred`,
+        unix_millis(timestamp_trunc(timestamp_millis(`time_transaction_occurred`), month)) as `month_start`
+        from `ops.user_behaviour`
+        where `created_at` <= computed_through
+    )
+    group by `user_id`, `transaction_type`, `month_start`
+) as `recomputed`
+on `aggregates`.`user_id` = `recomputed`.`user_id`
+and `aggregates`.`transaction_type` = `recomputed`.`transaction_type`
+and `aggregates`.`month_start` = `recomputed`.`month_start`
+when matched then update set
+    `transaction_count` = `recomputed`.`transaction_count`,
+    `amount_sum` = `recomputed`.`amount_sum`,
+    `count_above_first_benchmark` = `recomputed`.`count_above_first_benchmark`,
+    `count_above_second_benchmark` = `recomputed`.`count_above_second_benchmark`,
+    `latest_transaction_amount` = `recomputed`.`latest_transaction_amount`,
+    `latest_transaction_time` = `recomputed`.`latest_transaction_time`,
+    `computed_through` = `recomputed`.`computed_through`,
+    `updated_at` = `recomputed`.`updated_at`
+when not matched then insert (
+    `user_id`, `transaction_type`, `month_start`, `transaction_count`, `amount_sum`, `count_above_first_benchmark`,
+    `count_above_second_benchmark`, `latest_transaction_amount`, `latest_transaction_time`, `computed_through`, `updated_at`
+) values (
+    `recomputed`.`user_id`, `recomputed`.`transaction_type`, `recomputed`.`month_start`,
+    `recomputed`.`transaction_count`, `recomputed`.`amount_sum`, `recomputed`.`count_above_first_benchmark`,
+    `recomputed`.`count_above_second_benchmark`, `recomputed`.`latest_transaction_amount`,
+    `recomputed`.`latest_transaction_time`, `recomputed`.`computed_through`, `recomputed`.`updated_at`
+)
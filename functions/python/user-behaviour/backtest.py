@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Replays the `user_behaviour` history through the fraud rules to see who would have been flagged, and when, under a
+# given set of thresholds. A fraud check is simulated after every transaction, and a flag for a rule becomes that
+# rule's cut off time for the user, as it does in the fraud detector. Each user's history is evaluated with numpy over
+# all of their transactions at once, instead of one fetch-user-behaviour request per transaction.
+#
+# Usage: python backtest.py [--history-file <csv>] [--output-file <csv>] [--first-benchmark <whole currency>] ...
+# Without a history file the history is loaded from BigQuery. Needs numpy and pandas, which are not deployed with the
+# cloud function.
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import constant
+
+MILLISECONDS_IN_AN_HOUR = constant.SECONDS_IN_AN_HOUR * constant.SECOND_TO_MILLISECOND_FACTOR
+MILLISECONDS_IN_A_DAY = constant.HOURS_IN_A_DAY * MILLISECONDS_IN_AN_HOUR
+# `calculate_date_n_months_ago` subtracts whole days from today
+DAYS_IN_SIX_MONTHS = int(constant.SIX_MONTHS_INTERVAL * constant.TOTAL_DAYS_IN_A_YEAR / constant.MONTHS_IN_A_YEAR)
+EVALUATION_CHUNK_SIZE = 1024
+
+DEFAULT_THRESHOLDS = {
+    "firstBenchmark": constant.FIRST_BENCHMARK_SAVING_EVENT,
+    "secondBenchmark": constant.SECOND_BENCHMARK_SAVING_EVENT,
+    "countAboveSecondBenchmark": constant.FLAG_CANDIDATE_THRESHOLDS["countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod"],
+    "multiplier": constant.MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT,
+    "errorTolerance": constant.ERROR_TOLERANCE_PERCENTAGE_FOR_SAVING_EVENTS,
+    "countOfWithdrawalsDuringMonthCycle": constant.FLAG_CANDIDATE_THRESHOLDS["countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle"],
+    "countOfWithdrawalsDuringWeekCycle": constant.FLAG_CANDIDATE_THRESHOLDS["countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle"],
+}
+
+def load_user_behaviour_history(historyFile=None):
+    if historyFile:
+        print("Loading user behaviour history from file: {}".format(historyFile))
+        return pd.read_csv(historyFile)
+
+    from google.cloud import bigquery
+    print("Loading user behaviour history from big query")
+    return bigquery.Client().query(
+        """
+        select `user_id`, `transaction_type`, `amount`, `time_transaction_occurred`
+        from `ops.user_behaviour`
+        """
+    ).to_dataframe()
+
+def convert_whole_currency_to_hundredth_cent(amount):
+    return amount * constant.FACTOR_TO_CONVERT_WHOLE_CURRENCY_TO_HUNDREDTH_CENT
+
+def calculate_start_of_day(times):
+    return times - np.mod(times, MILLISECONDS_IN_A_DAY)
+
+def count_in_range(cumulativeCounts, lowerIndices, upperIndices):
+    return np.where(upperIndices > lowerIndices, cumulativeCounts[upperIndices] - cumulativeCounts[np.minimum(lowerIndices, upperIndices)], 0)
+
+# Repeatedly finds the first evaluation after the current cut off at which the rule holds. That evaluation flags the
+# user and becomes the new cut off, as the fraud detector's flag time does
+def find_flag_times(evaluationTimes, ruleHolds):
+    flagTimes = []
+    cutOffTime = constant.DEFAULT_LATEST_FLAG_TIME
+    while True:
+        holds = ruleHolds(cutOffTime) & (evaluationTimes > cutOffTime)
+        if not holds.any():
+            return flagTimes
+
+        cutOffTime = evaluationTimes[np.argmax(holds)]
+        flagTimes.append(cutOffTime)
+
+def construct_saving_event_rules(savingTimes, savingAmounts, evaluationTimes, thresholds):
+    firstBenchmark = convert_whole_currency_to_hundredth_cent(thresholds["firstBenchmark"])
+    secondBenchmark = convert_whole_currency_to_hundredth_cent(thresholds["secondBenchmark"])
+    cumulativeAboveFirstBenchmark = np.concatenate([[0], np.cumsum(savingAmounts > firstBenchmark)])
+    cumulativeAboveSecondBenchmark = np.concatenate([[0], np.cumsum(savingAmounts > secondBenchmark)])
+    cumulativeAmounts = np.concatenate([[0], np.cumsum(savingAmounts, dtype=np.float64)])
+
+    # savings up to each evaluation are [.., upperIndices), the six month window starts at sixMonthsIndices
+    upperIndices = np.searchsorted(savingTimes, evaluationTimes, side="right")
+    sixMonthsIndices = np.searchsorted(savingTimes, calculate_start_of_day(evaluationTimes) - DAYS_IN_SIX_MONTHS * MILLISECONDS_IN_A_DAY, side="left")
+
+    def cut_off_index(cutOffTime):
+        return np.searchsorted(savingTimes, cutOffTime, side="right")
+
+    def single_very_large_saving_event(cutOffTime):
+        return count_in_range(cumulativeAboveFirstBenchmark, cut_off_index(cutOffTime), upperIndices) > 0
+
+    def saving_events_greater_than_benchmark_within_six_months(cutOffTime):
+        lowerIndices = np.maximum(sixMonthsIndices, cut_off_index(cutOffTime))
+        return count_in_range(cumulativeAboveSecondBenchmark, lowerIndices, upperIndices) >= thresholds["countAboveSecondBenchmark"]
+
+    # as in fetch-user-behaviour, a latest saving_event without savings in the six month window has an average of 0
+    def latest_saving_event_greater_than_six_months_average(cutOffTime):
+        cutOffIndex = cut_off_index(cutOffTime)
+        lowerIndices = np.maximum(sixMonthsIndices, cutOffIndex)
+        countInWindow = count_in_range(np.arange(len(savingAmounts) + 1), lowerIndices, upperIndices)
+        amountInWindow = count_in_range(cumulativeAmounts, lowerIndices, upperIndices)
+        averageInWindow = np.divide(amountInWindow, countInWindow, out=np.zeros(len(evaluationTimes)), where=countInWindow > 0)
+        hasLatestSavingEvent = upperIndices > cutOffIndex
+        latestSavingEvent = np.where(hasLatestSavingEvent, savingAmounts[np.maximum(upperIndices - 1, 0)] if len(savingAmounts) else 0, 0)
+        return hasLatestSavingEvent & (latestSavingEvent > averageInWindow * thresholds["multiplier"])
+
+    return {
+        "single_very_large_saving_event": single_very_large_saving_event,
+        "saving_events_greater_than_benchmark_within_six_months": saving_events_greater_than_benchmark_within_six_months,
+        "latest_saving_event_greater_than_six_months_average": latest_saving_event_greater_than_six_months_average,
+    }
+
+# Pairs of a withdrawal and a saving_event matched as in `check_each_withdrawal_against_saving_event_for_flagged_withdrawals`:
+# withdrawal within the error tolerance of the saving_event, at most `numOfHours` after it (or any time before it)
+def find_withdrawal_saving_event_pairs(withdrawalTimes, withdrawalAmounts, savingTimes, savingAmounts, numOfDays, numOfHours, errorTolerance):
+    # both transactions of a pair lie in one days cycle, which spans less than `numOfDays + 1` days
+    maximumDistance = (numOfDays + 1) * MILLISECONDS_IN_A_DAY
+    lowerIndices = np.searchsorted(savingTimes, withdrawalTimes - maximumDistance, side="left")
+    upperIndices = np.searchsorted(savingTimes, withdrawalTimes + maximumDistance, side="right")
+
+    candidateCounts = upperIndices - lowerIndices
+    withdrawalIndices = np.repeat(np.arange(len(withdrawalTimes)), candidateCounts)
+    savingIndices = np.arange(candidateCounts.sum()) - np.repeat(np.cumsum(candidateCounts) - candidateCounts, candidateCounts) + np.repeat(lowerIndices, candidateCounts)
+
+    pairWithdrawalTimes = withdrawalTimes[withdrawalIndices]
+    pairSavingTimes = savingTimes[savingIndices]
+    pairWithdrawalAmounts = withdrawalAmounts[withdrawalIndices]
+    pairSavingAmounts = savingAmounts[savingIndices]
+    matches = (
+        (pairSavingAmounts * errorTolerance <= pairWithdrawalAmounts)
+        & (pairWithdrawalAmounts <= pairSavingAmounts)
+        & ((pairWithdrawalTimes - pairSavingTimes) / MILLISECONDS_IN_AN_HOUR <= numOfHours)
+    )
+
+    pairFirstTimes = np.minimum(pairWithdrawalTimes, pairSavingTimes)[matches]
+    pairLastTimes = np.maximum(pairWithdrawalTimes, pairSavingTimes)[matches]
+    return pairFirstTimes, pairLastTimes
+
+def construct_withdrawal_rule(withdrawalTimes, withdrawalAmounts, savingTimes, savingAmounts, evaluationTimes, cycle, threshold, errorTolerance):
+    pairFirstTimes, pairLastTimes = find_withdrawal_saving_event_pairs(
+        withdrawalTimes, withdrawalAmounts, savingTimes, savingAmounts, cycle["numOfDays"], cycle["numOfHours"], errorTolerance
+    )
+    cycleStartTimes = calculate_start_of_day(evaluationTimes) - cycle["numOfDays"] * MILLISECONDS_IN_A_DAY
+
+    # a pair counts at an evaluation once both transactions happened, inside the cycle and after the cut off
+    def withdrawals_within_hours_of_saving_events(cutOffTime):
+        counts = np.zeros(len(evaluationTimes), dtype=np.int64)
+        for chunkStart in range(0, len(evaluationTimes), EVALUATION_CHUNK_SIZE):
+            chunk = slice(chunkStart, chunkStart + EVALUATION_CHUNK_SIZE)
+            lowerBounds = np.maximum(cycleStartTimes[chunk], cutOffTime + 1)
+            pairCounted = (pairLastTimes[None, :] <= evaluationTimes[chunk, None]) & (pairFirstTimes[None, :] >= lowerBounds[:, None])
+            counts[chunk] = pairCounted.sum(axis=1)
+        return counts > threshold
+
+    return withdrawals_within_hours_of_saving_events
+
+def evaluate_rules_for_user(userTransactions, thresholds):
+    userTransactions = userTransactions.sort_values("time_transaction_occurred")
+    isSavingEvent = (userTransactions["transaction_type"] == constant.SAVING_EVENT_TRANSACTION_TYPE).to_numpy()
+    isWithdrawal = (userTransactions["transaction_type"] == constant.WITHDRAWAL_TRANSACTION_TYPE).to_numpy()
+    times = userTransactions["time_transaction_occurred"].to_numpy(dtype=np.int64)
+    amounts = userTransactions["amount"].to_numpy(dtype=np.int64)
+
+    savingTimes, savingAmounts = times[isSavingEvent], amounts[isSavingEvent]
+    withdrawalTimes, withdrawalAmounts = times[isWithdrawal], amounts[isWithdrawal]
+    evaluationTimes = np.unique(times)
+
+    rules = construct_saving_event_rules(savingTimes, savingAmounts, evaluationTimes, thresholds)
+    rules["withdrawals_within_two_days_of_saving_events_during_one_month"] = construct_withdrawal_rule(
+        withdrawalTimes, withdrawalAmounts, savingTimes, savingAmounts, evaluationTimes,
+        { "numOfDays": constant.DAYS_IN_A_MONTH, "numOfHours": constant.HOURS_IN_TWO_DAYS },
+        thresholds["countOfWithdrawalsDuringMonthCycle"], thresholds["errorTolerance"]
+    )
+    rules["withdrawals_within_one_day_of_saving_events_during_one_week"] = construct_withdrawal_rule(
+        withdrawalTimes, withdrawalAmounts, savingTimes, savingAmounts, evaluationTimes,
+        { "numOfDays": constant.DAYS_IN_A_WEEK, "numOfHours": constant.HOURS_IN_A_DAY },
+        thresholds["countOfWithdrawalsDuringWeekCycle"], thresholds["errorTolerance"]
+    )
+
+    return {ruleLabel: find_flag_times(evaluationTimes, ruleHolds) for ruleLabel, ruleHolds in rules.items()}
+
+# returns one row per flag: `rule_label`, `user_id` and `time_flagged`, ordered by rule and time
+def replay_user_behaviour_history(history, thresholds=None):
+    thresholds = { **DEFAULT_THRESHOLDS, **(thresholds or {}) }
+    print("Replaying {rows} transactions of {users} users with thresholds: {thresholds}".format(
+        rows=len(history), users=history["user_id"].nunique(), thresholds=thresholds
+    ))
+
+    flags = []
+    for userId, userTransactions in history.groupby("user_id", sort=False):
+        for ruleLabel, flagTimes in evaluate_rules_for_user(userTransactions, thresholds).items():
+            flags.extend({ "rule_label": ruleLabel, "user_id": userId, "time_flagged": int(flagTime) } for flagTime in flagTimes)
+
+    flagTimeline = pd.DataFrame(flags, columns=["rule_label", "user_id", "time_flagged"])
+    return flagTimeline.sort_values(["rule_label", "time_flagged"]).reset_index(drop=True)
+
+def summarise_flag_timeline(flagTimeline):
+    return flagTimeline.groupby("rule_label").agg(flags=("user_id", "size"), users_flagged=("user_id", "nunique"))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Replay user behaviour history through the fraud rules")
+    parser.add_argument("--history-file", help="csv with user_id, transaction_type, amount and time_transaction_occurred")
+    parser.add_argument("--output-file", default="flag_timeline.csv")
+    parser.add_argument("--first-benchmark", type=float, help="whole currency")
+    parser.add_argument("--second-benchmark", type=float, help="whole currency")
+    parser.add_argument("--multiplier", type=float)
+    parser.add_argument("--error-tolerance", type=float)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    givenThresholds = {
+        "firstBenchmark": arguments.first_benchmark,
+        "secondBenchmark": arguments.second_benchmark,
+        "multiplier": arguments.multiplier,
+        "errorTolerance": arguments.error_tolerance,
+    }
+
+    flagTimeline = replay_user_behaviour_history(
+        load_user_behaviour_history(arguments.history_file),
+        { key: value for key, value in givenThresholds.items() if value is not None }
+    )
+    flagTimeline.to_csv(arguments.output_file, index=False)
+    print("Flags per rule:\n{}".format(summarise_flag_timeline(flagTimeline)))
+    print("Wrote flag timeline to: {}".format(arguments.output_file))
@@ -0,0 +1,106 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+from backtest \
+    import replay_user_behaviour_history, \
+    find_withdrawal_saving_event_pairs, \
+    find_flag_times, \
+    summarise_flag_timeline
+
+from main import check_each_withdrawal_against_saving_event_for_flagged_withdrawals
+
+import constant
+
+sample_user_id = "kig2"
+sample_other_user_id = "zt91"
+one_hour_in_milliseconds = 3600000
+one_day_in_milliseconds = 24 * one_hour_in_milliseconds
+sample_start_time = 1577836800000
+
+def construct_sample_transaction(userId, transactionType, amountInWholeCurrency, hoursAfterStart):
+    return {
+        "user_id": userId,
+        "transaction_type": transactionType,
+        "amount": amountInWholeCurrency * constant.FACTOR_TO_CONVERT_WHOLE_CURRENCY_TO_HUNDREDTH_CENT,
+        "time_transaction_occurred": sample_start_time + hoursAfterStart * one_hour_in_milliseconds
+    }
+
+def test_find_flag_times_moves_cut_off_to_each_flag():
+    evaluationTimes = np.array([1, 2, 3, 4])
+    # the rule holds at evaluations with more than one transaction after the cut off
+    ruleHolds = lambda cutOffTime: (evaluationTimes - max(cutOffTime, 0)) > 1
+
+    assert find_flag_times(evaluationTimes, ruleHolds) == [2, 4]
+
+def test_replay_flags_every_very_large_saving_event_once():
+    history = pd.DataFrame([
+        construct_sample_transaction(sample_user_id, "SAVING_EVENT", 1000, 0),
+        construct_sample_transaction(sample_user_id, "SAVING_EVENT", 150000, 10),
+        construct_sample_transaction(sample_user_id, "SAVING_EVENT", 1000, 20),
+        construct_sample_transaction(sample_user_id, "SAVING_EVENT", 200000, 30),
+        construct_sample_transaction(sample_other_user_id, "SAVING_EVENT", 1000, 5),
+    ])
+
+    flagTimeline = replay_user_behaviour_history(history)
+    singleVeryLargeFlags = flagTimeline[flagTimeline["rule_label"] == "single_very_large_saving_event"]
+
+    assert singleVeryLargeFlags["user_id"].tolist() == [sample_user_id, sample_user_id]
+    assert singleVeryLargeFlags["time_flagged"].tolist() == [
+        sample_start_time + 10 * one_hour_in_milliseconds,
+        sample_start_time + 30 * one_hour_in_milliseconds
+    ]
+
+def test_replay_flags_latest_saving_event_against_six_month_average():
+    history = pd.DataFrame(
+        [construct_sample_transaction(sample_user_id, "SAVING_EVENT", 100, day * 24) for day in range(10)]
+        + [construct_sample_transaction(sample_user_id, "SAVING_EVENT", 20000, 10 * 24)]
+    )
+
+    flagTimeline = replay_user_behaviour_history(history)
+
+    assert flagTimeline[flagTimeline["rule_label"] == "latest_saving_event_greater_than_six_months_average"]["time_flagged"].tolist() == [
+        sample_start_time + 10 * one_day_in_milliseconds
+    ]
+    assert len(replay_user_behaviour_history(history, { "multiplier": 20 })) == 0
+
+def test_summarise_flag_timeline():
+    flagTimeline = pd.DataFrame([
+        { "rule_label": "single_very_large_saving_event", "user_id": sample_user_id, "time_flagged": 1 },
+        { "rule_label": "single_very_large_saving_event", "user_id": sample_user_id, "time_flagged": 2 },
+        { "rule_label": "single_very_large_saving_event", "user_id": sample_other_user_id, "time_flagged": 3 },
+    ])
+
+    summary = summarise_flag_timeline(flagTimeline)
+
+    assert summary.loc["single_very_large_saving_event", "flags"] == 3
+    assert summary.loc["single_very_large_saving_event", "users_flagged"] == 2
+
+def test_find_withdrawal_saving_event_pairs_matches_live_matcher():
+    randomGenerator = random.Random(7)
+    for _ in range(50):
+        withdrawals = [
+            { "amount": randomGenerator.randint(90, 100), "time_transaction_occurred": randomGenerator.randint(0, 5 * one_day_in_milliseconds) }
+            for _ in range(randomGenerator.randint(0, 8))
+        ]
+        savingEvents = [
+            { "amount": randomGenerator.randint(95, 105), "time_transaction_occurred": randomGenerator.randint(0, 5 * one_day_in_milliseconds) }
+            for _ in range(randomGenerator.randint(0, 8))
+        ]
+        withdrawals.sort(key=lambda transaction: transaction["time_transaction_occurred"])
+        savingEvents.sort(key=lambda transaction: transaction["time_transaction_occurred"])
+
+        pairFirstTimes, _ = find_withdrawal_saving_event_pairs(
+            np.array([transaction["time_transaction_occurred"] for transaction in withdrawals], dtype=np.int64),
+            np.array([transaction["amount"] for transaction in withdrawals], dtype=np.int64),
+            np.array([transaction["time_transaction_occurred"] for transaction in savingEvents], dtype=np.int64),
+            np.array([transaction["amount"] for transaction in savingEvents], dtype=np.int64),
+            constant.DAYS_IN_A_WEEK,
+            constant.HOURS_IN_A_DAY,
+            constant.ERROR_TOLERANCE_PERCENTAGE_FOR_SAVING_EVENTS
+        )
+
+        assert len(pairFirstTimes) == check_each_withdrawal_against_saving_event_for_flagged_withdrawals(
+            withdrawals, savingEvents, constant.HOURS_IN_A_DAY
+        )
@@ -20,4 +20,87 @@ DEFAULT_LATEST_FLAG_TIME=-2208988800 # Date: '1900-01-01' and hour: '00:00:00' c
 SECOND_TO_MILLISECOND_FACTOR=1000
 HOUR_MARKING_START_OF_DAY='00:00:00'
 HOUR_MARKING_END_OF_DAY='23:59:59'
-DEFAULT_COUNT_FOR_RULE=0.0
\ No newline at end of file
+DEFAULT_COUNT_FOR_RULE=0.0
+RULE_EXECUTION_MODES={"sequential": "SEQUENTIAL", "single_scan": "SINGLE_SCAN", "rule_engine": "RULE_ENGINE", "concurrent": "CONCURRENT", "monthly_aggregates": "MONTHLY_AGGREGATES"}
+DEFAULT_PAGE_SIZE_FOR_USERS_BATCH=500
+DEFAULT_USER_BEHAVIOUR_CACHE_SIZE=1000
+DEFAULT_LATEST_WRITE_TIME_TTL_IN_SECONDS=0
+DEFAULT_RECENT_WRITES_TTL_IN_SECONDS=600
+DEFAULT_RULE_WINDOW_TTL_IN_SECONDS=60
+FRAUD_DETECTOR_TRIGGER_MODES={"sync": "SYNC", "async": "ASYNC"}
+DEFAULT_FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS=3
+DEFAULT_FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS=30
+FRAUD_DETECTOR_CONNECTION_RETRIES=3
+DEFAULT_FRAUD_DETECTOR_TRIGGER_TOPIC='fraud-detector-triggers'
+FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS=10
+MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS=300
+MAXIMUM_PAGE_SIZE_FOR_USERS_BATCH=1000
+DEFAULT_PAGE_SIZE_FOR_TRANSACTION_TIMELINE=1000
+MAXIMUM_PAGE_SIZE_FOR_TRANSACTION_TIMELINE=10000
+RULE_AGGREGATIONS={
+    "count_above_benchmark": "COUNT_ABOVE_BENCHMARK",
+    "latest_amount": "LATEST_AMOUNT",
+    "average_amount": "AVERAGE_AMOUNT",
+    "withdrawals_within_hours_of_saving_events": "WITHDRAWALS_WITHIN_HOURS_OF_SAVING_EVENTS"
+}
+# rules are declared as data, the rule engine plans the queries needed to compute them (see `plan_rule_queries`).
+# `label` is the rule label of `ruleCutOffTimes`, `fact` is the key of the rule's result in the response.
+# `window` of None means all of the user's history
+RULE_DEFINITIONS=[
+    {
+        "label": "single_very_large_saving_event",
+        "fact": "countOfSavingEventsGreaterThanHundredThousand",
+        "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+        "window": None,
+        "benchmark": FIRST_BENCHMARK_SAVING_EVENT,
+        "aggregation": RULE_AGGREGATIONS["count_above_benchmark"]
+    },
+    {
+        "label": "saving_events_greater_than_benchmark_within_six_months",
+        "fact": "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod",
+        "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+        "window": {"months": SIX_MONTHS_INTERVAL},
+        "benchmark": SECOND_BENCHMARK_SAVING_EVENT,
+        "aggregation": RULE_AGGREGATIONS["count_above_benchmark"]
+    },
+    {
+        "label": "latest_saving_event_greater_than_six_months_average",
+        "fact": "latestSavingEvent",
+        "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+        "window": None,
+        "aggregation": RULE_AGGREGATIONS["latest_amount"]
+    },
+    {
+        "label": "latest_saving_event_greater_than_six_months_average",
+        "fact": "sixMonthAverageSavingEventMultipliedByN",
+        "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+        "window": {"months": SIX_MONTHS_INTERVAL},
+        "multiplier": MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT,
+        "aggregation": RULE_AGGREGATIONS["average_amount"]
+    },
+    {
+        "label": "withdrawals_within_two_days_of_saving_events_during_one_month",
+        "fact": "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle",
+        "transactionType": WITHDRAWAL_TRANSACTION_TYPE,
+        "window": {"days": DAYS_IN_A_MONTH},
+        "numOfHours": HOURS_IN_TWO_DAYS,
+        "aggregation": RULE_AGGREGATIONS["withdrawals_within_hours_of_saving_events"]
+    },
+    {
+        "label": "withdrawals_within_one_day_of_saving_events_during_one_week",
+        "fact": "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle",
+        "transactionType": WITHDRAWAL_TRANSACTION_TYPE,
+        "window": {"days": DAYS_IN_A_WEEK},
+        "numOfHours": HOURS_IN_A_DAY,
+        "aggregation": RULE_AGGREGATIONS["withdrawals_within_hours_of_saving_events"]
+    }
+]
+# thresholds of the rules in `javascript/fraud-detector/custom-rules.js`, used to pre-screen transactions on ingest
+FLAG_CANDIDATE_THRESHOLDS={
+    "countOfSavingEventsGreaterThanHundredThousand": 0, # greater than
+    "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 3, # greater than or equal to
+    "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": 3, # greater than
+    "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": 1, # greater than
+}
+# rows written to `ops.all_user_events` in router mode, as `pubsub-to-big-query-for-sns` writes them
+ALL_USER_EVENTS_SOURCE_OF_EVENT='INTERNAL_SERVICES'
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# Drives `fetch_user_behaviour_based_on_rules` at a fixed request rate against a local stand-in for BigQuery, and reports
+# throughput and p50/p95/p99 latency of the requests and of each rule. The stand-in sleeps for the time given by a
+# latency model, which by default grows with the number of rows the query reads, and answers with synthetic rows of the
+# shape each rule query expects. The facts returned are not meaningful, only the time taken to compute them is.
+#
+# Usage: python load_test.py [--execution-mode <mode>] [--requests-per-second <n>] [--duration-in-seconds <n>] ...
+# Per rule latency is read from the diagnostics of each response, see `includeDiagnostics` in the README.
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import concurrent.futures
+
+import constant
+import main
+
+SAVING_EVENT_TRANSACTION_TYPE = constant.SAVING_EVENT_TRANSACTION_TYPE
+WITHDRAWAL_TRANSACTION_TYPE = constant.WITHDRAWAL_TRANSACTION_TYPE
+SECOND_TO_MILLISECOND_FACTOR = constant.SECOND_TO_MILLISECOND_FACTOR
+MILLISECONDS_IN_A_DAY = constant.HOURS_IN_A_DAY * constant.SECONDS_IN_AN_HOUR * SECOND_TO_MILLISECOND_FACTOR
+
+REPORTED_PERCENTILES = [50, 95, 99]
+QUERY_ALIAS_PATTERN = re.compile(r"as `(\w+)`")
+
+# the time a query takes: a fixed cost per query plus a cost per thousand rows read, with lognormal noise
+class LinearLatencyModel:
+    def __init__(self, baseSeconds=0.3, secondsPerThousandRows=0.05, jitterSigma=0.25, seed=None):
+        self.baseSeconds = baseSeconds
+        self.secondsPerThousandRows = secondsPerThousandRows
+        self.jitterSigma = jitterSigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def __call__(self, query, rowsRead):
+        with self.lock:
+            jitter = self.random.lognormvariate(0, self.jitterSigma) if self.jitterSigma > 0 else 1
+        return (self.baseSeconds + self.secondsPerThousandRows * rowsRead / 1000) * jitter
+
+class LocalQueryJob:
+    def __init__(self, rows, bytesProcessed, slotMillis):
+        self.rows = rows
+        self.job_id = "local-{}".format(id(self))
+        self.total_bytes_processed = bytesProcessed
+        self.slot_millis = slotMillis
+        self.cache_hit = False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def result(self):
+        return self.rows
+
+# answers `client.query` in place of `bigquery.Client`. Each user's transactions are synthetic, the queries are not
+# evaluated: the rows returned only have the columns (or aliases) the query selects
+class LocalBigQueryClient:
+    def __init__(self, transactionsByUserId, latencyModel):
+        self.transactionsByUserId = transactionsByUserId
+        self.latencyModel = latencyModel
+        self.queryCount = 0
+        self.lock = threading.Lock()
+
+    def query(self, query, location=None, job_config=None):
+        with self.lock:
+            self.queryCount += 1
+        queryParams = { param.name: param.value for param in getattr(job_config, "query_parameters", None) or [] }
+        transactions = self.transactionsByUserId.get(queryParams.get("userId"), [])
+        if "transactionType" in queryParams:
+            transactions = [transaction for transaction in transactions if transaction["transaction_type"] == queryParams["transactionType"]]
+
+        latencyInSeconds = self.latencyModel(query, len(transactions))
+        time.sleep(latencyInSeconds)
+
+        rows = construct_rows_for_query(query, transactions)
+        return LocalQueryJob(rows, bytesProcessed=len(transactions) * 64, slotMillis=int(latencyInSeconds * SECOND_TO_MILLISECOND_FACTOR))
+
+def construct_value_for_alias(alias, transactions):
+    if alias.startswith("withdrawalsDuring"):
+        return [transaction for transaction in transactions if transaction["transaction_type"] == WITHDRAWAL_TRANSACTION_TYPE]
+
+    if alias.startswith("savingEventsDuring"):
+        return [transaction for transaction in transactions if transaction["transaction_type"] == SAVING_EVENT_TRANSACTION_TYPE]
+
+    if alias == "transactionCount":
+        return len(transactions)
+
+    if alias.lower().startswith("count"):
+        return 0
+
+    if alias == "latestWriteTime":
+        return max([transaction["created_at"] for transaction in transactions], default=None)
+
+    return transactions[-1]["amount"] if transactions else None
+
+# aggregation queries name each column with an alias and return one row, the other queries return the transactions
+def construct_rows_for_query(query, transactions):
+    aliases = QUERY_ALIAS_PATTERN.findall(query)
+    if not aliases:
+        return transactions
+
+    return [{ alias: construct_value_for_alias(alias, transactions) for alias in aliases }]
+
+# the number of transactions of a user is lognormal around `medianUserSize`, spread over the last `historyInDays` days
+def generate_user_transactions(userCount, medianUserSize, userSizeSigma, historyInDays, seed=None):
+    randomGenerator = random.Random(seed)
+    timeNow = int(time.time() * SECOND_TO_MILLISECOND_FACTOR)
+    transactionsByUserId = {}
+
+    for userIndex in range(userCount):
+        userSize = max(1, int(round(randomGenerator.lognormvariate(math.log(medianUserSize), userSizeSigma))))
+        transactionTimes = sorted(timeNow - randomGenerator.randint(0, historyInDays * MILLISECONDS_IN_A_DAY) for _ in range(userSize))
+        transactionsByUserId["load-test-user-{}".format(userIndex)] = [
+            {
+                "transaction_type": randomGenerator.choice([SAVING_EVENT_TRANSACTION_TYPE, WITHDRAWAL_TRANSACTION_TYPE]),
+                "amount": randomGenerator.randint(100, 10000) * constant.FACTOR_TO_CONVERT_WHOLE_CURRENCY_TO_HUNDREDTH_CENT,
+                "time_transaction_occurred": transactionTime,
+                "created_at": transactionTime
+            }
+            for transactionTime in transactionTimes
+        ]
+
+    return transactionsByUserId
+
+class LoadTestRequest:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_json(self):
+        return self.payload
+
+# latency is measured from `scheduledTime` when given, so time spent waiting for a free worker is included
+def send_fetch_user_behaviour_request(userId, scheduledTime=None):
+    payload = { "userId": userId, "accountId": "{}-account".format(userId), "ruleCutOffTimes": {}, "includeDiagnostics": True }
+    startTime = scheduledTime or time.time()
+    responseBody, status = main.fetch_user_behaviour_based_on_rules(LoadTestRequest(payload))
+    latencyInMilliseconds = (time.time() - startTime) * SECOND_TO_MILLISECOND_FACTOR
+
+    if status != 200:
+        return { "latencyInMilliseconds": latencyInMilliseconds, "error": responseBody }
+
+    diagnostics = json.loads(responseBody)["diagnostics"]
+    return {
+        "latencyInMilliseconds": latencyInMilliseconds,
+        "resultCacheHit": diagnostics["resultCacheHit"],
+        "ruleLatenciesInMilliseconds": { rule: details["wallTimeInMilliseconds"] for rule, details in diagnostics["rules"].items() }
+    }
+
+# open loop: requests are started on schedule whether or not earlier ones have finished, so queueing shows in the latency
+def run_load_test(userIds, requestsPerSecond, durationInSeconds, maxConcurrentRequests, seed=None):
+    randomGenerator = random.Random(seed)
+    requestCount = int(requestsPerSecond * durationInSeconds)
+    futures = []
+
+    startTime = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrentRequests) as executor:
+        for requestIndex in range(requestCount):
+            scheduledTime = startTime + requestIndex / requestsPerSecond
+            delayInSeconds = scheduledTime - time.time()
+            if delayInSeconds > 0:
+                time.sleep(delayInSeconds)
+            futures.append(executor.submit(send_fetch_user_behaviour_request, randomGenerator.choice(userIds), scheduledTime))
+
+        results = [future.result() for future in futures]
+
+    summary = summarise_load_test_results(results, time.time() - startTime)
+    summary["queries"] = getattr(main.client, "queryCount", None)
+    return summary
+
+# nearest rank percentile
+def calculate_percentile(sortedValues, percentile):
+    if not sortedValues:
+        return None
+
+    rank = max(int(math.ceil(percentile / 100 * len(sortedValues))), 1)
+    return sortedValues[rank - 1]
+
+def summarise_latencies(latencies):
+    sortedLatencies = sorted(latencies)
+    return { "p{}".format(percentile): calculate_percentile(sortedLatencies, percentile) for percentile in REPORTED_PERCENTILES }
+
+def summarise_load_test_results(results, elapsedSeconds):
+    successfulResults = [result for result in results if "error" not in result]
+    latenciesByRule = {}
+    for result in successfulResults:
+        for rule, latencyInMilliseconds in result["ruleLatenciesInMilliseconds"].items():
+            latenciesByRule.setdefault(rule, []).append(latencyInMilliseconds)
+
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(successfulResults),
+        "resultCacheHits": sum(1 for result in successfulResults if result["resultCacheHit"]),
+        "throughputPerSecond": len(successfulResults) / elapsedSeconds if elapsedSeconds > 0 else None,
+        "latencyInMilliseconds": summarise_latencies([result["latencyInMilliseconds"] for result in successfulResults]),
+        "ruleLatencyInMilliseconds": { rule: summarise_latencies(latencies) for rule, latencies in latenciesByRule.items() }
+    }
+
+def print_load_test_summary(summary):
+    print("Requests: {requests}, errors: {errors}, result cache hits: {resultCacheHits}, BigQuery queries: {queries}".format(**summary))
+    print("Throughput: {:.1f} requests per second".format(summary["throughputPerSecond"] or 0))
+    rows = [("request", summary["latencyInMilliseconds"])] + sorted(summary["ruleLatencyInMilliseconds"].items())
+    rowFormat = "{:<" + str(max(len(name) for name, _ in rows + [("latency (ms)", None)])) + "} {:>8} {:>8} {:>8}"
+    print(rowFormat.format("latency (ms)", *["p{}".format(percentile) for percentile in REPORTED_PERCENTILES]))
+    for name, percentiles in rows:
+        print(rowFormat.format(name, *[
+            "-" if percentiles["p{}".format(percentile)] is None else int(percentiles["p{}".format(percentile)])
+            for percentile in REPORTED_PERCENTILES
+        ]))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load test fetch user behaviour based on rules against a local BigQuery stand-in")
+    parser.add_argument("--execution-mode", default=main.RULE_EXECUTION_MODE, choices=list(constant.RULE_EXECUTION_MODES.values()))
+    parser.add_argument("--requests-per-second", type=float, default=20)
+    parser.add_argument("--duration-in-seconds", type=float, default=30)
+    parser.add_argument("--max-concurrent-requests", type=int, default=50, help="e.g. the concurrency of one instance")
+    parser.add_argument("--users", type=int, default=1000, help="distinct users requests are drawn from")
+    parser.add_argument("--median-user-size", type=int, default=50, help="transactions of the median user")
+    parser.add_argument("--user-size-sigma", type=float, default=1.0, help="sigma of the lognormal user size distribution")
+    parser.add_argument("--history-in-days", type=int, default=365)
+    parser.add_argument("--base-latency-in-milliseconds", type=float, default=300)
+    parser.add_argument("--latency-per-thousand-rows-in-milliseconds", type=float, default=50)
+    parser.add_argument("--latency-jitter-sigma", type=float, default=0.25)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", help="keep the logs of the cloud function")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    transactionsByUserId = generate_user_transactions(
+        arguments.users, arguments.median_user_size, arguments.user_size_sigma, arguments.history_in_days, arguments.seed
+    )
+    main.client = LocalBigQueryClient(transactionsByUserId, LinearLatencyModel(
+        arguments.base_latency_in_milliseconds / SECOND_TO_MILLISECOND_FACTOR,
+        arguments.latency_per_thousand_rows_in_milliseconds / SECOND_TO_MILLISECOND_FACTOR,
+        arguments.latency_jitter_sigma,
+        arguments.seed
+    ))
+    main.RULE_EXECUTION_MODE = arguments.execution_mode
+
+    print("Load testing execution mode: {mode} at {rate} requests per second for {duration} seconds".format(
+        mode=arguments.execution_mode, rate=arguments.requests_per_second, duration=arguments.duration_in_seconds
+    ))
+    standardOutput = sys.stdout
+    if not arguments.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        summary = run_load_test(
+            list(transactionsByUserId.keys()), arguments.requests_per_second, arguments.duration_in_seconds, arguments.max_concurrent_requests, arguments.seed
+        )
+    finally:
+        sys.stdout = standardOutput
+
+    print_load_test_summary(summary)
@@ -0,0 +1,96 @@
+from unittest.mock import patch, Mock
+
+from google.cloud import bigquery
+
+from load_test \
+    import LocalBigQueryClient, \
+    LinearLatencyModel, \
+    generate_user_transactions, \
+    calculate_percentile, \
+    run_load_test
+
+from main import extract_params_from_fetch_user_behaviour_request
+
+import constant
+import main
+
+sample_user_id = "load-test-user-0"
+
+def construct_sample_job_config(query_params):
+    job_config = bigquery.QueryJobConfig()
+    job_config.query_parameters = query_params
+    return job_config
+
+def test_calculate_percentile_uses_nearest_rank():
+    latencies = list(range(1, 101))
+
+    assert calculate_percentile(latencies, 50) == 50
+    assert calculate_percentile(latencies, 99) == 99
+    assert calculate_percentile([7], 95) == 7
+    assert calculate_percentile([], 50) is None
+
+def test_linear_latency_model_grows_with_rows_read():
+    latencyModel = LinearLatencyModel(baseSeconds=0.1, secondsPerThousandRows=0.2, jitterSigma=0)
+
+    assert latencyModel("select 1", 0) == 0.1
+    assert abs(latencyModel("select 1", 5000) - 1.1) < 1e-9
+
+def test_local_big_query_client_answers_rows_and_aliases_of_the_user():
+    transactionsByUserId = generate_user_transactions(1, 20, 0, 30, seed=3)
+    latencyModel = Mock(return_value=0)
+    client = LocalBigQueryClient(transactionsByUserId, latencyModel)
+    savingEvents = [
+        transaction for transaction in transactionsByUserId[sample_user_id]
+        if transaction["transaction_type"] == constant.SAVING_EVENT_TRANSACTION_TYPE
+    ]
+
+    rows = list(client.query("select `amount`, `time_transaction_occurred` from `table`", job_config=construct_sample_job_config([
+        bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id),
+        bigquery.ScalarQueryParameter("transactionType", "STRING", constant.SAVING_EVENT_TRANSACTION_TYPE),
+    ])))
+    assert rows == savingEvents
+    latencyModel.assert_called_once_with("select `amount`, `time_transaction_occurred` from `table`", len(savingEvents))
+
+    aggregateRows = list(client.query(
+        "select count(*) as `countOfSavingEvents`, max(`created_at`) as `latestWriteTime` from `table`",
+        job_config=construct_sample_job_config([bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id)])
+    ))
+    assert aggregateRows == [{
+        "countOfSavingEvents": 0,
+        "latestWriteTime": transactionsByUserId[sample_user_id][-1]["created_at"]
+    }]
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+def test_run_load_test_reports_latency_per_rule():
+    transactionsByUserId = generate_user_transactions(5, 10, 0.5, 30, seed=1)
+    client = LocalBigQueryClient(transactionsByUserId, LinearLatencyModel(baseSeconds=0, secondsPerThousandRows=0, jitterSigma=0))
+
+    with patch('main.client', client), patch('main.RULE_EXECUTION_MODE', constant.RULE_EXECUTION_MODES["concurrent"]):
+        summary = run_load_test(list(transactionsByUserId.keys()), requestsPerSecond=200, durationInSeconds=0.1, maxConcurrentRequests=4, seed=1)
+
+    assert summary["requests"] == 20
+    assert summary["errors"] == 0
+    assert set(summary["latencyInMilliseconds"].keys()) == { "p50", "p95", "p99" }
+    assert set(summary["ruleLatencyInMilliseconds"].keys()) == { "latest_write_time", *main.RULE_FACT_FETCHERS.keys() }
+
+def run_repeated_requests_for_one_user(requestCount):
+    transactionsByUserId = generate_user_transactions(1, 10, 0, 30, seed=2)
+    client = LocalBigQueryClient(transactionsByUserId, LinearLatencyModel(baseSeconds=0, secondsPerThousandRows=0, jitterSigma=0))
+    main.userBehaviourCache.clear()
+    main.latestWriteTimeCache.clear()
+
+    with patch('main.client', client):
+        return run_load_test([sample_user_id], requestsPerSecond=1000, durationInSeconds=requestCount / 1000, maxConcurrentRequests=1)
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+def test_run_load_test_shows_result_cache_saves_queries_of_an_unchanged_user():
+    ruleQueryCount = len(main.RULE_FACT_FETCHERS)
+
+    with patch('main.USER_BEHAVIOUR_CACHE_SIZE', 0):
+        uncachedSummary = run_repeated_requests_for_one_user(10)
+    cachedSummary = run_repeated_requests_for_one_user(10)
+
+    # every check reads the watermark, only the first one runs the rules
+    assert uncachedSummary["queries"] == 10 * (1 + ruleQueryCount)
+    assert cachedSummary["resultCacheHits"] == 9
+    assert cachedSummary["queries"] == 10 + ruleQueryCount
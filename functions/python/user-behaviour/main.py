@@ -1,13 +1,22 @@
 import os
 import json
 import base64
+import bisect
+import cachetools
 import constant
+import all_user_events_writer
+import concurrent.futures
+import contextvars
 import datetime
 import requests
+import threading
 import time
 
 from google.cloud import bigquery
 from dotenv import load_dotenv
+from flask import Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 load_dotenv()
 
 # these credentials are used to access google cloud services. See https://cloud.google.com/docs/authentication/getting-started
@@ -43,10 +52,103 @@ SECOND_TO_MILLISECOND_FACTOR = constant.SECOND_TO_MILLISECOND_FACTOR
 HOUR_MARKING_START_OF_DAY=constant.HOUR_MARKING_START_OF_DAY
 HOUR_MARKING_END_OF_DAY=constant.HOUR_MARKING_END_OF_DAY
 DEFAULT_COUNT_FOR_RULE=constant.DEFAULT_COUNT_FOR_RULE
+RULE_EXECUTION_MODES=constant.RULE_EXECUTION_MODES
+DEFAULT_PAGE_SIZE_FOR_USERS_BATCH=constant.DEFAULT_PAGE_SIZE_FOR_USERS_BATCH
+MAXIMUM_PAGE_SIZE_FOR_USERS_BATCH=constant.MAXIMUM_PAGE_SIZE_FOR_USERS_BATCH
+DEFAULT_PAGE_SIZE_FOR_TRANSACTION_TIMELINE=constant.DEFAULT_PAGE_SIZE_FOR_TRANSACTION_TIMELINE
+MAXIMUM_PAGE_SIZE_FOR_TRANSACTION_TIMELINE=constant.MAXIMUM_PAGE_SIZE_FOR_TRANSACTION_TIMELINE
+DEFAULT_USER_BEHAVIOUR_CACHE_SIZE=constant.DEFAULT_USER_BEHAVIOUR_CACHE_SIZE
+DEFAULT_LATEST_WRITE_TIME_TTL_IN_SECONDS=constant.DEFAULT_LATEST_WRITE_TIME_TTL_IN_SECONDS
+DEFAULT_RECENT_WRITES_TTL_IN_SECONDS=constant.DEFAULT_RECENT_WRITES_TTL_IN_SECONDS
+DEFAULT_RULE_WINDOW_TTL_IN_SECONDS=constant.DEFAULT_RULE_WINDOW_TTL_IN_SECONDS
+FRAUD_DETECTOR_TRIGGER_MODES=constant.FRAUD_DETECTOR_TRIGGER_MODES
+ALL_USER_EVENTS_SOURCE_OF_EVENT=constant.ALL_USER_EVENTS_SOURCE_OF_EVENT
+DEFAULT_FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS=constant.DEFAULT_FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS
+DEFAULT_FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS=constant.DEFAULT_FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS
+FRAUD_DETECTOR_CONNECTION_RETRIES=constant.FRAUD_DETECTOR_CONNECTION_RETRIES
+DEFAULT_FRAUD_DETECTOR_TRIGGER_TOPIC=constant.DEFAULT_FRAUD_DETECTOR_TRIGGER_TOPIC
+FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS=constant.FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS
+MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS=constant.MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS
+FLAG_CANDIDATE_THRESHOLDS=constant.FLAG_CANDIDATE_THRESHOLDS
+RULE_AGGREGATIONS=constant.RULE_AGGREGATIONS
+RULE_DEFINITIONS=constant.RULE_DEFINITIONS
+
+# `SEQUENTIAL` runs one query per rule helper, `SINGLE_SCAN` computes every rule feature in one query,
+# `RULE_ENGINE` plans the queries of the rules declared in `RULE_DEFINITIONS`, `CONCURRENT` runs the rule helpers in parallel,
+# `MONTHLY_AGGREGATES` reads the saving_event rules from `user_behaviour_monthly_aggregates`
+RULE_EXECUTION_MODE = os.getenv("RULE_EXECUTION_MODE", RULE_EXECUTION_MODES["sequential"])
+
+# Results of `fetch_user_behaviour_based_on_rules` are cached per user, cut off times and latest write time of the user
+# (the watermark), which is the latest `created_at` of the user's rows, so a late arriving transaction also moves it.
+# By default the watermark is read with one small query on every check, so a cached result is never stale. Setting
+# `LATEST_WRITE_TIME_TTL_IN_SECONDS` caches it too, trading that query for writes of other instances going unseen that long.
+# Checks triggered by the fraud detector carry their `recentTransactions` and skip the cache, so they run no watermark query
+USER_BEHAVIOUR_CACHE_SIZE = int(os.getenv("USER_BEHAVIOUR_CACHE_SIZE", DEFAULT_USER_BEHAVIOUR_CACHE_SIZE))
+LATEST_WRITE_TIME_TTL_IN_SECONDS = int(os.getenv("LATEST_WRITE_TIME_TTL_IN_SECONDS", DEFAULT_LATEST_WRITE_TIME_TTL_IN_SECONDS))
+userBehaviourCacheLock = threading.Lock()
+userBehaviourCache = cachetools.LRUCache(maxsize=max(USER_BEHAVIOUR_CACHE_SIZE, 1))
+latestWriteTimeCache = cachetools.TTLCache(maxsize=max(USER_BEHAVIOUR_CACHE_SIZE, 1), ttl=LATEST_WRITE_TIME_TTL_IN_SECONDS)
+
+# Read-your-writes overlay: rows streamed with `insert_rows` can take a while to become visible to queries. Rows
+# recently written for a user are kept here and merged into every query about that user, so the check triggered by a
+# transaction always sees it. Rows inserted in this process are kept for `RECENT_WRITES_TTL_IN_SECONDS`. The
+# `recentTransactions` that the fraud detector forwards from `update-user-behaviour` come from an unauthenticated request,
+# so they are only merged into the queries of the request that carries them and are never kept
+RECENT_WRITES_TTL_IN_SECONDS = int(os.getenv("RECENT_WRITES_TTL_IN_SECONDS", DEFAULT_RECENT_WRITES_TTL_IN_SECONDS))
+USER_BEHAVIOUR_TABLE_COLUMNS = [
+    ("user_id", "STRING"),
+    ("account_id", "STRING"),
+    ("transaction_type", "STRING"),
+    ("amount", "INT64"),
+    ("unit", "STRING"),
+    ("currency", "STRING"),
+    ("time_transaction_occurred", "INT64"),
+    ("created_at", "INT64"),
+    ("updated_at", "INT64"),
+]
+recentWritesLock = threading.Lock()
+recentWritesByUserId = cachetools.TTLCache(maxsize=max(USER_BEHAVIOUR_CACHE_SIZE, 1), ttl=max(RECENT_WRITES_TTL_IN_SECONDS, 1))
+
+# When `EVALUATE_RULES_ON_INGEST` is set, `update-user-behaviour` keeps six months of each user's transactions in memory,
+# seeded by one query and refreshed after `RULE_WINDOW_TTL_IN_SECONDS`, and only triggers the fraud detector for
+# transactions that could make a rule flag the user
+EVALUATE_RULES_ON_INGEST = os.getenv("EVALUATE_RULES_ON_INGEST", "false").lower() == "true"
+RULE_WINDOW_TTL_IN_SECONDS = int(os.getenv("RULE_WINDOW_TTL_IN_SECONDS", DEFAULT_RULE_WINDOW_TTL_IN_SECONDS))
+userTransactionWindowsLock = threading.Lock()
+userTransactionWindows = cachetools.TTLCache(maxsize=max(USER_BEHAVIOUR_CACHE_SIZE, 1), ttl=max(RULE_WINDOW_TTL_IN_SECONDS, 1))
+
+# In router mode (`INGEST_ROUTER_MODE`) `update-user-behaviour` also writes each event to `ops.all_user_events`, with the
+# schema checks, row ids and retries of `pubsub-to-big-query-for-sns` (see `all_user_events_writer.py`), so that function
+# no longer needs to be triggered by `sns-events`
+INGEST_ROUTER_MODE = os.getenv("INGEST_ROUTER_MODE", "false").lower() == "true"
+all_user_events_table_id = all_user_events_writer.TABLE_ID
+all_user_events_table = client.get_table(client.dataset(dataset_id).table(all_user_events_table_id)) if INGEST_ROUTER_MODE else None
+
+# `SYNC` posts to the fraud detector for one user after the other before the pub/sub message is acknowledged. `ASYNC`
+# publishes the triggers to `FRAUD_DETECTOR_TRIGGER_TOPIC` instead, from where `post-fraud-detector-trigger` posts them,
+# so the message is acknowledged once the triggers are published, however slow the fraud detector is. Both post over
+# one keep-alive session with bounded timeouts
+FRAUD_DETECTOR_TRIGGER_MODE = os.getenv("FRAUD_DETECTOR_TRIGGER_MODE", FRAUD_DETECTOR_TRIGGER_MODES["sync"])
+FRAUD_DETECTOR_TRIGGER_TOPIC = os.getenv("FRAUD_DETECTOR_TRIGGER_TOPIC", DEFAULT_FRAUD_DETECTOR_TRIGGER_TOPIC)
+FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS = float(os.getenv("FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS", DEFAULT_FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS))
+FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS = float(os.getenv("FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS", DEFAULT_FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS))
+fraudDetectorSessionLock = threading.Lock()
+fraudDetectorSession = None
+fraudDetectorTriggerPublisher = None
 
 
 FULL_TABLE_URL="{project_id}.{dataset_id}.{table_id}".format(project_id=project_id, dataset_id=dataset_id, table_id=table_id)
 
+# diagnostics of the request being served: wall time and BigQuery job statistics per rule. Context variables are used
+# so that rules running in the thread pool of `CONCURRENT` mode report into the request that started them
+requestRuleDiagnostics = contextvars.ContextVar("requestRuleDiagnostics", default=None)
+currentRuleQueryDiagnostics = contextvars.ContextVar("currentRuleQueryDiagnostics", default=None)
+# the validated `recentTransactions` of the request being served
+requestRecentTransactions = contextvars.ContextVar("requestRecentTransactions", default=())
+
+monthly_aggregates_table_id = 'user_behaviour_monthly_aggregates'
+MONTHLY_AGGREGATES_TABLE_URL="{project_id}.{dataset_id}.{table_id}".format(project_id=project_id, dataset_id=dataset_id, table_id=monthly_aggregates_table_id)
+
 def convert_amount_from_given_unit_to_hundredth_cent(amount, unit):
     if unit == 'HUNDREDTH_CENT':
         return amount
@@ -101,20 +203,153 @@ def extract_key_value_from_first_item_of_big_query_response(responseList, key):
 def convert_big_query_response_to_list(response):
     return list(response)
 
+def calculate_elapsed_milliseconds(startTime):
+    return int(round((time.time() - startTime) * SECOND_TO_MILLISECOND_FACTOR))
+
+def record_query_diagnostics(queryJob, wallTimeInMilliseconds):
+    ruleQueryDiagnostics = currentRuleQueryDiagnostics.get()
+    if ruleQueryDiagnostics is None:
+        return
+
+    ruleQueryDiagnostics.append({
+        "jobId": queryJob.job_id,
+        "wallTimeInMilliseconds": wallTimeInMilliseconds,
+        "totalBytesProcessed": queryJob.total_bytes_processed,
+        "slotMillis": queryJob.slot_millis,
+        "cacheHit": queryJob.cache_hit
+    })
+
+# runs the fact fetcher of a rule and, when the request collects diagnostics, records its wall time and queries
+def fetch_rule_facts_with_diagnostics(ruleName, fetchFacts, *args):
+    ruleDiagnostics = requestRuleDiagnostics.get()
+    if ruleDiagnostics is None:
+        return fetchFacts(*args)
+
+    ruleQueryDiagnostics = []
+    token = currentRuleQueryDiagnostics.set(ruleQueryDiagnostics)
+    startTime = time.time()
+    try:
+        return fetchFacts(*args)
+    finally:
+        ruleDiagnostics[ruleName] = {
+            "wallTimeInMilliseconds": calculate_elapsed_milliseconds(startTime),
+            "queries": ruleQueryDiagnostics
+        }
+        currentRuleQueryDiagnostics.reset(token)
+
+def remember_recent_writes(rows):
+    if RECENT_WRITES_TTL_IN_SECONDS <= 0:
+        return
+
+    with recentWritesLock:
+        for row in rows:
+            recentRows = recentWritesByUserId.get(row["user_id"], [])
+            if row not in recentRows:
+                # re-assigning restarts the TTL of the user's rows, so they expire together
+                recentWritesByUserId[row["user_id"]] = recentRows + [row]
+
+def is_valid_value_for_column(value, columnType):
+    if value is None:
+        return True
+
+    if columnType == "INT64":
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    return isinstance(value, str)
+
+# `recentTransactions` come from the request, so only rows of the requested user and account with exactly the columns of
+# the table, each of the column's type, are merged into its queries. Other rows are dropped rather than failing the check
+def extract_valid_recent_transactions(recentTransactions, userId, accountId):
+    if not isinstance(recentTransactions, list):
+        print("Dropping recent transactions that are not a list: {}".format(recentTransactions))
+        return []
+
+    columnNames = set(column for column, _ in USER_BEHAVIOUR_TABLE_COLUMNS)
+    validRecentTransactions = []
+    for row in recentTransactions:
+        if (
+            not isinstance(row, dict)
+            or set(row.keys()) != columnNames
+            or row["user_id"] != userId
+            or row["account_id"] != accountId
+            or not all(is_valid_value_for_column(row[column], columnType) for column, columnType in USER_BEHAVIOUR_TABLE_COLUMNS)
+        ):
+            print(
+                "Dropping recent transaction that is not a row of user id: {userId} and account id: {accountId} in the user behaviour table: {row}"
+                .format(userId=userId, accountId=accountId, row=row)
+            )
+            continue
+
+        validRecentTransactions.append({ column: row[column] for column, _ in USER_BEHAVIOUR_TABLE_COLUMNS })
+
+    return validRecentTransactions
+
+def fetch_recent_writes_for_user(userId):
+    with recentWritesLock:
+        recentWrites = list(recentWritesByUserId.get(userId, []))
+
+    for row in requestRecentTransactions.get():
+        if row["user_id"] == userId and row not in recentWrites:
+            recentWrites.append(row)
+
+    return recentWrites
+
+# recent writes are merged into every query about the user, so they move the watermark even while the cached latest
+# write time read from the table has not expired yet
+def include_recent_writes_in_latest_write_time(userId, latestWriteTime):
+    recentWriteTimes = [row["created_at"] for row in fetch_recent_writes_for_user(userId) if row.get("created_at") is not None]
+    return max(recentWriteTimes + ([latestWriteTime] if latestWriteTime is not None else []), default=None)
+
+def extract_user_id_from_query_params(query_params):
+    for query_param in query_params:
+        if query_param.name == "userId":
+            return query_param.value
+
+    return None
+
+# Replaces the table in a query about one user by the table unioned with the user's recent writes. `union distinct`
+# drops a recent write once it is visible in the table, since it is then the same row
+def merge_recent_writes_into_query(query, query_params):
+    userId = extract_user_id_from_query_params(query_params)
+    recentWrites = fetch_recent_writes_for_user(userId) if userId else []
+    if not recentWrites:
+        return query, query_params
+
+    print("Merging {count} recent writes of user id: {userId} into query".format(count=len(recentWrites), userId=userId))
+    tableWithRecentWrites = (
+        "(select * from `{full_table_url}` union distinct select * from unnest(@recentlyInsertedRows))".format(full_table_url=FULL_TABLE_URL)
+    )
+    recentWritesParam = bigquery.ArrayQueryParameter(
+        "recentlyInsertedRows",
+        "STRUCT",
+        [
+            bigquery.StructQueryParameter(
+                None,
+                *[bigquery.ScalarQueryParameter(column, columnType, row[column]) for column, columnType in USER_BEHAVIOUR_TABLE_COLUMNS]
+            )
+            for row in recentWrites
+        ]
+    )
+    return query.replace("`{}`".format(FULL_TABLE_URL), tableWithRecentWrites), query_params + [recentWritesParam]
+
 def fetch_data_as_list_from_user_behaviour_table(query, query_params):
     print(
         """
         Fetching from table: {table} with query: {query} and params {query_params}
         """.format(query=query, query_params=query_params, table=table_id)
     )
+    query, query_params = merge_recent_writes_into_query(query, query_params)
     job_config = bigquery.QueryJobConfig()
     job_config.query_parameters = query_params
 
+    startTime = time.time()
     query_result = client.query(
         query,
         location=BIG_QUERY_DATASET_LOCATION,
         job_config=job_config,
     )
+    queryResultList = convert_big_query_response_to_list(query_result)
+    record_query_diagnostics(query_result, calculate_elapsed_milliseconds(startTime))
 
     print(
         """
@@ -122,7 +357,7 @@ def fetch_data_as_list_from_user_behaviour_table(query, query_params):
         """.format(query=query, query_params=query_params, table=table_id)
     )
 
-    return convert_big_query_response_to_list(query_result)
+    return queryResultList
 
 def extract_last_flag_time_or_default_time(ruleLabel, ruleCutOffTimes):
     return int(ruleCutOffTimes[ruleLabel] if (ruleLabel in ruleCutOffTimes.keys()) else DEFAULT_LATEST_FLAG_TIME)
@@ -350,34 +585,121 @@ def time_difference_less_than_or_equal_given_hours(timeDifference, numOfHours):
     )
     return timeDifference <= numOfHours
 
+# Counts the (withdrawal, saving_event) pairs where the withdrawal is within the tolerance range of the saving_event amount
+# and happened at most `numOfHours` after it. Rather than comparing every withdrawal against every saving_event,
+# withdrawals are visited from latest to earliest while a window of saving_events that are close enough in time grows
+# from the latest saving_event backwards. The saving_events are ranked by amount once, so the matching saving_events of a
+# withdrawal are a contiguous range of ranks found by binary search, and the window is a binary indexed tree counting
+# the saving_events of each rank it holds: O((W + S) log S) instead of O(W x S)
 def check_each_withdrawal_against_saving_event_for_flagged_withdrawals(withdrawals, saving_events, numOfHours):
     print('Checking each withdrawal against saving_events in search of flagged withdrawals')
     count_of_flagged_withdrawals = 0
 
-    # loop over {withdrawal amounts / time} and compare with each {saving_event amounts / time}
-    for mapOfWithdrawalAmountAndTimeTransactionOccurred in withdrawals:
+    savingEventsByTime = sorted(saving_events, key=lambda savingEvent: savingEvent["time_transaction_occurred"])
+    withdrawalsByLatestTime = sorted(withdrawals, key=lambda withdrawal: withdrawal["time_transaction_occurred"], reverse=True)
+
+    # both lists are sorted and aligned: amount * tolerance is non-decreasing in amount
+    savingEventIndicesByAmount = sorted(range(len(savingEventsByTime)), key=lambda index: savingEventsByTime[index]["amount"])
+    savingEventAmounts = [savingEventsByTime[index]["amount"] for index in savingEventIndicesByAmount]
+    minimumMatchingWithdrawals = [amount * ERROR_TOLERANCE_PERCENTAGE_FOR_SAVING_EVENTS for amount in savingEventAmounts]
+    amountRankBySavingEventIndex = { index: rank for rank, index in enumerate(savingEventIndicesByAmount) }
+
+    savingEventsInWindowByRank = [0] * (len(savingEventAmounts) + 1)
+    def add_saving_event_to_window(rank):
+        rank += 1
+        while rank < len(savingEventsInWindowByRank):
+            savingEventsInWindowByRank[rank] += 1
+            rank += rank & -rank
+
+    def count_saving_events_in_window_below_rank(rank):
+        count = 0
+        while rank > 0:
+            count += savingEventsInWindowByRank[rank]
+            rank -= rank & -rank
+        return count
+
+    earliestSavingEventIndexInWindow = len(savingEventsByTime)
+
+    for mapOfWithdrawalAmountAndTimeTransactionOccurred in withdrawalsByLatestTime:
         withdrawalAmount = mapOfWithdrawalAmountAndTimeTransactionOccurred["amount"]
         timeOfWithdrawal = mapOfWithdrawalAmountAndTimeTransactionOccurred["time_transaction_occurred"]
 
-        for mapOfSavingEventAmountAndTimeTransactionOccurred in saving_events:
-            savingEventAmount = mapOfSavingEventAmountAndTimeTransactionOccurred["amount"]
+        while earliestSavingEventIndexInWindow > 0 and convert_milliseconds_to_hours(
+            timeOfWithdrawal - savingEventsByTime[earliestSavingEventIndexInWindow - 1]["time_transaction_occurred"]
+        ) <= numOfHours:
+            earliestSavingEventIndexInWindow -= 1
+            add_saving_event_to_window(amountRankBySavingEventIndex[earliestSavingEventIndexInWindow])
+
+        # matching saving_events satisfy: saving_event amount * tolerance <= withdrawal amount <= saving_event amount
+        firstSavingEventNotLessThanWithdrawal = bisect.bisect_left(savingEventAmounts, withdrawalAmount)
+        firstSavingEventWithMinimumAboveWithdrawal = bisect.bisect_right(minimumMatchingWithdrawals, withdrawalAmount)
+        matchingSavingEvents = max(0,
+            count_saving_events_in_window_below_rank(firstSavingEventWithMinimumAboveWithdrawal)
+            - count_saving_events_in_window_below_rank(firstSavingEventNotLessThanWithdrawal)
+        )
+
+        if matchingSavingEvents > 0:
             print(
-                "Comparing withdrawal: {withdrawalAmount} against saving_event: {savingEventAmount}"
-                .format(withdrawalAmount=withdrawalAmount, savingEventAmount=savingEventAmount)
+                "Withdrawal {withdrawalAmount} has been flagged against {count} saving_events. Increase counter by {count}"
+                    .format(withdrawalAmount=withdrawalAmount, count=matchingSavingEvents)
             )
-            if withdrawal_within_tolerance_range_of_saving_event_amount(withdrawalAmount, savingEventAmount):
-                print("Withdrawal: {} is within tolerance range of saving_event".format(withdrawalAmount))
-                timeOfSavingEvent = mapOfSavingEventAmountAndTimeTransactionOccurred["time_transaction_occurred"]
-                timeBetweenSavingEventAndWithdrawal = calculate_time_difference_in_hours_between_timestamps(timeOfWithdrawal, timeOfSavingEvent)
+            count_of_flagged_withdrawals += matchingSavingEvents
 
-                if time_difference_less_than_or_equal_given_hours(timeBetweenSavingEventAndWithdrawal, numOfHours):
-                    print("Withdrawal {} has been flagged. Increase counter by 1".format(withdrawalAmount))
-                    count_of_flagged_withdrawals += 1
+    return count_of_flagged_withdrawals
 
+def calculate_given_time_for_days_cycle(numOfDays):
+    return convert_date_string_to_millisecond_int(calculate_date_n_days_ago(numOfDays), HOUR_MARKING_START_OF_DAY)
 
-    return count_of_flagged_withdrawals
+# Window planner: the withdrawal/saving_event rules look at overlapping days cycles of the same rows. Both transaction
+# types are fetched once for the widest window (earliest given date, earliest flag time) and each rule's window is
+# then sliced out of them in memory by `slice_transactions_for_days_cycle`
+def fetch_withdrawals_and_saving_events_for_widest_days_cycle(userId, configs):
+    widestNumOfDays = max(config["numOfDays"] for config in configs)
+    earliestFlagTime = min(config["latestFlagTime"] for config in configs)
+    givenDateInMilliseconds = calculate_given_time_for_days_cycle(widestNumOfDays)
 
-def calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(userId, config):
+    print(
+        """
+        Fetching the withdrawals and saving_events during the widest cycle of '{numOfDays}' days of user id '{userId}'.
+        Given date to consider: '{leastDate}'. Considering transactions after earliest flag time of rules: {latest_flag_time}
+        """
+            .format(userId=userId, numOfDays=widestNumOfDays, leastDate=givenDateInMilliseconds, latest_flag_time=earliestFlagTime)
+    )
+
+    query = (
+        """
+        select `amount`, `time_transaction_occurred`, `transaction_type`
+        from `{full_table_url}`
+        where `transaction_type` in (@withdrawalTransactionType, @savingEventTransactionType)
+        and `user_id` = @userId
+        and `time_transaction_occurred` >= @givenTime
+        and `time_transaction_occurred` > @latestFlagTime
+        """.format(full_table_url=FULL_TABLE_URL)
+    )
+
+    query_params = [
+        bigquery.ScalarQueryParameter("withdrawalTransactionType", "STRING", WITHDRAWAL_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("savingEventTransactionType", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("userId", "STRING", userId),
+        bigquery.ScalarQueryParameter("givenTime", "INT64", givenDateInMilliseconds),
+        bigquery.ScalarQueryParameter("latestFlagTime", "INT64", earliestFlagTime),
+    ]
+
+    return fetch_data_as_list_from_user_behaviour_table(query, query_params)
+
+def slice_transactions_for_days_cycle(transactions, config, transactionType):
+    givenDateInMilliseconds = calculate_given_time_for_days_cycle(config["numOfDays"])
+    mostRecentFlagTimeForRule = config["latestFlagTime"]
+
+    return [
+        transaction for transaction in transactions
+        if transaction["transaction_type"] == transactionType
+        and transaction["time_transaction_occurred"] >= givenDateInMilliseconds
+        and transaction["time_transaction_occurred"] > mostRecentFlagTimeForRule
+    ]
+
+# `transactionsForWidestWindow` are the rows fetched by the window planner, when given no query is run for the rule
+def calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(userId, config, transactionsForWidestWindow=None):
     numOfHours = config["numOfHours"]
     numOfDays = config["numOfDays"]
     mostRecentFlagTimeForRule = config["latestFlagTime"]
@@ -390,8 +712,12 @@ def calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cyc
         """
         .format(numOfHours=numOfHours, numOfDays=numOfDays, userId=userId, latest_flag_time=mostRecentFlagTimeForRule)
     )
-    withdrawalsDuringDaysList = fetch_withdrawals_during_days_cycle(userId, config)
-    savingEventsDuringDaysList = fetch_saving_events_during_days_cycle(userId, config)
+    if transactionsForWidestWindow is None:
+        withdrawalsDuringDaysList = fetch_withdrawals_during_days_cycle(userId, config)
+        savingEventsDuringDaysList = fetch_saving_events_during_days_cycle(userId, config)
+    else:
+        withdrawalsDuringDaysList = slice_transactions_for_days_cycle(transactionsForWidestWindow, config, WITHDRAWAL_TRANSACTION_TYPE)
+        savingEventsDuringDaysList = slice_transactions_for_days_cycle(transactionsForWidestWindow, config, SAVING_EVENT_TRANSACTION_TYPE)
 
     count_of_flagged_withdrawals = check_each_withdrawal_against_saving_event_for_flagged_withdrawals(withdrawalsDuringDaysList, savingEventsDuringDaysList, numOfHours)
 
@@ -406,6 +732,553 @@ def calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cyc
 
     return count_of_flagged_withdrawals
 
+def convert_datetime_to_millisecond_int(dateObject):
+    return (dateObject - datetime.datetime.utcfromtimestamp(0)) // datetime.timedelta(milliseconds=1)
+
+def calculate_month_start_in_milliseconds(timeInMilliseconds):
+    dateObject = datetime.datetime.utcfromtimestamp(timeInMilliseconds // SECOND_TO_MILLISECOND_FACTOR)
+    return convert_datetime_to_millisecond_int(datetime.datetime(dateObject.year, dateObject.month, 1))
+
+def calculate_first_month_start_on_or_after(timeInMilliseconds):
+    monthStart = calculate_month_start_in_milliseconds(timeInMilliseconds)
+    if monthStart >= timeInMilliseconds:
+        return monthStart
+
+    dateObject = datetime.datetime.utcfromtimestamp(monthStart // SECOND_TO_MILLISECOND_FACTOR)
+    nextMonth = datetime.datetime(dateObject.year + dateObject.month // constant.MONTHS_IN_A_YEAR, dateObject.month % constant.MONTHS_IN_A_YEAR + 1, 1)
+    return convert_datetime_to_millisecond_int(nextMonth)
+
+# Whole months on or after `lowerBound` are read from `user_behaviour_monthly_aggregates`, the partial month before the
+# first whole month is read from `user_behaviour`, so the rule reads at most one month of raw rows however long the
+# user's history is. Rows written after a month was last recomputed (`computed_through`), or in a month without
+# aggregates yet, are read raw too, so the result does not wait for `refresh_monthly_aggregates`. `lowerBound` is
+# inclusive, i.e. one millisecond after the rule's cut off time
+def fetch_saving_event_aggregates_since(userId, lowerBound):
+    firstWholeMonthStart = calculate_first_month_start_on_or_after(lowerBound)
+
+    print(
+        """
+        Fetching the aggregates of saving_events of user id '{userId}' from monthly aggregates since: {lowerBound}.
+        Reading raw transactions before first whole month: {firstWholeMonthStart}
+        """
+            .format(userId=userId, lowerBound=lowerBound, firstWholeMonthStart=firstWholeMonthStart)
+    )
+
+    query = (
+        """
+        select coalesce(sum(`transaction_count`), 0) as `transactionCount`,
+        coalesce(sum(`amount_sum`), 0) as `amountSum`,
+        coalesce(sum(`count_above_first_benchmark`), 0) as `countAboveFirstBenchmark`,
+        coalesce(sum(`count_above_second_benchmark`), 0) as `countAboveSecondBenchmark`,
+        array_agg(`latest_transaction_amount` ignore nulls order by `latest_transaction_time` desc limit 1)[safe_offset(0)] as `latestTransactionAmount`
+        from (
+            select `transaction_count`, `amount_sum`, `count_above_first_benchmark`, `count_above_second_benchmark`,
+            `latest_transaction_amount`, `latest_transaction_time`
+            from `{monthly_aggregates_table_url}`
+            where `user_id` = @userId
+            and `transaction_type` = @transactionType
+            and `month_start` >= @firstWholeMonthStart
+            union all
+            select 1, `transactions`.`amount`, if(`transactions`.`amount` > @firstBenchmark, 1, 0),
+            if(`transactions`.`amount` > @secondBenchmark, 1, 0), `transactions`.`amount`, `transactions`.`time_transaction_occurred`
+            from `{full_table_url}` as `transactions`
+            left join `{monthly_aggregates_table_url}` as `aggregates`
+            on `aggregates`.`user_id` = `transactions`.`user_id`
+            and `aggregates`.`transaction_type` = `transactions`.`transaction_type`
+            and `aggregates`.`month_start` = unix_millis(timestamp_trunc(timestamp_millis(`transactions`.`time_transaction_occurred`), month))
+            where `transactions`.`user_id` = @userId
+            and `transactions`.`transaction_type` = @transactionType
+            and `transactions`.`time_transaction_occurred` >= @lowerBound
+            and (
+                `transactions`.`time_transaction_occurred` < @firstWholeMonthStart
+                or `aggregates`.`computed_through` is null
+                or `transactions`.`created_at` > `aggregates`.`computed_through`
+            )
+        )
+        """.format(monthly_aggregates_table_url=MONTHLY_AGGREGATES_TABLE_URL, full_table_url=FULL_TABLE_URL)
+    )
+
+    query_params = [
+        bigquery.ScalarQueryParameter("transactionType", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("userId", "STRING", userId),
+        bigquery.ScalarQueryParameter("lowerBound", "INT64", lowerBound),
+        bigquery.ScalarQueryParameter("firstWholeMonthStart", "INT64", firstWholeMonthStart),
+        bigquery.ScalarQueryParameter("firstBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+        bigquery.ScalarQueryParameter("secondBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(SECOND_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+    ]
+
+    return fetch_data_as_list_from_user_behaviour_table(query, query_params)[0]
+
+RULE_CUT_OFF_TIME_KEYS = {
+    "singleVeryLargeSavingEventFlagTime": "single_very_large_saving_event",
+    "savingEventsGreaterThanBenchmarkFlagTime": "saving_events_greater_than_benchmark_within_six_months",
+    "latestSavingEventFlagTime": "latest_saving_event_greater_than_six_months_average",
+    "monthCycleFlagTime": "withdrawals_within_two_days_of_saving_events_during_one_month",
+    "weekCycleFlagTime": "withdrawals_within_one_day_of_saving_events_during_one_week",
+}
+
+# the cut off time of each rule is substituted in as either a query parameter (single user) or a column of the
+# joined cut off times (many users), so both plans share the same conditional aggregations
+def construct_rule_features_select_list(cutOffTimeReferences):
+    return (
+        """
+        countif(`transaction_type` = @savingEventTransactionType and `amount` > @hundredThousandBenchmark
+            and `time_transaction_occurred` > {singleVeryLargeSavingEventFlagTime}) as `countOfSavingEventsGreaterThanHundredThousand`,
+        countif(`transaction_type` = @savingEventTransactionType and `amount` > @fiftyThousandBenchmark
+            and `time_transaction_occurred` >= @sixMonthsGivenTime
+            and `time_transaction_occurred` > {savingEventsGreaterThanBenchmarkFlagTime}) as `countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod`,
+        array_agg(
+            if(`transaction_type` = @savingEventTransactionType and `time_transaction_occurred` > {latestSavingEventFlagTime}, `amount`, null)
+            ignore nulls order by `time_transaction_occurred` desc limit 1
+        )[safe_offset(0)] as `latestSavingEvent`,
+        avg(
+            if(`transaction_type` = @savingEventTransactionType and `time_transaction_occurred` >= @sixMonthsGivenTime
+                and `time_transaction_occurred` > {latestSavingEventFlagTime}, `amount`, null)
+        ) as `averageSavingEventDuringPastPeriodInMonths`,
+        array_agg(
+            if(`transaction_type` = @withdrawalTransactionType and `time_transaction_occurred` >= @monthCycleGivenTime
+                and `time_transaction_occurred` > {monthCycleFlagTime}, struct(`amount`, `time_transaction_occurred`), null)
+            ignore nulls
+        ) as `withdrawalsDuringMonthCycle`,
+        array_agg(
+            if(`transaction_type` = @savingEventTransactionType and `time_transaction_occurred` >= @monthCycleGivenTime
+                and `time_transaction_occurred` > {monthCycleFlagTime}, struct(`amount`, `time_transaction_occurred`), null)
+            ignore nulls
+        ) as `savingEventsDuringMonthCycle`,
+        array_agg(
+            if(`transaction_type` = @withdrawalTransactionType and `time_transaction_occurred` >= @weekCycleGivenTime
+                and `time_transaction_occurred` > {weekCycleFlagTime}, struct(`amount`, `time_transaction_occurred`), null)
+            ignore nulls
+        ) as `withdrawalsDuringWeekCycle`,
+        array_agg(
+            if(`transaction_type` = @savingEventTransactionType and `time_transaction_occurred` >= @weekCycleGivenTime
+                and `time_transaction_occurred` > {weekCycleFlagTime}, struct(`amount`, `time_transaction_occurred`), null)
+            ignore nulls
+        ) as `savingEventsDuringWeekCycle`
+        """.format(**cutOffTimeReferences)
+    )
+
+def construct_single_scan_rule_features_query():
+    cutOffTimeReferences = { key: "@{}".format(key) for key in RULE_CUT_OFF_TIME_KEYS }
+    return (
+        """
+        select {select_list}
+        from `{full_table_url}`
+        where `user_id` = @userId
+        """.format(select_list=construct_rule_features_select_list(cutOffTimeReferences), full_table_url=FULL_TABLE_URL)
+    )
+
+def construct_rule_features_shared_query_params():
+    sixMonthsGivenTime = convert_date_string_to_millisecond_int(calculate_date_n_months_ago(SIX_MONTHS_INTERVAL), HOUR_MARKING_START_OF_DAY)
+    monthCycleGivenTime = convert_date_string_to_millisecond_int(calculate_date_n_days_ago(DAYS_IN_A_MONTH), HOUR_MARKING_START_OF_DAY)
+    weekCycleGivenTime = convert_date_string_to_millisecond_int(calculate_date_n_days_ago(DAYS_IN_A_WEEK), HOUR_MARKING_START_OF_DAY)
+
+    return [
+        bigquery.ScalarQueryParameter("savingEventTransactionType", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("withdrawalTransactionType", "STRING", WITHDRAWAL_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("hundredThousandBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+        bigquery.ScalarQueryParameter("fiftyThousandBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(SECOND_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+        bigquery.ScalarQueryParameter("sixMonthsGivenTime", "INT64", sixMonthsGivenTime),
+        bigquery.ScalarQueryParameter("monthCycleGivenTime", "INT64", monthCycleGivenTime),
+        bigquery.ScalarQueryParameter("weekCycleGivenTime", "INT64", weekCycleGivenTime),
+    ]
+
+def construct_single_scan_rule_features_query_params(userId, ruleCutOffTimes):
+    cutOffTimeParams = [
+        bigquery.ScalarQueryParameter(key, "INT64", extract_last_flag_time_or_default_time(ruleLabel, ruleCutOffTimes))
+        for key, ruleLabel in RULE_CUT_OFF_TIME_KEYS.items()
+    ]
+    return [bigquery.ScalarQueryParameter("userId", "STRING", userId)] + construct_rule_features_shared_query_params() + cutOffTimeParams
+
+def convert_single_scan_rule_features_to_user_behaviour(ruleFeatures):
+    return {
+        "countOfSavingEventsGreaterThanHundredThousand": ruleFeatures["countOfSavingEventsGreaterThanHundredThousand"],
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": ruleFeatures["countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod"],
+        "latestSavingEvent": convert_amount_from_hundredth_cent_to_whole_currency(ruleFeatures["latestSavingEvent"]),
+        "sixMonthAverageSavingEventMultipliedByN": convert_amount_from_hundredth_cent_to_whole_currency(
+            ruleFeatures["averageSavingEventDuringPastPeriodInMonths"]
+        ) * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT,
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": check_each_withdrawal_against_saving_event_for_flagged_withdrawals(
+            ruleFeatures["withdrawalsDuringMonthCycle"] or [],
+            ruleFeatures["savingEventsDuringMonthCycle"] or [],
+            HOURS_IN_TWO_DAYS
+        ),
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": check_each_withdrawal_against_saving_event_for_flagged_withdrawals(
+            ruleFeatures["withdrawalsDuringWeekCycle"] or [],
+            ruleFeatures["savingEventsDuringWeekCycle"] or [],
+            HOURS_IN_A_DAY
+        )
+    }
+
+# computes the features of every rule in one query (conditional aggregation), each rule keeps its own `latestFlagTime` cut off
+def fetch_user_behaviour_in_single_scan(userId, ruleCutOffTimes):
+    print("Fetching user behaviour for user id: {userId} in a single scan of table: {table}".format(userId=userId, table=table_id))
+
+    query = construct_single_scan_rule_features_query()
+    query_params = construct_single_scan_rule_features_query_params(userId, ruleCutOffTimes)
+
+    bigQueryResponse = fetch_data_as_list_from_user_behaviour_table(query, query_params)
+    return convert_single_scan_rule_features_to_user_behaviour(bigQueryResponse[0])
+
+def construct_rule_features_query_for_users():
+    cutOffTimeReferences = { key: "`cut_off_times`.`{}`".format(key) for key in RULE_CUT_OFF_TIME_KEYS }
+    return (
+        """
+        select `user_behaviour`.`user_id` as `userId`, {select_list}
+        from `{full_table_url}` as `user_behaviour`
+        join unnest(@userRuleCutOffTimes) as `cut_off_times`
+        on `user_behaviour`.`user_id` = `cut_off_times`.`userId`
+        group by `user_behaviour`.`user_id`
+        """.format(select_list=construct_rule_features_select_list(cutOffTimeReferences), full_table_url=FULL_TABLE_URL)
+    )
+
+def construct_rule_features_query_params_for_users(users):
+    userRuleCutOffTimes = [
+        bigquery.StructQueryParameter(
+            None,
+            bigquery.ScalarQueryParameter("userId", "STRING", user["userId"]),
+            *[
+                bigquery.ScalarQueryParameter(key, "INT64", extract_last_flag_time_or_default_time(ruleLabel, user["ruleCutOffTimes"]))
+                for key, ruleLabel in RULE_CUT_OFF_TIME_KEYS.items()
+            ]
+        )
+        for user in users
+    ]
+    return [bigquery.ArrayQueryParameter("userRuleCutOffTimes", "STRUCT", userRuleCutOffTimes)] + construct_rule_features_shared_query_params()
+
+# users without any rows in the table are not returned by the `group by`, their features are the rule defaults
+def construct_empty_rule_features():
+    return {
+        "countOfSavingEventsGreaterThanHundredThousand": 0,
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 0,
+        "latestSavingEvent": None,
+        "averageSavingEventDuringPastPeriodInMonths": None,
+        "withdrawalsDuringMonthCycle": [],
+        "savingEventsDuringMonthCycle": [],
+        "withdrawalsDuringWeekCycle": [],
+        "savingEventsDuringWeekCycle": []
+    }
+
+def fetch_user_behaviour_for_page_of_users(users):
+    print("Fetching user behaviour for {count} users in one scan of table: {table}".format(count=len(users), table=table_id))
+
+    query = construct_rule_features_query_for_users()
+    query_params = construct_rule_features_query_params_for_users(users)
+
+    bigQueryResponse = fetch_data_as_list_from_user_behaviour_table(query, query_params)
+    ruleFeaturesByUserId = { row["userId"]: row for row in bigQueryResponse }
+
+    return [
+        {
+            "userAccountInfo": {
+                "userId": user["userId"],
+                "accountId": user["accountId"]
+            },
+            **convert_single_scan_rule_features_to_user_behaviour(
+                ruleFeaturesByUserId.get(user["userId"], construct_empty_rule_features())
+            )
+        }
+        for user in users
+    ]
+
+# Single saving_event larger than R100 000, use cut off time if it exists, else twenty years ago means prior to system birth
+def fetch_single_very_large_saving_event_facts(userId, ruleCutOffTimes):
+    countOfSavingEventsGreaterThanHundredThousand = fetch_count_of_user_transactions_larger_than_benchmark(
+        userId,
+        {
+            "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+            "hundredThousandBenchmark": FIRST_BENCHMARK_SAVING_EVENT,
+            "latestFlagTime": extract_last_flag_time_or_default_time("single_very_large_saving_event", ruleCutOffTimes)
+        }
+    )
+    return { "countOfSavingEventsGreaterThanHundredThousand": countOfSavingEventsGreaterThanHundredThousand }
+
+# More than 3 saving_events larger than R50 000 within a 6 month period
+def fetch_saving_events_greater_than_benchmark_within_six_months_facts(userId, ruleCutOffTimes):
+    countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod = fetch_count_of_user_transactions_larger_than_benchmark_within_months_period(
+        userId,
+        {
+            "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+            "fiftyThousandBenchmark": SECOND_BENCHMARK_SAVING_EVENT,
+            "sixMonthsPeriod": SIX_MONTHS_INTERVAL,
+            "latestFlagTime": extract_last_flag_time_or_default_time("saving_events_greater_than_benchmark_within_six_months", ruleCutOffTimes)
+        }
+    )
+    return { "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod }
+
+# If latest inward saving_event > 10x past 6 month average saving_event
+def fetch_latest_saving_event_facts(userId, ruleCutOffTimes):
+    latestSavingEvent = fetch_user_latest_transaction(
+        userId,
+        {
+            "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+            "latestFlagTime": extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes)
+        }
+    )
+    return { "latestSavingEvent": latestSavingEvent }
+
+def fetch_six_months_average_saving_event_facts(userId, ruleCutOffTimes):
+    sixMonthAverageSavingEvent = fetch_user_average_transaction_within_months_period(
+        userId,
+        {
+            "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
+            "sixMonthsPeriod": SIX_MONTHS_INTERVAL,
+            "latestFlagTime": extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes)
+        }
+    )
+    return { "sixMonthAverageSavingEventMultipliedByN": sixMonthAverageSavingEvent * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT }
+
+def fetch_withdrawals_within_hours_of_saving_events_facts(userId, ruleCutOffTimes):
+    monthCycleConfig = {
+        "numOfHours": HOURS_IN_TWO_DAYS,
+        "numOfDays": DAYS_IN_A_MONTH,
+        "latestFlagTime": extract_last_flag_time_or_default_time("withdrawals_within_two_days_of_saving_events_during_one_month", ruleCutOffTimes)
+    }
+    weekCycleConfig = {
+        "numOfHours": HOURS_IN_A_DAY,
+        "numOfDays": DAYS_IN_A_WEEK,
+        "latestFlagTime": extract_last_flag_time_or_default_time("withdrawals_within_one_day_of_saving_events_during_one_week", ruleCutOffTimes)
+    }
+    transactionsForWidestWindow = fetch_withdrawals_and_saving_events_for_widest_days_cycle(userId, [monthCycleConfig, weekCycleConfig])
+
+    countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle = calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
+        userId,
+        monthCycleConfig,
+        transactionsForWidestWindow
+    )
+    countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle = calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
+        userId,
+        weekCycleConfig,
+        transactionsForWidestWindow
+    )
+    return {
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle,
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle
+    }
+
+# each fetcher runs its own queries independently of the others and returns the facts of its rule(s)
+RULE_FACT_FETCHERS = {
+    "single_very_large_saving_event": fetch_single_very_large_saving_event_facts,
+    "saving_events_greater_than_benchmark_within_six_months": fetch_saving_events_greater_than_benchmark_within_six_months_facts,
+    "latest_saving_event": fetch_latest_saving_event_facts,
+    "six_months_average_saving_event": fetch_six_months_average_saving_event_facts,
+    "withdrawals_within_hours_of_saving_events": fetch_withdrawals_within_hours_of_saving_events_facts,
+}
+
+def fetch_user_behaviour_rule_by_rule(userId, ruleCutOffTimes):
+    userBehaviour = {}
+    for ruleName, fetchFacts in RULE_FACT_FETCHERS.items():
+        userBehaviour.update(fetch_rule_facts_with_diagnostics(ruleName, fetchFacts, userId, ruleCutOffTimes))
+
+    return userBehaviour
+
+# The rule fetchers are independent, so their queries are submitted at once from a thread pool and the wall-clock time
+# of a check is close to that of the slowest query. A rule that fails does not fail the others: its facts are left out
+# and its error is reported under `ruleErrors`
+def fetch_user_behaviour_concurrently(userId, ruleCutOffTimes):
+    print("Fetching user behaviour for user id: {userId} with {count} concurrent rule fetchers".format(userId=userId, count=len(RULE_FACT_FETCHERS)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(RULE_FACT_FETCHERS)) as executor:
+        futuresByRule = {
+            ruleName: executor.submit(
+                contextvars.copy_context().run, fetch_rule_facts_with_diagnostics, ruleName, fetchFacts, userId, ruleCutOffTimes
+            )
+            for ruleName, fetchFacts in RULE_FACT_FETCHERS.items()
+        }
+
+    userBehaviour = {}
+    ruleErrors = {}
+    for ruleName, future in futuresByRule.items():
+        try:
+            userBehaviour.update(future.result())
+        except Exception as e:
+            print("Error fetching facts for rule: {rule}. Error: {error}".format(rule=ruleName, error=e))
+            ruleErrors[ruleName] = str(e)
+
+    if ruleErrors:
+        userBehaviour["ruleErrors"] = ruleErrors
+
+    return userBehaviour
+
+# The saving_event rules are answered from the monthly aggregates, one query per distinct lower bound. The
+# withdrawal/saving_event rules look at days, not months, and still use the window planner on `user_behaviour`
+def fetch_user_behaviour_from_monthly_aggregates(userId, ruleCutOffTimes):
+    sixMonthsGivenTime = convert_date_string_to_millisecond_int(calculate_date_n_months_ago(SIX_MONTHS_INTERVAL), HOUR_MARKING_START_OF_DAY)
+    lowerBounds = {
+        "singleVeryLargeSavingEvent": extract_last_flag_time_or_default_time("single_very_large_saving_event", ruleCutOffTimes) + 1,
+        "savingEventsGreaterThanBenchmark": max(
+            sixMonthsGivenTime,
+            extract_last_flag_time_or_default_time("saving_events_greater_than_benchmark_within_six_months", ruleCutOffTimes) + 1
+        ),
+        "latestSavingEvent": extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes) + 1,
+        "sixMonthAverageSavingEvent": max(
+            sixMonthsGivenTime,
+            extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes) + 1
+        ),
+    }
+
+    aggregatesByLowerBound = {}
+    for lowerBound in lowerBounds.values():
+        if lowerBound not in aggregatesByLowerBound:
+            aggregatesByLowerBound[lowerBound] = fetch_saving_event_aggregates_since(userId, lowerBound)
+
+    sixMonthAggregates = aggregatesByLowerBound[lowerBounds["sixMonthAverageSavingEvent"]]
+    sixMonthAverageSavingEvent = convert_amount_from_hundredth_cent_to_whole_currency(
+        sixMonthAggregates["amountSum"] / sixMonthAggregates["transactionCount"] if sixMonthAggregates["transactionCount"] else None
+    )
+
+    return {
+        "countOfSavingEventsGreaterThanHundredThousand": aggregatesByLowerBound[lowerBounds["singleVeryLargeSavingEvent"]]["countAboveFirstBenchmark"],
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": aggregatesByLowerBound[lowerBounds["savingEventsGreaterThanBenchmark"]]["countAboveSecondBenchmark"],
+        "latestSavingEvent": convert_amount_from_hundredth_cent_to_whole_currency(
+            aggregatesByLowerBound[lowerBounds["latestSavingEvent"]]["latestTransactionAmount"]
+        ),
+        "sixMonthAverageSavingEventMultipliedByN": sixMonthAverageSavingEvent * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT,
+        **fetch_withdrawals_within_hours_of_saving_events_facts(userId, ruleCutOffTimes)
+    }
+
+def assemble_config_for_rule(ruleDefinition, ruleCutOffTimes):
+    return {
+        **ruleDefinition,
+        "latestFlagTime": extract_last_flag_time_or_default_time(ruleDefinition["label"], ruleCutOffTimes)
+    }
+
+def calculate_given_time_for_window(window):
+    if "months" in window:
+        return convert_date_string_to_millisecond_int(calculate_date_n_months_ago(window["months"]), HOUR_MARKING_START_OF_DAY)
+
+    return calculate_given_time_for_days_cycle(window["days"])
+
+def construct_window_key(window):
+    return tuple(sorted(window.items())) if window else None
+
+# Groups rules into the fewest queries: rules aggregating over the same window share one query of conditional
+# aggregations, and all withdrawal/saving_event rules share one fetch of the rows of their widest window
+def plan_rule_queries(ruleConfigs):
+    aggregatePlansByWindow = {}
+    transactionsPlan = None
+
+    for ruleConfig in ruleConfigs:
+        if ruleConfig["aggregation"] == RULE_AGGREGATIONS["withdrawals_within_hours_of_saving_events"]:
+            transactionsPlan = transactionsPlan or { "kind": "transactions", "rules": [] }
+            transactionsPlan["rules"].append(ruleConfig)
+            continue
+
+        windowKey = construct_window_key(ruleConfig["window"])
+        if windowKey not in aggregatePlansByWindow:
+            aggregatePlansByWindow[windowKey] = { "kind": "aggregate", "window": ruleConfig["window"], "rules": [] }
+        aggregatePlansByWindow[windowKey]["rules"].append(ruleConfig)
+
+    queryPlans = list(aggregatePlansByWindow.values())
+    if transactionsPlan:
+        queryPlans.append(transactionsPlan)
+
+    print("Planned {queries} queries for {rules} rules".format(queries=len(queryPlans), rules=len(ruleConfigs)))
+    return queryPlans
+
+def construct_aggregation_for_rule(ruleConfig, ruleIndex):
+    ruleCondition = (
+        "`transaction_type` = @transactionType{index} and `time_transaction_occurred` > @latestFlagTime{index}".format(index=ruleIndex)
+    )
+    aggregation = ruleConfig["aggregation"]
+
+    if aggregation == RULE_AGGREGATIONS["count_above_benchmark"]:
+        return "countif({condition} and `amount` > @benchmark{index}) as `{fact}`".format(condition=ruleCondition, index=ruleIndex, fact=ruleConfig["fact"])
+
+    if aggregation == RULE_AGGREGATIONS["latest_amount"]:
+        return (
+            "array_agg(if({condition}, `amount`, null) ignore nulls order by `time_transaction_occurred` desc limit 1)[safe_offset(0)] as `{fact}`"
+                .format(condition=ruleCondition, fact=ruleConfig["fact"])
+        )
+
+    if aggregation == RULE_AGGREGATIONS["average_amount"]:
+        return "avg(if({condition}, `amount`, null)) as `{fact}`".format(condition=ruleCondition, fact=ruleConfig["fact"])
+
+    raise Exception("Unsupported aggregation: {aggregation} for rule: {label}".format(aggregation=aggregation, label=ruleConfig["label"]))
+
+def construct_query_for_aggregate_plan(userId, queryPlan):
+    aggregations = []
+    query_params = [bigquery.ScalarQueryParameter("userId", "STRING", userId)]
+
+    for ruleIndex, ruleConfig in enumerate(queryPlan["rules"]):
+        aggregations.append(construct_aggregation_for_rule(ruleConfig, ruleIndex))
+        query_params.append(bigquery.ScalarQueryParameter("transactionType{}".format(ruleIndex), "STRING", ruleConfig["transactionType"]))
+        query_params.append(bigquery.ScalarQueryParameter("latestFlagTime{}".format(ruleIndex), "INT64", ruleConfig["latestFlagTime"]))
+        if "benchmark" in ruleConfig:
+            benchmark = convert_amount_from_given_unit_to_hundredth_cent(ruleConfig["benchmark"], 'WHOLE_CURRENCY')
+            query_params.append(bigquery.ScalarQueryParameter("benchmark{}".format(ruleIndex), "INT64", benchmark))
+
+    windowCondition = ""
+    if queryPlan["window"]:
+        windowCondition = "and `time_transaction_occurred` >= @givenTime"
+        query_params.append(bigquery.ScalarQueryParameter("givenTime", "INT64", calculate_given_time_for_window(queryPlan["window"])))
+
+    query = (
+        """
+        select {aggregations}
+        from `{full_table_url}`
+        where `user_id` = @userId
+        {window_condition}
+        """.format(aggregations=",\n        ".join(aggregations), full_table_url=FULL_TABLE_URL, window_condition=windowCondition)
+    )
+    return query, query_params
+
+def convert_aggregate_to_fact(ruleConfig, value):
+    if ruleConfig["aggregation"] == RULE_AGGREGATIONS["count_above_benchmark"]:
+        return value
+
+    return convert_amount_from_hundredth_cent_to_whole_currency(value) * ruleConfig.get("multiplier", 1)
+
+def execute_aggregate_plan(userId, queryPlan):
+    query, query_params = construct_query_for_aggregate_plan(userId, queryPlan)
+    bigQueryResponse = fetch_data_as_list_from_user_behaviour_table(query, query_params)
+
+    return {
+        ruleConfig["fact"]: convert_aggregate_to_fact(
+            ruleConfig,
+            extract_key_value_from_first_item_of_big_query_response(bigQueryResponse, ruleConfig["fact"])
+        )
+        for ruleConfig in queryPlan["rules"]
+    }
+
+def execute_transactions_plan(userId, queryPlan):
+    cycleConfigs = [
+        {
+            "numOfHours": ruleConfig["numOfHours"],
+            "numOfDays": ruleConfig["window"]["days"],
+            "latestFlagTime": ruleConfig["latestFlagTime"]
+        }
+        for ruleConfig in queryPlan["rules"]
+    ]
+    transactionsForWidestWindow = fetch_withdrawals_and_saving_events_for_widest_days_cycle(userId, cycleConfigs)
+
+    return {
+        ruleConfig["fact"]: calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(userId, cycleConfig, transactionsForWidestWindow)
+        for ruleConfig, cycleConfig in zip(queryPlan["rules"], cycleConfigs)
+    }
+
+def execute_query_plan(userId, queryPlan):
+    if queryPlan["kind"] == "transactions":
+        return execute_transactions_plan(userId, queryPlan)
+
+    return execute_aggregate_plan(userId, queryPlan)
+
+# executes the rules declared in `RULE_DEFINITIONS` whose label is in `rulesToExecute` (all rules if not given)
+def generic_rule_executor(userId, ruleCutOffTimes, rulesToExecute=None):
+    ruleConfigs = [
+        assemble_config_for_rule(ruleDefinition, ruleCutOffTimes)
+        for ruleDefinition in RULE_DEFINITIONS
+        if rulesToExecute is None or ruleDefinition["label"] in rulesToExecute
+    ]
+
+    userBehaviour = {}
+    for queryPlan in plan_rule_queries(ruleConfigs):
+        planName = "+".join(ruleConfig["label"] for ruleConfig in queryPlan["rules"])
+        userBehaviour.update(fetch_rule_facts_with_diagnostics(planName, execute_query_plan, userId, queryPlan))
+
+    # facts are returned in the order the rules are declared
+    return { ruleConfig["fact"]: userBehaviour[ruleConfig["fact"]] for ruleConfig in ruleConfigs }
+
 def extract_params_from_fetch_user_behaviour_request(request):
     print("Extracting params - 'userId', 'accountId' and 'ruleCutOffTimes' from 'retrieve user behaviour request'")
     request_json = request.get_json()
@@ -437,6 +1310,24 @@ def extract_params_from_fetch_user_behaviour_request(request):
         "ruleCutOffTimes": ruleCutOffTimes
     }
 
+    # optional, limits the rules run by the rule engine
+    if request_json and 'rulesToExecute' in request_json:
+        extractedParams["rulesToExecute"] = request_json['rulesToExecute']
+
+    # optional, rows just inserted by `update-user-behaviour` that may not be visible to queries yet
+    if request_json and 'recentTransactions' in request_json:
+        recentTransactions = request_json['recentTransactions']
+        try:
+            recentTransactions = json.loads(recentTransactions) if isinstance(recentTransactions, str) else recentTransactions
+        except ValueError:
+            print("Dropping recent transactions that are not valid JSON: {}".format(recentTransactions))
+            recentTransactions = []
+        extractedParams["recentTransactions"] = extract_valid_recent_transactions(recentTransactions, userId, accountId)
+
+    # optional, adds per rule wall time and BigQuery job statistics to the response
+    if request_json and 'includeDiagnostics' in request_json:
+        extractedParams["includeDiagnostics"] = request_json['includeDiagnostics']
+
     print(
         """
         Successfully extracted required params from fetch user behaviour request.
@@ -446,7 +1337,82 @@ def extract_params_from_fetch_user_behaviour_request(request):
 
     return extractedParams
 
+def fetch_latest_write_time_for_user(userId):
+    if LATEST_WRITE_TIME_TTL_IN_SECONDS > 0:
+        with userBehaviourCacheLock:
+            if userId in latestWriteTimeCache:
+                return latestWriteTimeCache[userId]
+
+    print("Fetching the latest write time of user id: {userId}".format(userId=userId))
+    query = (
+        """
+        select max(`created_at`) as `latestWriteTime`
+        from `{full_table_url}`
+        where `user_id` = @userId
+        """.format(full_table_url=FULL_TABLE_URL)
+    )
+    query_params = [
+        bigquery.ScalarQueryParameter("userId", "STRING", userId),
+    ]
+
+    bigQueryResponse = fetch_data_as_list_from_user_behaviour_table(query, query_params)
+    latestWriteTime = bigQueryResponse[0]["latestWriteTime"] if bigQueryResponse else None
+
+    if LATEST_WRITE_TIME_TTL_IN_SECONDS > 0:
+        with userBehaviourCacheLock:
+            latestWriteTimeCache[userId] = latestWriteTime
+
+    return latestWriteTime
+
+# the windows of the rules are relative to today, so a result is only valid on the day it was computed
+def construct_user_behaviour_cache_key(requestParams, latestWriteTime):
+    return (
+        requestParams["userId"],
+        json.dumps(requestParams["ruleCutOffTimes"], sort_keys=True),
+        json.dumps(requestParams.get("rulesToExecute")),
+        RULE_EXECUTION_MODE,
+        datetime.date.today().isoformat(),
+        latestWriteTime
+    )
+
+def fetch_user_behaviour_from_cache(cacheKey):
+    if USER_BEHAVIOUR_CACHE_SIZE <= 0:
+        return None
+
+    with userBehaviourCacheLock:
+        return userBehaviourCache.get(cacheKey)
+
+def store_user_behaviour_in_cache(cacheKey, userBehaviour):
+    if USER_BEHAVIOUR_CACHE_SIZE <= 0:
+        return
+
+    with userBehaviourCacheLock:
+        userBehaviourCache[cacheKey] = userBehaviour
+
+def fetch_user_behaviour_for_execution_mode(userId, ruleCutOffTimes, requestParams):
+    # in these modes the rules share their queries, so they are timed as one
+    if RULE_EXECUTION_MODE == RULE_EXECUTION_MODES["single_scan"]:
+        return fetch_rule_facts_with_diagnostics(RULE_EXECUTION_MODE, fetch_user_behaviour_in_single_scan, userId, ruleCutOffTimes)
+
+    if RULE_EXECUTION_MODE == RULE_EXECUTION_MODES["monthly_aggregates"]:
+        return fetch_rule_facts_with_diagnostics(RULE_EXECUTION_MODE, fetch_user_behaviour_from_monthly_aggregates, userId, ruleCutOffTimes)
+
+    if RULE_EXECUTION_MODE == RULE_EXECUTION_MODES["rule_engine"]:
+        return generic_rule_executor(userId, ruleCutOffTimes, requestParams.get("rulesToExecute"))
+
+    if RULE_EXECUTION_MODE == RULE_EXECUTION_MODES["concurrent"]:
+        return fetch_user_behaviour_concurrently(userId, ruleCutOffTimes)
+
+    return fetch_user_behaviour_rule_by_rule(userId, ruleCutOffTimes)
+
+def log_fetch_user_behaviour_diagnostics(userId, diagnostics):
+    print(json.dumps({ "message": "fetch_user_behaviour_diagnostics", "userId": userId, **diagnostics }))
+
 def fetch_user_behaviour_based_on_rules(request):
+    startTime = time.time()
+    ruleDiagnostics = {}
+    diagnosticsToken = requestRuleDiagnostics.set(ruleDiagnostics)
+    recentTransactionsToken = requestRecentTransactions.set(())
     try:
         requestParams = extract_params_from_fetch_user_behaviour_request(request)
 
@@ -461,81 +1427,121 @@ def fetch_user_behaviour_based_on_rules(request):
         # This function's job is to extract user behaviour. Its job is not to understand what fraud means. That is the
         # job of the fraud detection function. This one just says, if you give me a cut off time for a rule, I apply it.
         ruleCutOffTimes = requestParams["ruleCutOffTimes"]
+        requestRecentTransactions.set(tuple(requestParams.get("recentTransactions", [])))
+
+        resultCacheHit = False
+        if requestParams.get("recentTransactions"):
+            # a result computed with forwarded rows must not reach other requests, so it is not cached
+            print("Computing user behaviour of user id: {userId} with forwarded recent transactions".format(userId=userId))
+            userBehaviour = fetch_user_behaviour_for_execution_mode(userId, ruleCutOffTimes, requestParams)
+        else:
+            latestWriteTime = fetch_rule_facts_with_diagnostics("latest_write_time", fetch_latest_write_time_for_user, userId)
+            latestWriteTime = include_recent_writes_in_latest_write_time(userId, latestWriteTime)
+            cacheKey = construct_user_behaviour_cache_key(requestParams, latestWriteTime)
+            userBehaviour = fetch_user_behaviour_from_cache(cacheKey)
+            resultCacheHit = userBehaviour is not None
+
+            if resultCacheHit:
+                print("Found cached user behaviour for user id: {userId} at latest write time: {time}".format(userId=userId, time=latestWriteTime))
+            else:
+                userBehaviour = fetch_user_behaviour_for_execution_mode(userId, ruleCutOffTimes, requestParams)
+                # partial results are not cached, the failed rules are retried on the next check
+                if "ruleErrors" not in userBehaviour:
+                    store_user_behaviour_in_cache(cacheKey, userBehaviour)
 
-        # could also do via a generic rule executor and list comprehensions
-        # rulesToExecute = request["rulesToExecute"]
-        # ruleConfigs = [assembleConfigForRule(label, ruleCutOffTimes, ruleDefaults) for label in rulesToExecute]
-        # ruleResults = [generic_rule_executor(ruleConfig) for ruleConfig in ruleConfigs]
-
-        # Single saving_event larger than R100 000, use cut off time if it exists, else twenty years ago means prior to system birth
-        countOfSavingEventsGreaterThanHundredThousand = fetch_count_of_user_transactions_larger_than_benchmark(
-            userId,
-            {
-                "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
-                "hundredThousandBenchmark": FIRST_BENCHMARK_SAVING_EVENT,
-                "latestFlagTime": extract_last_flag_time_or_default_time("single_very_large_saving_event", ruleCutOffTimes)
-            }
-        )
+        response = {
+            "userAccountInfo": userAccountInfo,
+            **userBehaviour
+        }
 
-        # More than 3 saving_events larger than R50 000 within a 6 month period
-        countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod = fetch_count_of_user_transactions_larger_than_benchmark_within_months_period(
-            userId,
-            {
-                "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
-                "fiftyThousandBenchmark": SECOND_BENCHMARK_SAVING_EVENT,
-                "sixMonthsPeriod": SIX_MONTHS_INTERVAL,
-                "latestFlagTime": extract_last_flag_time_or_default_time("saving_events_greater_than_benchmark_within_six_months", ruleCutOffTimes)
-            }
-        )
+        diagnostics = {
+            "executionMode": RULE_EXECUTION_MODE,
+            "resultCacheHit": resultCacheHit,
+            "totalTimeInMilliseconds": calculate_elapsed_milliseconds(startTime),
+            "rules": ruleDiagnostics
+        }
+        log_fetch_user_behaviour_diagnostics(userId, diagnostics)
+        if requestParams.get("includeDiagnostics"):
+            response["diagnostics"] = diagnostics
 
-        # If latest inward saving_event > 10x past 6 month average saving_event
-        latestSavingEvent = fetch_user_latest_transaction(
-            userId,
-            {
-                "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
-                "latestFlagTime": extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes)
-            }
-        )
-        sixMonthAverageSavingEvent = fetch_user_average_transaction_within_months_period(
-            userId,
-            {
-                "transactionType": SAVING_EVENT_TRANSACTION_TYPE,
-                "sixMonthsPeriod": SIX_MONTHS_INTERVAL,
-                "latestFlagTime": extract_last_flag_time_or_default_time("latest_saving_event_greater_than_six_months_average", ruleCutOffTimes)
-            }
-        )
-        sixMonthAverageSavingEventMultipliedByN = sixMonthAverageSavingEvent * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT
-
-        countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle = calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
-            userId,
-            {
-                "numOfHours": HOURS_IN_TWO_DAYS,
-                "numOfDays": DAYS_IN_A_MONTH,
-                "latestFlagTime": extract_last_flag_time_or_default_time("withdrawals_within_two_days_of_saving_events_during_one_month", ruleCutOffTimes)
-            }
+        print("Done fetching user behaviour shaped by rules. Response: {}".format(response))
+        return json.dumps(response), 200
+    except Exception as e:
+        customErrorMessage = 'Error fetching user behaviour based on rules. Error: {}'.format(e)
+        print(customErrorMessage)
+        return customErrorMessage, 500
+    finally:
+        requestRecentTransactions.reset(recentTransactionsToken)
+        requestRuleDiagnostics.reset(diagnosticsToken)
+
+def extract_params_from_fetch_user_behaviour_for_users_request(request):
+    print("Extracting params - 'users', 'pageSize' and 'pageToken' from 'retrieve user behaviour for users request'")
+    request_json = request.get_json()
+
+    if not request_json or not isinstance(request_json.get('users'), list) or len(request_json['users']) == 0:
+        raise Exception(
+            """
+            Invalid request to fetch user behaviour for users based on rules. 
+            Param: 'users' must be supplied as a non-empty list
+            """
         )
-        countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle = calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
-            userId,
-            {
-                "numOfHours": HOURS_IN_A_DAY,
-                "numOfDays": DAYS_IN_A_WEEK,
-                "latestFlagTime": extract_last_flag_time_or_default_time("withdrawals_within_one_day_of_saving_events_during_one_week", ruleCutOffTimes)
-            }
+
+    for user in request_json['users']:
+        if 'userId' not in user or 'accountId' not in user or 'ruleCutOffTimes' not in user:
+            raise Exception(
+                """
+                Invalid request to fetch user behaviour for users based on rules. 
+                Params: 'userId', 'accountId' and 'ruleCutOffTimes' must be supplied for each user. User: {}
+                """.format(user)
+            )
+
+    pageSize = int(request_json.get('pageSize', DEFAULT_PAGE_SIZE_FOR_USERS_BATCH))
+    pageToken = int(request_json.get('pageToken', 0))
+    if pageSize < 1 or pageSize > MAXIMUM_PAGE_SIZE_FOR_USERS_BATCH or pageToken < 0:
+        raise Exception(
+            "Invalid page. 'pageSize' must be between 1 and {maximum} and 'pageToken' must not be negative"
+                .format(maximum=MAXIMUM_PAGE_SIZE_FOR_USERS_BATCH)
         )
 
+    return {
+        "users": deduplicate_users_by_user_id(request_json['users']),
+        "pageSize": pageSize,
+        "pageToken": pageToken
+    }
+
+# a user supplied twice would be joined twice in the query and have its counts doubled, so only its first entry is kept
+def deduplicate_users_by_user_id(users):
+    usersById = {}
+    for user in users:
+        if user['userId'] in usersById:
+            print("User id: {} is supplied more than once, only its first entry is evaluated".format(user['userId']))
+            continue
+        usersById[user['userId']] = user
+
+    return list(usersById.values())
+
+# batch counterpart of `fetch_user_behaviour_based_on_rules` for re-screens and sweeps. The users are evaluated
+# with one `group by user_id` query per page. `nextPageToken` is returned until all users supplied have been evaluated.
+# The token is an offset into the users, so the client sends the same `users` with every page
+def fetch_user_behaviour_for_users_based_on_rules(request):
+    try:
+        requestParams = extract_params_from_fetch_user_behaviour_for_users_request(request)
+        users = requestParams["users"]
+        pageSize = requestParams["pageSize"]
+        pageToken = requestParams["pageToken"]
+
+        usersInPage = users[pageToken:pageToken + pageSize]
+        results = fetch_user_behaviour_for_page_of_users(usersInPage) if usersInPage else []
+
+        nextPageStart = pageToken + pageSize
         response = {
-            "userAccountInfo": userAccountInfo,
-            "countOfSavingEventsGreaterThanHundredThousand": countOfSavingEventsGreaterThanHundredThousand,
-            "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod,
-            "latestSavingEvent": latestSavingEvent,
-            "sixMonthAverageSavingEventMultipliedByN": sixMonthAverageSavingEventMultipliedByN,
-            "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle,
-            "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle
+            "results": results,
+            "nextPageToken": str(nextPageStart) if nextPageStart < len(users) else None
         }
-        print("Done fetching user behaviour shaped by rules. Response: {}".format(response))
+        print("Done fetching user behaviour shaped by rules for {count} users".format(count=len(results)))
         return json.dumps(response), 200
     except Exception as e:
-        customErrorMessage = 'Error fetching user behaviour based on rules. Error: {}'.format(e)
+        customErrorMessage = 'Error fetching user behaviour for users based on rules. Error: {}'.format(e)
         print(customErrorMessage)
         return customErrorMessage, 500
 
@@ -549,6 +1555,18 @@ def fetch_user_behaviour_based_on_rules(request):
 '''
 
 def missing_parameter_in_payload (payload):
+    if not isinstance(payload, dict):
+        print("event is not an object")
+        return True
+
+    if ("user_id" not in payload):
+        print("user_id not in payload")
+        return True
+
+    if ("event_type" not in payload):
+        print("event_type not in payload")
+        return True
+
     if ("time_transaction_occurred" not in payload):
         print("time_transaction_occurred not in extracted context")
         return True
@@ -604,31 +1622,32 @@ def fetch_current_time_in_milliseconds():
     return currentTimeInMilliseconds
 
 def format_payload_for_user_behaviour_table(payloadList, time_in_milliseconds_now):
-    userId = ""
-    accountId = ""
     print("formatting payload for user behaviour table {}".format(payloadList))
     formattedPayloadList = []
+    # a message may batch events of many users, an invalid event is skipped without dropping the others
     for eventMessage in payloadList:
         if missing_parameter_in_payload(eventMessage):
-            print("a required parameter is missing")
-            break
-        
-        context = json.loads(eventMessage["context"])
-        amountUnitAndCurrency = extract_amount_unit_and_currency(context["savedAmount"])
-        transactionType = determine_transaction_type_from_event_type(eventMessage["event_type"])
+            print("a required parameter is missing, skipping event: {}".format(eventMessage))
+            continue
+
+        try:
+            context = json.loads(eventMessage["context"])
+            amountUnitAndCurrency = extract_amount_unit_and_currency(context["savedAmount"])
+            transactionType = determine_transaction_type_from_event_type(eventMessage["event_type"])
+        except Exception as e:
+            print("Error extracting transaction from event: {event}, skipping it. Error: {error}".format(event=eventMessage, error=e))
+            continue
+
         if transactionType == "":
             print(
-                "Given event type is not supported. We only support the following event types: {}"
+                "Given event type is not supported. We only support the following event types: {}. Skipping event"
                     .format(SUPPORTED_EVENT_TYPES)
             )
-            break
-
-        userId = eventMessage["user_id"] # only one eventMessage is expected, hence the assignment of user info
-        accountId = context["accountId"]
+            continue
 
         singleFormattedPayload = {
-            "user_id": userId,
-            "account_id": accountId,
+            "user_id": eventMessage["user_id"],
+            "account_id": context["accountId"],
             "transaction_type": transactionType,
             "amount": amountUnitAndCurrency["amount"],
             "unit": amountUnitAndCurrency["unit"],
@@ -641,11 +1660,10 @@ def format_payload_for_user_behaviour_table(payloadList, time_in_milliseconds_no
         formattedPayloadList.append(singleFormattedPayload)
     
     print(
-        "constructed formatted payload list: {payload} for user Id: {userId} and account id: {accountId}".format(payload=formattedPayloadList, userId=userId, accountId=accountId)
+        "constructed formatted payload list: {payload}".format(payload=formattedPayloadList)
     )
+    # the rows can belong to many users, `extract_unique_users_from_formatted_payload` groups them by user
     return {
-        "userId": userId,
-        "accountId": accountId,
         "formattedPayloadList": formattedPayloadList
     }
 
@@ -657,6 +1675,7 @@ def insert_rows_into_user_behaviour_table(formattedPayloadList):
             errors = client.insert_rows(table, formattedPayloadList)
             print("successfully inserted formatted payload: {msg} into table: {table} of big query".format(msg=formattedPayloadList, table=table_id))
             assert errors == []
+            remember_recent_writes(formattedPayloadList)
         except AssertionError:
             raise Exception('Error inserting row into user behaviour table. Error: {}'.format(errors))
         except Exception as error:
@@ -665,19 +1684,296 @@ def insert_rows_into_user_behaviour_table(formattedPayloadList):
         raise Exception("Invalid formatted payload list provided to insert rows into behaviour table function. Formatted Payload list: {}".format(formattedPayloadList))
 
 
+# Recomputes the months of `user_behaviour_monthly_aggregates` that rows written since the last run fall into, from every
+# row of those months in `user_behaviour` written up to `computedThrough`. Months are recomputed rather than incremented,
+# so a run that fails or is repeated leaves the rows right, and every row is counted like the raw-row execution modes do
+def construct_monthly_aggregates_refresh_query():
+    return (
+        """
+        merge `{monthly_aggregates_table_url}` as `aggregates`
+        using (
+            select `user_id`, `transaction_type`, `month_start`,
+            count(*) as `transaction_count`,
+            sum(`amount`) as `amount_sum`,
+            countif(`amount` > @firstBenchmark) as `count_above_first_benchmark`,
+            countif(`amount` > @secondBenchmark) as `count_above_second_benchmark`,
+            array_agg(`amount` order by `time_transaction_occurred` desc limit 1)[offset(0)] as `latest_transaction_amount`,
+            max(`time_transaction_occurred`) as `latest_transaction_time`,
+            @computedThrough as `computed_through`,
+            @updatedAt as `updated_at`
+            from (
+                select `user_id`, `transaction_type`, `amount`, `time_transaction_occurred`,
+                unix_millis(timestamp_trunc(timestamp_millis(`time_transaction_occurred`), month)) as `month_start`
+                from `{full_table_url}`
+                where `created_at` <= @computedThrough
+            ) as `transactions`
+            join (
+                select distinct `user_id`, `transaction_type`,
+                unix_millis(timestamp_trunc(timestamp_millis(`time_transaction_occurred`), month)) as `month_start`
+                from `{full_table_url}`
+                where `created_at` > (select coalesce(max(`computed_through`), 0) from `{monthly_aggregates_table_url}`)
+                and `created_at` <= @computedThrough
+            ) as `changed_months`
+            using (`user_id`, `transaction_type`, `month_start`)
+            group by `user_id`, `transaction_type`, `month_start`
+        ) as `recomputed`
+        on `aggregates`.`user_id` = `recomputed`.`user_id`
+        and `aggregates`.`transaction_type` = `recomputed`.`transaction_type`
+        and `aggregates`.`month_start` = `recomputed`.`month_start`
+        when matched then update set
+            `transaction_count` = `recomputed`.`transaction_count`,
+            `amount_sum` = `recomputed`.`amount_sum`,
+            `count_above_first_benchmark` = `recomputed`.`count_above_first_benchmark`,
+            `count_above_second_benchmark` = `recomputed`.`count_above_second_benchmark`,
+            `latest_transaction_amount` = `recomputed`.`latest_transaction_amount`,
+            `latest_transaction_time` = `recomputed`.`latest_transaction_time`,
+            `computed_through` = `recomputed`.`computed_through`,
+            `updated_at` = `recomputed`.`updated_at`
+        when not matched then insert (
+            `user_id`, `transaction_type`, `month_start`, `transaction_count`, `amount_sum`, `count_above_first_benchmark`,
+            `count_above_second_benchmark`, `latest_transaction_amount`, `latest_transaction_time`, `computed_through`, `updated_at`
+        ) values (
+            `recomputed`.`user_id`, `recomputed`.`transaction_type`, `recomputed`.`month_start`,
+            `recomputed`.`transaction_count`, `recomputed`.`amount_sum`, `recomputed`.`count_above_first_benchmark`,
+            `recomputed`.`count_above_second_benchmark`, `recomputed`.`latest_transaction_amount`,
+            `recomputed`.`latest_transaction_time`, `recomputed`.`computed_through`, `recomputed`.`updated_at`
+        )
+        """.format(monthly_aggregates_table_url=MONTHLY_AGGREGATES_TABLE_URL, full_table_url=FULL_TABLE_URL)
+    )
+
+# rows streamed into `user_behaviour` can take a while to become visible to queries, so only rows written at least
+# `MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS` ago are counted. Later rows are read raw until the next run
+def construct_monthly_aggregates_refresh_query_params(time_in_milliseconds_now):
+    return [
+        bigquery.ScalarQueryParameter(
+            "computedThrough", "INT64", time_in_milliseconds_now - MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS * SECOND_TO_MILLISECOND_FACTOR
+        ),
+        bigquery.ScalarQueryParameter("firstBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+        bigquery.ScalarQueryParameter("secondBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(SECOND_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+        bigquery.ScalarQueryParameter("updatedAt", "INT64", time_in_milliseconds_now),
+    ]
+
+# run on a schedule, so the table is updated by one MERGE at a time rather than one per message, which BigQuery would
+# fail when they run at once. A failed run is logged, the next one recomputes the same months
+def refresh_monthly_aggregates(event, context):
+    print("recomputing the months of table: {table} written since the last refresh".format(table=monthly_aggregates_table_id))
+
+    job_config = bigquery.QueryJobConfig()
+    job_config.query_parameters = construct_monthly_aggregates_refresh_query_params(fetch_current_time_in_milliseconds())
+
+    try:
+        client.query(
+            construct_monthly_aggregates_refresh_query(),
+            location=BIG_QUERY_DATASET_LOCATION,
+            job_config=job_config,
+        ).result()
+        print("successfully refreshed table: {table}".format(table=monthly_aggregates_table_id))
+        return 'OK', 200
+    except Exception as e:
+        print('Error refreshing monthly aggregates table. Error: {}'.format(e))
+
+
+def calculate_start_of_six_months_window():
+    return convert_date_string_to_millisecond_int(calculate_date_n_months_ago(SIX_MONTHS_INTERVAL), HOUR_MARKING_START_OF_DAY)
+
+# `single_very_large_saving_event` counts over the whole history of the user, so the window keeps those saving events
+# however old they are
+def is_very_large_saving_event(transaction):
+    return transaction["transaction_type"] == SAVING_EVENT_TRANSACTION_TYPE and transaction["amount"] > convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')
+
+def fetch_transactions_for_rule_window(userId):
+    print("Seeding the rule window of user id: {userId} with the transactions of the last {months} months".format(userId=userId, months=SIX_MONTHS_INTERVAL))
+    query = (
+        """
+        select `transaction_type`, `amount`, `time_transaction_occurred`, `created_at`
+        from `{full_table_url}`
+        where `user_id` = @userId
+        and (`time_transaction_occurred` >= @givenTime or (`transaction_type` = @savingEventType and `amount` > @firstBenchmark))
+        """.format(full_table_url=FULL_TABLE_URL)
+    )
+    query_params = [
+        bigquery.ScalarQueryParameter("userId", "STRING", userId),
+        bigquery.ScalarQueryParameter("givenTime", "INT64", calculate_start_of_six_months_window()),
+        bigquery.ScalarQueryParameter("savingEventType", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("firstBenchmark", "INT64", convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')),
+    ]
+
+    return [dict(row.items()) for row in fetch_data_as_list_from_user_behaviour_table(query, query_params)]
+
+def construct_rule_window_key(transaction):
+    return (transaction["transaction_type"], transaction["amount"], transaction["time_transaction_occurred"], transaction["created_at"])
+
+def update_user_transaction_window(userId, newTransactions):
+    with userTransactionWindowsLock:
+        transactionWindow = userTransactionWindows.get(userId)
+
+    if transactionWindow is None:
+        transactionWindow = fetch_transactions_for_rule_window(userId)
+
+    windowStart = calculate_start_of_six_months_window()
+    transactionsByKey = { construct_rule_window_key(transaction): transaction for transaction in transactionWindow + newTransactions }
+    transactionWindow = sorted(
+        [
+            transaction for transaction in transactionsByKey.values()
+            if transaction["time_transaction_occurred"] >= windowStart or is_very_large_saving_event(transaction)
+        ],
+        key=lambda transaction: transaction["time_transaction_occurred"]
+    )
+
+    with userTransactionWindowsLock:
+        if userId not in userTransactionWindows:
+            userTransactionWindows[userId] = transactionWindow
+        else:
+            # keep the expiry of the seed, so that transactions logged by other instances are picked up in time
+            userTransactionWindows[userId][:] = transactionWindow
+
+    return transactionWindow
+
+# The rules are evaluated over the window without the users' cut off times, which are only known to the fraud
+# detector. Leaving them out can only add transactions, so every count is at least the one the fraud detector gets.
+# The window holds the last six months and, for `single_very_large_saving_event`, which counts over the user's whole
+# history, every saving_event above the first benchmark. The other rules only look at the last six months.
+# Any average after a cut off that includes the latest saving_event is at least the smallest saving_event of the window.
+# The latest saving_event of the user can be older than the window though, and the fraud detector still compares it to
+# the average of the window, so a user without saving_events in the window is always a candidate for that rule. A rule
+# that would flag the user is therefore never missed, at the price of some candidates that are not flagged
+def find_flag_candidate_rules(userId, transactionWindow):
+    windowStart = calculate_start_of_six_months_window()
+    sixMonthTransactions = [transaction for transaction in transactionWindow if transaction["time_transaction_occurred"] >= windowStart]
+    savingEventAmounts = [
+        transaction["amount"] for transaction in sixMonthTransactions if transaction["transaction_type"] == SAVING_EVENT_TRANSACTION_TYPE
+    ]
+    secondBenchmark = convert_amount_from_given_unit_to_hundredth_cent(SECOND_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')
+    noFlagTime = { "latestFlagTime": DEFAULT_LATEST_FLAG_TIME }
+
+    facts = {
+        "countOfSavingEventsGreaterThanHundredThousand": len([transaction for transaction in transactionWindow if is_very_large_saving_event(transaction)]),
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": len([amount for amount in savingEventAmounts if amount > secondBenchmark]),
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
+            userId, { "numOfHours": HOURS_IN_TWO_DAYS, "numOfDays": DAYS_IN_A_MONTH, **noFlagTime }, sixMonthTransactions
+        ),
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(
+            userId, { "numOfHours": HOURS_IN_A_DAY, "numOfDays": DAYS_IN_A_WEEK, **noFlagTime }, sixMonthTransactions
+        ),
+    }
+
+    candidateRules = []
+    if facts["countOfSavingEventsGreaterThanHundredThousand"] > FLAG_CANDIDATE_THRESHOLDS["countOfSavingEventsGreaterThanHundredThousand"]:
+        candidateRules.append("single_very_large_saving_event")
+    if facts["countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod"] >= FLAG_CANDIDATE_THRESHOLDS["countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod"]:
+        candidateRules.append("saving_events_greater_than_benchmark_within_six_months")
+    if not savingEventAmounts or savingEventAmounts[-1] > min(savingEventAmounts) * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT:
+        candidateRules.append("latest_saving_event_greater_than_six_months_average")
+    if facts["countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle"] > FLAG_CANDIDATE_THRESHOLDS["countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle"]:
+        candidateRules.append("withdrawals_within_two_days_of_saving_events_during_one_month")
+    if facts["countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle"] > FLAG_CANDIDATE_THRESHOLDS["countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle"]:
+        candidateRules.append("withdrawals_within_one_day_of_saving_events_during_one_week")
+
+    return candidateRules
+
+def find_flag_candidate_rules_for_transactions(userId, formattedPayloadList):
+    newTransactions = [
+        {
+            "transaction_type": row["transaction_type"],
+            "amount": row["amount"],
+            "time_transaction_occurred": row["time_transaction_occurred"],
+            "created_at": row["created_at"]
+        }
+        for row in formattedPayloadList
+    ]
+    candidateRules = find_flag_candidate_rules(userId, update_user_transaction_window(userId, newTransactions))
+    print("Flag candidate rules for user id: {userId} on ingest: {rules}".format(userId=userId, rules=candidateRules))
+    return candidateRules
+
+# Groups the rows of a batch by user, so the fraud detector checks each user once with all of the user's new rows. The
+# rules are evaluated per user, the account is the one of the user's last row in the batch
+def extract_unique_users_from_formatted_payload(formattedPayloadList):
+    usersById = {}
+    for row in formattedPayloadList:
+        if row["user_id"] not in usersById:
+            usersById[row["user_id"]] = { "userId": row["user_id"], "formattedPayloadList": [] }
+        usersById[row["user_id"]]["accountId"] = row["account_id"]
+        usersById[row["user_id"]]["formattedPayloadList"].append(row)
+
+    return list(usersById.values())
+
+# the rows are forwarded by the fraud detector to `fetch-user-behaviour`, the payload is form encoded so they are sent as json
 def construct_payload_for_fraud_detector(payload):
     return {
         "userId": payload["userId"],
-        "accountId": payload["accountId"]
+        "accountId": payload["accountId"],
+        "recentTransactions": json.dumps(payload["formattedPayloadList"])
     }
 
 def trigger_fraud_detector(payload):
     print(
         "trigger fraud detector with payload: {}".format(payload)
     )
-    response = requests.post(url = FRAUD_DETECTOR_ENDPOINT, data = payload)
-
-    print("Response from fraud detector {}".format(response.text))
+    if FRAUD_DETECTOR_TRIGGER_MODE == FRAUD_DETECTOR_TRIGGER_MODES["async"]:
+        return publish_fraud_detector_trigger(payload)
+
+    post_to_fraud_detector(payload)
+
+def fetch_fraud_detector_session():
+    global fraudDetectorSession
+    with fraudDetectorSessionLock:
+        if fraudDetectorSession is None:
+            # only connection failures are retried, the request has then not reached the fraud detector
+            retry = Retry(total=FRAUD_DETECTOR_CONNECTION_RETRIES, connect=FRAUD_DETECTOR_CONNECTION_RETRIES, read=0, status=0, backoff_factor=0.2)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            fraudDetectorSession = session
+
+        return fraudDetectorSession
+
+def post_to_fraud_detector(payload):
+    print("Posting trigger to fraud detector for user id: {}".format(payload["userId"]))
+    response = fetch_fraud_detector_session().post(
+        url = FRAUD_DETECTOR_ENDPOINT,
+        data = payload,
+        timeout = (FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS, FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS)
+    )
+    print("Response from fraud detector for user id: {userId}: {response}".format(userId=payload["userId"], response=response.text))
+    return response
+
+# imported on first use, as in `SYNC` mode the function publishes nothing
+def fetch_fraud_detector_trigger_publisher():
+    global fraudDetectorTriggerPublisher
+    if fraudDetectorTriggerPublisher is None:
+        from google.cloud import pubsub_v1
+        fraudDetectorTriggerPublisher = pubsub_v1.PublisherClient()
+
+    return fraudDetectorTriggerPublisher
+
+def publish_fraud_detector_trigger(payload):
+    publisher = fetch_fraud_detector_trigger_publisher()
+    topicPath = publisher.topic_path(project_id, FRAUD_DETECTOR_TRIGGER_TOPIC)
+    return publisher.publish(topicPath, json.dumps(payload).encode('utf-8'))
+
+# the publisher sends messages from a background thread, which gets no CPU once the function has returned. The triggers
+# are waited for together up to `FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS`, whatever the number of users
+def wait_for_fraud_detector_triggers(pendingTriggers):
+    if not pendingTriggers:
+        return
+
+    print("Waiting for {} fraud detector triggers to be published".format(len(pendingTriggers)))
+    deadline = time.time() + FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS
+    for userId, pendingTrigger in pendingTriggers:
+        try:
+            pendingTrigger.result(timeout=max(deadline - time.time(), 0))
+        except Exception as e:
+            print("Fraud detector trigger for user id: {userId} was not published. Error: {error}".format(userId=userId, error=e))
+
+# entry point of `post-fraud-detector-trigger`, subscribed to `FRAUD_DETECTOR_TRIGGER_TOPIC`. A failed post is raised, so
+# that pub/sub redelivers the trigger
+def post_fraud_detector_trigger(event, context):
+    payload = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+    response = post_to_fraud_detector(payload)
+    if response.status_code >= 500:
+        raise Exception("Fraud detector failed for user id: {userId} with status: {status}".format(userId=payload["userId"], status=response.status_code))
+    return 'OK', 200
 
 def decode_pub_sub_message(event):
     print("Decoding raw message 'data' from event: {evt}".format(evt=event))
@@ -685,25 +1981,89 @@ def decode_pub_sub_message(event):
     print("Successfully decoded message from pubsub. Message: {msg}".format(msg=msg))
     return msg
 
-def format_payload_and_log_account_transaction(event):
+# every event is kept, supported or not, shaped to the schema of `all_user_events` as `pubsub-to-big-query-for-sns` shapes
+# it. The row ids are then the same, so an event written by both while switching to router mode is de-duplicated
+def format_payload_for_all_user_events_table(payloadList, time_in_milliseconds_now):
+    rows = [
+        { **eventMessage, "created_at": time_in_milliseconds_now, "updated_at": time_in_milliseconds_now, "source_of_event": ALL_USER_EVENTS_SOURCE_OF_EVENT }
+        if isinstance(eventMessage, dict) else eventMessage
+        for eventMessage in payloadList
+    ]
+    shapedRows, rejectedRows = all_user_events_writer.shape_rows(rows)
+    if rejectedRows:
+        log_rejected_all_user_events_rows(rejectedRows)
+
+    return shapedRows
+
+def log_rejected_all_user_events_rows(rejectedRows):
+    print("Rejected {count} rows for table: {table}, not writing them. Rows: {rows}".format(count=len(rejectedRows), table=all_user_events_table_id, rows=rejectedRows))
+
+def insert_rows_into_all_user_events_table(rows):
+    print("inserting {count} rows into table: {table} of big query".format(count=len(rows), table=all_user_events_table_id))
+    rowsNotInserted = all_user_events_writer.insert_rows_with_retries(client, all_user_events_table, rows, log_rejected_all_user_events_rows)
+    if rowsNotInserted:
+        raise Exception('Error inserting rows into all user events table. Rows not inserted: {}'.format(rowsNotInserted))
+
+# Writes the events of the message to all user events before anything is written to user behaviour. A failed write is
+# raised out of the function so that pub/sub redelivers the message, which the row ids keep from duplicating rows.
+# Rows big query rejects as invalid are only logged, they would fail again on every redelivery
+def route_events_to_all_user_events_table(messageFromPubSub):
+    allUserEventsRows = format_payload_for_all_user_events_table(messageFromPubSub, fetch_current_time_in_milliseconds())
+    if allUserEventsRows:
+        insert_rows_into_all_user_events_table(allUserEventsRows)
+
+def format_payload_and_log_account_transaction(messageFromPubSub):
     print("Message received from pubsub")
 
     try:
-        messageFromPubSub = decode_pub_sub_message(event)
-        responseFromPayloadFormatter = format_payload_for_user_behaviour_table(
-            messageFromPubSub,
-            fetch_current_time_in_milliseconds()
-        )
+        responseFromPayloadFormatter = format_payload_for_user_behaviour_table(messageFromPubSub, fetch_current_time_in_milliseconds())
         insert_rows_into_user_behaviour_table(responseFromPayloadFormatter["formattedPayloadList"])
         return responseFromPayloadFormatter
     except Exception as e:
         raise Exception("Error formatting payload and logging account transaction. Error: {}".format(e))
 
+# if the rules cannot be evaluated the fraud detector is triggered, as it would be without pre-screening
+def is_flag_candidate_on_ingest(responseFromPayloadFormatter):
+    try:
+        return len(find_flag_candidate_rules_for_transactions(
+            responseFromPayloadFormatter["userId"],
+            responseFromPayloadFormatter["formattedPayloadList"]
+        )) > 0
+    except Exception as e:
+        print("Error evaluating rules on ingest, triggering fraud detector. Error: {}".format(e))
+        return True
+
+def trigger_fraud_detector_for_user(responseForUser):
+    if EVALUATE_RULES_ON_INGEST and not is_flag_candidate_on_ingest(responseForUser):
+        print("User id: {} is not a flag candidate, not triggering fraud detector".format(responseForUser["userId"]))
+        return
+
+    try:
+        return trigger_fraud_detector(construct_payload_for_fraud_detector(responseForUser))
+    except Exception as e:
+        print("Error triggering fraud detector for user id: {userId}. Error: {error}".format(userId=responseForUser["userId"], error=e))
+
+# the transactions of a batch are inserted at once and the fraud detector is triggered once per user. The message is
+# decoded once, in router mode for both tables
 def update_user_behaviour_and_trigger_fraud_detector(event, context):
     try:
-        responseFromPayloadFormatter = format_payload_and_log_account_transaction(event)
-        payloadForFraudDetector = construct_payload_for_fraud_detector(responseFromPayloadFormatter)
-        trigger_fraud_detector(payloadForFraudDetector)
+        messageFromPubSub = decode_pub_sub_message(event)
+    except Exception as e:
+        print("Error decoding message from pub/sub. Error: {}".format(e))
+        return
+
+    if INGEST_ROUTER_MODE:
+        route_events_to_all_user_events_table(messageFromPubSub)
+
+    try:
+        responseFromPayloadFormatter = format_payload_and_log_account_transaction(messageFromPubSub)
+        pendingTriggers = []
+        for responseForUser in extract_unique_users_from_formatted_payload(responseFromPayloadFormatter["formattedPayloadList"]):
+            pendingTrigger = trigger_fraud_detector_for_user(responseForUser)
+            if pendingTrigger is not None:
+                pendingTriggers.append((responseForUser["userId"], pendingTrigger))
+
+        wait_for_fraud_detector_triggers(pendingTriggers)
         print("acknowledging message to pub/sub")
         return 'OK', 200
     except Exception as e:
@@ -711,3 +2071,151 @@ def update_user_behaviour_and_trigger_fraud_detector(event, context):
 
 # TODO: separate the `fetch user behaviour` and `update user behaviour` functions to a separate folder as it's own function
 # TODO: only authorized users can `fetch user behaviour`
+
+def encode_transaction_timeline_page_token(row):
+    keyset = {
+        "timeTransactionOccurred": row["time_transaction_occurred"],
+        "createdAt": row["created_at"],
+        "rowKey": row["row_key"],
+        "duplicateNumber": row["duplicate_number"]
+    }
+    return base64.urlsafe_b64encode(json.dumps(keyset).encode('utf-8')).decode('utf-8')
+
+def decode_transaction_timeline_page_token(pageToken):
+    try:
+        keyset = json.loads(base64.urlsafe_b64decode(pageToken.encode('utf-8')).decode('utf-8'))
+        return {
+            "timeTransactionOccurred": int(keyset["timeTransactionOccurred"]),
+            "createdAt": int(keyset["createdAt"]),
+            "rowKey": int(keyset["rowKey"]),
+            "duplicateNumber": int(keyset["duplicateNumber"])
+        }
+    except Exception as e:
+        raise Exception("Invalid 'pageToken': {token}. Error: {error}".format(token=pageToken, error=e))
+
+def extract_params_from_fetch_transaction_timeline_request(request):
+    print("Extracting params - 'userId', 'transactionType', 'pageSize' and 'pageToken' from 'fetch transaction timeline request'")
+    request_json = request.get_json()
+
+    if not request_json or 'userId' not in request_json:
+        raise Exception(
+            """
+            Invalid request to fetch user transaction timeline. 
+            Param: 'userId' must be supplied
+            """
+        )
+
+    transactionType = request_json.get('transactionType')
+    if transactionType is not None and transactionType not in [SAVING_EVENT_TRANSACTION_TYPE, WITHDRAWAL_TRANSACTION_TYPE]:
+        raise Exception(
+            "Invalid 'transactionType': {given}. It must be one of: {supported}"
+                .format(given=transactionType, supported=[SAVING_EVENT_TRANSACTION_TYPE, WITHDRAWAL_TRANSACTION_TYPE])
+        )
+
+    pageSize = int(request_json.get('pageSize', DEFAULT_PAGE_SIZE_FOR_TRANSACTION_TIMELINE))
+    if pageSize < 1 or pageSize > MAXIMUM_PAGE_SIZE_FOR_TRANSACTION_TIMELINE:
+        raise Exception(
+            "Invalid page. 'pageSize' must be between 1 and {maximum}".format(maximum=MAXIMUM_PAGE_SIZE_FOR_TRANSACTION_TIMELINE)
+        )
+
+    pageToken = request_json.get('pageToken')
+    return {
+        "userId": request_json['userId'],
+        "transactionType": transactionType,
+        "pageSize": pageSize,
+        "pageKeyset": decode_transaction_timeline_page_token(pageToken) if pageToken else None
+    }
+
+# The page starts after the keyset (time_transaction_occurred, created_at, row_key, duplicate_number) of the last row of
+# the previous page, so a page costs the same however deep into the history it is. `row_key` is a fingerprint of the
+# whole row that breaks ties between rows logged at the same time. Streamed inserts are not de-duplicated, so identical
+# rows share a `row_key`, and `duplicate_number` numbers them. One row more than the page is read to know if another follows
+def construct_transaction_timeline_query(requestParams):
+    query_params = [
+        bigquery.ScalarQueryParameter("userId", "STRING", requestParams["userId"]),
+        bigquery.ScalarQueryParameter("rowLimit", "INT64", requestParams["pageSize"] + 1),
+    ]
+    filters = ["user_id = @userId"]
+
+    if requestParams["transactionType"] is not None:
+        filters.append("transaction_type = @transactionType")
+        query_params.append(bigquery.ScalarQueryParameter("transactionType", "STRING", requestParams["transactionType"]))
+
+    keysetFilter = "true"
+    pageKeyset = requestParams["pageKeyset"]
+    if pageKeyset is not None:
+        keysetFilter = (
+            "(time_transaction_occurred > @lastTimeTransactionOccurred or "
+            "(time_transaction_occurred = @lastTimeTransactionOccurred and created_at > @lastCreatedAt) or "
+            "(time_transaction_occurred = @lastTimeTransactionOccurred and created_at = @lastCreatedAt and row_key > @lastRowKey) or "
+            "(time_transaction_occurred = @lastTimeTransactionOccurred and created_at = @lastCreatedAt and row_key = @lastRowKey "
+            "and duplicate_number > @lastDuplicateNumber))"
+        )
+        query_params.append(bigquery.ScalarQueryParameter("lastTimeTransactionOccurred", "INT64", pageKeyset["timeTransactionOccurred"]))
+        query_params.append(bigquery.ScalarQueryParameter("lastCreatedAt", "INT64", pageKeyset["createdAt"]))
+        query_params.append(bigquery.ScalarQueryParameter("lastRowKey", "INT64", pageKeyset["rowKey"]))
+        query_params.append(bigquery.ScalarQueryParameter("lastDuplicateNumber", "INT64", pageKeyset["duplicateNumber"]))
+
+    query = (
+        """
+        select `account_id`, `transaction_type`, `amount`, `unit`, `currency`, `time_transaction_occurred`, `created_at`,
+        `row_key`, `duplicate_number`
+        from (
+            select *, row_number() over (partition by `row_key`) as `duplicate_number`
+            from (
+                select `transactions`.*, farm_fingerprint(to_json_string(`transactions`)) as `row_key`
+                from `{full_table_url}` as `transactions`
+                where {filters}
+            )
+        )
+        where {keyset_filter}
+        order by `time_transaction_occurred`, `created_at`, `row_key`, `duplicate_number`
+        limit @rowLimit
+        """.format(full_table_url=FULL_TABLE_URL, filters=" and ".join(filters), keyset_filter=keysetFilter)
+    )
+
+    return query, query_params
+
+# One JSON object per line: the rows of the page, then `{"nextPageToken": ...}`. Rows are written as BigQuery returns them,
+# so memory does not grow with the page. The status is sent before the first row is read, so a failure while streaming
+# ends the response with `{"error": ...}` instead of a token
+def generate_transaction_timeline_lines(rows, pageSize):
+    lastRow = None
+    streamedRows = 0
+    try:
+        for row in rows:
+            if streamedRows == pageSize:
+                yield json.dumps({ "nextPageToken": encode_transaction_timeline_page_token(lastRow) }) + "\n"
+                return
+
+            lastRow = dict(row.items())
+            streamedRows += 1
+            yield json.dumps({ column: value for column, value in lastRow.items() if column not in ["row_key", "duplicate_number"] }) + "\n"
+    except Exception as e:
+        print("Error streaming the transaction timeline after {count} rows. Error: {error}".format(count=streamedRows, error=e))
+        yield json.dumps({ "error": "Error fetching user transaction timeline. Error: {}".format(e) }) + "\n"
+        return
+
+    print("Streamed the last {count} rows of the transaction timeline".format(count=streamedRows))
+    yield json.dumps({ "nextPageToken": None }) + "\n"
+
+# transaction history of a user for investigators reviewing fraud flags, streamed as newline delimited JSON
+def fetch_user_transaction_timeline(request):
+    try:
+        requestParams = extract_params_from_fetch_transaction_timeline_request(request)
+        query, query_params = construct_transaction_timeline_query(requestParams)
+
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = query_params
+        print("Fetching transaction timeline for user id: {userId} with query: {query}".format(userId=requestParams["userId"], query=query))
+        rows = client.query(
+            query,
+            location=BIG_QUERY_DATASET_LOCATION,
+            job_config=job_config,
+        ).result()
+
+        return Response(generate_transaction_timeline_lines(rows, requestParams["pageSize"]), mimetype="application/x-ndjson"), 200
+    except Exception as e:
+        customErrorMessage = 'Error fetching user transaction timeline. Error: {}'.format(e)
+        print(customErrorMessage)
+        return customErrorMessage, 500
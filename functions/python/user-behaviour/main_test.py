@@ -1,12 +1,16 @@
+import os
 import time
 import json
+import filecmp
+import random
 import pytest
 import base64
 import datetime
+import cachetools
 
 from mock import Mock
 from google.cloud import bigquery
-from unittest.mock import patch
+from unittest.mock import patch, call
 
 from main \
     import missing_parameter_in_payload, \
@@ -17,7 +21,9 @@ from main \
     trigger_fraud_detector, \
     decode_pub_sub_message, \
     format_payload_and_log_account_transaction, \
+    format_payload_for_all_user_events_table, \
     update_user_behaviour_and_trigger_fraud_detector, \
+    extract_unique_users_from_formatted_payload, \
     construct_payload_for_fraud_detector, \
     fetch_current_time_in_milliseconds, \
     convert_date_string_to_millisecond_int, \
@@ -43,9 +49,34 @@ from main \
     extract_params_from_fetch_user_behaviour_request, \
     fetch_user_behaviour_based_on_rules, \
     fetch_user_average_transaction_within_months_period, \
-    convert_amount_from_given_unit_to_hundredth_cent
+    convert_amount_from_given_unit_to_hundredth_cent, \
+    construct_single_scan_rule_features_query_params, \
+    convert_single_scan_rule_features_to_user_behaviour, \
+    fetch_user_behaviour_in_single_scan, \
+    construct_rule_features_query_params_for_users, \
+    fetch_user_behaviour_for_page_of_users, \
+    fetch_user_behaviour_for_users_based_on_rules, \
+    fetch_withdrawals_and_saving_events_for_widest_days_cycle, \
+    slice_transactions_for_days_cycle, \
+    assemble_config_for_rule, \
+    plan_rule_queries, \
+    construct_query_for_aggregate_plan, \
+    execute_aggregate_plan, \
+    generic_rule_executor, \
+    fetch_user_behaviour_concurrently, \
+    calculate_first_month_start_on_or_after, \
+    fetch_user_behaviour_from_monthly_aggregates, \
+    refresh_monthly_aggregates, \
+    fetch_latest_write_time_for_user, \
+    merge_recent_writes_into_query, \
+    remember_recent_writes, \
+    extract_valid_recent_transactions, \
+    find_flag_candidate_rules, \
+    find_flag_candidate_rules_for_transactions, \
+    update_user_transaction_window
 
 import main
+import all_user_events_writer
 import constant
 
 table = main.table
@@ -68,6 +99,12 @@ SECOND_BENCHMARK_SAVING_EVENT = main.SECOND_BENCHMARK_SAVING_EVENT
 WITHDRAWAL_TRANSACTION_TYPE = main.WITHDRAWAL_TRANSACTION_TYPE
 HOURS_IN_A_DAY = main.HOURS_IN_A_DAY
 DAYS_IN_A_WEEK = main.DAYS_IN_A_WEEK
+DAYS_IN_A_MONTH = main.DAYS_IN_A_MONTH
+HOURS_IN_TWO_DAYS = main.HOURS_IN_TWO_DAYS
+MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT = main.MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT
+RULE_EXECUTION_MODES = main.RULE_EXECUTION_MODES
+RULE_DEFINITIONS = main.RULE_DEFINITIONS
+FRAUD_DETECTOR_TRIGGER_MODES = main.FRAUD_DETECTOR_TRIGGER_MODES
 BIG_QUERY_DATASET_LOCATION = main.BIG_QUERY_DATASET_LOCATION
 
 sample_user_id = "kig2"
@@ -152,6 +189,35 @@ class SampleHttpRequestObject:
         self.get_json_method_called = True
         return sample_request_payload
 
+class SampleHttpRequestObjectWithPayload:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_json(self):
+        return self.payload
+
+class SampleQueryJob:
+    def __init__(self, rows):
+        self.rows = rows
+        self.job_id = "sample-job-id"
+        self.total_bytes_processed = 2048
+        self.slot_millis = 35
+        self.cache_hit = False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+sample_other_user_id = "zt91"
+sample_other_account_id = "0d1e2f3a-77a1-4c5e-9f1b-2c5d9e8a4b60"
+sample_users_for_batch = [
+    sample_request_payload,
+    {
+        "userId": sample_other_user_id,
+        "accountId": sample_account_id,
+        "ruleCutOffTimes": {}
+    }
+]
+
 @pytest.fixture
 def mock_big_query():
     return Mock(spec=bigquery.Client())
@@ -164,6 +230,16 @@ def mock_date_string_to_millisecond_conversion():
 def mock_extract_params_from_fetch_user_behaviour_request():
     return Mock(spec=extract_params_from_fetch_user_behaviour_request)
 
+# every test starts with empty result caches and a known latest transaction time, so no test is served a cached result
+@pytest.fixture(autouse=True)
+def fetch_latest_write_time_for_user_patch():
+    main.userBehaviourCache.clear()
+    main.latestWriteTimeCache.clear()
+    main.recentWritesByUserId.clear()
+    main.userTransactionWindows.clear()
+    with patch('main.fetch_latest_write_time_for_user', return_value=sample_time_transaction_occurred) as patched:
+        yield patched
+
 
 # function is shared by update/fetch user behaviour
 def test_convert_amount_from_given_unit_to_hundredth_cent():
@@ -234,8 +310,8 @@ def test_fetch_data_as_list_from_user_behaviour_table(mock_big_query):
     assert result == list(sample_expected_users)
     mock_big_query.query.assert_called_once()
 
-    query_args = mock_big_query.query.call_args.args
-    query_keyword_args = mock_big_query.query.call_args.kwargs
+    query_args = mock_big_query.query.call_args[0]
+    query_keyword_args = mock_big_query.query.call_args[1]
     
     assert query_args[0] == sample_query
     assert query_keyword_args['location'] == BIG_QUERY_DATASET_LOCATION
@@ -603,6 +679,35 @@ def test_withdrawal_within_tolerance_range_but_time_difference_check_fails_for_c
         sample_number_of_hours
     ) == expected_response
 
+def test_check_each_withdrawal_against_saving_event_matches_pairwise_comparison():
+    # reference: the pairwise comparison of every withdrawal against every saving_event
+    def count_flagged_withdrawals_pairwise(withdrawals, saving_events, numOfHours):
+        count = 0
+        for withdrawal in withdrawals:
+            for saving_event in saving_events:
+                if withdrawal_within_tolerance_range_of_saving_event_amount(withdrawal["amount"], saving_event["amount"]) \
+                        and convert_milliseconds_to_hours(withdrawal["time_transaction_occurred"] - saving_event["time_transaction_occurred"]) <= numOfHours:
+                    count += 1
+        return count
+
+    random.seed(7)
+    for _ in range(50):
+        sample_saving_events = [
+            { "amount": random.choice([95, 98, 100, 101, 120]), "time_transaction_occurred": random.randint(0, 20) * one_hour_in_milliseconds }
+            for _ in range(random.randint(0, 30))
+        ]
+        sample_withdrawals = [
+            { "amount": random.choice([90, 95, 97, 100, 110]), "time_transaction_occurred": random.randint(0, 20) * one_hour_in_milliseconds }
+            for _ in range(random.randint(0, 30))
+        ]
+        sample_number_of_hours = random.choice([1, 6, 24])
+
+        assert check_each_withdrawal_against_saving_event_for_flagged_withdrawals(
+            sample_withdrawals,
+            sample_saving_events,
+            sample_number_of_hours
+        ) == count_flagged_withdrawals_pairwise(sample_withdrawals, sample_saving_events, sample_number_of_hours)
+
 
 @patch('main.fetch_withdrawals_during_days_cycle')
 @patch('main.fetch_saving_events_during_days_cycle')
@@ -625,6 +730,80 @@ def test_calculate_count_of_withdrawals_within_hours_of_saving_events_during_day
     check_each_withdrawal_against_saving_event_for_flagged_withdrawals_patch.assert_called_once()
 
 
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+@patch('main.calculate_given_time_for_days_cycle')
+def test_fetch_withdrawals_and_saving_events_for_widest_days_cycle(
+        calculate_given_time_for_days_cycle_patch,
+        fetch_from_table_patch
+):
+    calculate_given_time_for_days_cycle_patch.return_value = sample_time_transaction_occurred
+    sample_configs = [
+        { "numOfHours": sample_hours, "numOfDays": sample_days, "latestFlagTime": cutoff_time_rule2 },
+        { "numOfHours": sample_hours, "numOfDays": DAYS_IN_A_MONTH, "latestFlagTime": cutoff_time_rule1 }
+    ]
+
+    sample_query = (
+        """
+        select `amount`, `time_transaction_occurred`, `transaction_type`
+        from `{full_table_url}`
+        where `transaction_type` in (@withdrawalTransactionType, @savingEventTransactionType)
+        and `user_id` = @userId
+        and `time_transaction_occurred` >= @givenTime
+        and `time_transaction_occurred` > @latestFlagTime
+        """.format(full_table_url=FULL_TABLE_URL)
+    )
+
+    sample_query_params = [
+        bigquery.ScalarQueryParameter("withdrawalTransactionType", "STRING", WITHDRAWAL_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("savingEventTransactionType", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id),
+        bigquery.ScalarQueryParameter("givenTime", "INT64", sample_time_transaction_occurred),
+        bigquery.ScalarQueryParameter("latestFlagTime", "INT64", cutoff_time_rule1),
+    ]
+
+    fetch_withdrawals_and_saving_events_for_widest_days_cycle(sample_user_id, sample_configs)
+
+    calculate_given_time_for_days_cycle_patch.assert_called_once_with(DAYS_IN_A_MONTH)
+    fetch_from_table_patch.assert_called_once_with(sample_query, sample_query_params)
+
+@patch('main.calculate_given_time_for_days_cycle')
+def test_slice_transactions_for_days_cycle(calculate_given_time_for_days_cycle_patch):
+    calculate_given_time_for_days_cycle_patch.return_value = one_hour_in_milliseconds
+    sample_saving_event_in_window = { "amount": 100, "time_transaction_occurred": five_hours_in_milliseconds, "transaction_type": SAVING_EVENT_TRANSACTION_TYPE }
+    sample_saving_event_before_window = { "amount": 100, "time_transaction_occurred": 0, "transaction_type": SAVING_EVENT_TRANSACTION_TYPE }
+    sample_saving_event_before_flag_time = { "amount": 100, "time_transaction_occurred": 2 * one_hour_in_milliseconds, "transaction_type": SAVING_EVENT_TRANSACTION_TYPE }
+    sample_withdrawal_in_window = { "amount": 98, "time_transaction_occurred": five_hours_in_milliseconds, "transaction_type": WITHDRAWAL_TRANSACTION_TYPE }
+    sample_transactions = [sample_saving_event_in_window, sample_saving_event_before_window, sample_saving_event_before_flag_time, sample_withdrawal_in_window]
+    sample_config = { "numOfHours": sample_hours, "numOfDays": sample_days, "latestFlagTime": 3 * one_hour_in_milliseconds }
+
+    assert slice_transactions_for_days_cycle(sample_transactions, sample_config, SAVING_EVENT_TRANSACTION_TYPE) == [sample_saving_event_in_window]
+    assert slice_transactions_for_days_cycle(sample_transactions, sample_config, WITHDRAWAL_TRANSACTION_TYPE) == [sample_withdrawal_in_window]
+
+@patch('main.fetch_withdrawals_during_days_cycle')
+@patch('main.fetch_saving_events_during_days_cycle')
+@patch('main.slice_transactions_for_days_cycle')
+def test_calculate_count_of_withdrawals_within_hours_of_saving_events_from_widest_window(
+    slice_transactions_for_days_cycle_patch,
+    fetch_saving_events_during_days_cycle_patch,
+    fetch_withdrawals_during_days_cycle_patch,
+):
+    slice_transactions_for_days_cycle_patch.return_value = []
+    sample_config = {
+        "numOfHours": sample_hours,
+        "numOfDays": sample_days,
+        "latestFlagTime": sample_last_flag_time,
+    }
+    sample_transactions_for_widest_window = []
+
+    calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle(sample_user_id, sample_config, sample_transactions_for_widest_window)
+
+    fetch_withdrawals_during_days_cycle_patch.assert_not_called()
+    fetch_saving_events_during_days_cycle_patch.assert_not_called()
+    slice_transactions_for_days_cycle_patch.assert_has_calls([
+        call(sample_transactions_for_widest_window, sample_config, WITHDRAWAL_TRANSACTION_TYPE),
+        call(sample_transactions_for_widest_window, sample_config, SAVING_EVENT_TRANSACTION_TYPE)
+    ])
+
 def test_extract_params_from_fetch_user_behaviour_request():
     sample_request_payload_instance = SampleHttpRequestObject()
 
@@ -640,9 +819,11 @@ def test_extract_params_from_fetch_user_behaviour_request():
 @patch('main.fetch_count_of_user_transactions_larger_than_benchmark_within_months_period')
 @patch('main.fetch_user_latest_transaction')
 @patch('main.fetch_user_average_transaction_within_months_period')
+@patch('main.fetch_withdrawals_and_saving_events_for_widest_days_cycle')
 @patch('main.calculate_count_of_withdrawals_within_hours_of_saving_events_during_days_cycle')
 def test_fetch_user_behaviour_based_on_rules(
     count_of_withdrawals_within_hours_of_saving_events_during_days_cycle_patch,
+    fetch_withdrawals_and_saving_events_for_widest_days_cycle_patch,
     fetch_user_average_transaction_within_months_period_patch,
     fetch_user_latest_transaction_patch,
     count_of_user_transactions_larger_than_benchmark_within_months_period_patch,
@@ -693,10 +874,631 @@ def test_fetch_user_behaviour_based_on_rules(
         }
     )
 
+    fetch_withdrawals_and_saving_events_for_widest_days_cycle_patch.assert_called_once()
     assert count_of_withdrawals_within_hours_of_saving_events_during_days_cycle_patch.call_count == 2
 
 
+def test_construct_single_scan_rule_features_query_params():
+    sample_cut_off_times = {
+        "single_very_large_saving_event": cutoff_time_rule1,
+        "withdrawals_within_one_day_of_saving_events_during_one_week": cutoff_time_rule2
+    }
+
+    query_params = construct_single_scan_rule_features_query_params(sample_user_id, sample_cut_off_times)
+
+    assert bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id) in query_params
+    assert bigquery.ScalarQueryParameter("singleVeryLargeSavingEventFlagTime", "INT64", cutoff_time_rule1) in query_params
+    assert bigquery.ScalarQueryParameter("weekCycleFlagTime", "INT64", cutoff_time_rule2) in query_params
+    assert bigquery.ScalarQueryParameter("monthCycleFlagTime", "INT64", DEFAULT_LATEST_FLAG_TIME) in query_params
+    assert bigquery.ScalarQueryParameter(
+        "hundredThousandBenchmark",
+        "INT64",
+        convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')
+    ) in query_params
+
+def test_convert_single_scan_rule_features_to_user_behaviour():
+    sample_saving_event = { "amount": 100, "time_transaction_occurred": one_hour_in_milliseconds }
+    sample_withdrawal = { "amount": 98, "time_transaction_occurred": five_hours_in_milliseconds }
+    sample_rule_features = {
+        "countOfSavingEventsGreaterThanHundredThousand": 1,
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 2,
+        "latestSavingEvent": sample_amount,
+        "averageSavingEventDuringPastPeriodInMonths": sample_amount,
+        "withdrawalsDuringMonthCycle": [sample_withdrawal],
+        "savingEventsDuringMonthCycle": [sample_saving_event],
+        "withdrawalsDuringWeekCycle": None,
+        "savingEventsDuringWeekCycle": None
+    }
+
+    assert convert_single_scan_rule_features_to_user_behaviour(sample_rule_features) == {
+        "countOfSavingEventsGreaterThanHundredThousand": 1,
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 2,
+        "latestSavingEvent": convert_amount_from_hundredth_cent_to_whole_currency(sample_amount),
+        "sixMonthAverageSavingEventMultipliedByN": convert_amount_from_hundredth_cent_to_whole_currency(sample_amount) * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT,
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": 1,
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": 0
+    }
+
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+@patch('main.convert_single_scan_rule_features_to_user_behaviour')
+def test_fetch_user_behaviour_in_single_scan(
+        convert_single_scan_rule_features_patch,
+        fetch_from_table_patch
+):
+    sample_rule_features = { "countOfSavingEventsGreaterThanHundredThousand": 0 }
+    fetch_from_table_patch.return_value = [sample_rule_features]
+
+    fetch_user_behaviour_in_single_scan(sample_user_id, sample_rule_cut_off_times)
+
+    fetch_from_table_patch.assert_called_once()
+    query_args = fetch_from_table_patch.call_args[0]
+    assert "from `{full_table_url}`".format(full_table_url=FULL_TABLE_URL) in query_args[0]
+    assert bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id) in query_args[1]
+    convert_single_scan_rule_features_patch.assert_called_once_with(sample_rule_features)
+
+@patch('main.RULE_EXECUTION_MODE', RULE_EXECUTION_MODES["single_scan"])
+@patch('main.fetch_user_behaviour_in_single_scan')
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_in_single_scan_mode(
+    fetch_user_behaviour_rule_by_rule_patch,
+    fetch_user_behaviour_in_single_scan_patch
+):
+    fetch_user_behaviour_in_single_scan_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    result = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert result == (json.dumps({
+        "userAccountInfo": { "userId": sample_user_id, "accountId": sample_account_id },
+        "latestSavingEvent": 1.0
+    }), 200)
+    fetch_user_behaviour_in_single_scan_patch.assert_called_once_with(sample_user_id, sample_rule_cut_off_times)
+    fetch_user_behaviour_rule_by_rule_patch.assert_not_called()
+
+
+
+def test_construct_rule_features_query_params_for_users():
+    query_params = construct_rule_features_query_params_for_users(sample_users_for_batch)
+
+    user_rule_cut_off_times = query_params[0]
+    assert user_rule_cut_off_times.name == "userRuleCutOffTimes"
+    assert user_rule_cut_off_times.array_type == "STRUCT"
+    assert len(user_rule_cut_off_times.values) == len(sample_users_for_batch)
+    assert user_rule_cut_off_times.values[1].struct_values["userId"] == sample_other_user_id
+    assert user_rule_cut_off_times.values[1].struct_values["singleVeryLargeSavingEventFlagTime"] == DEFAULT_LATEST_FLAG_TIME
+
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+def test_fetch_user_behaviour_for_page_of_users(fetch_from_table_patch):
+    fetch_from_table_patch.return_value = [
+        {
+            "userId": sample_user_id,
+            "countOfSavingEventsGreaterThanHundredThousand": 1,
+            "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 0,
+            "latestSavingEvent": sample_amount,
+            "averageSavingEventDuringPastPeriodInMonths": sample_amount,
+            "withdrawalsDuringMonthCycle": [],
+            "savingEventsDuringMonthCycle": [],
+            "withdrawalsDuringWeekCycle": [],
+            "savingEventsDuringWeekCycle": []
+        }
+    ]
+
+    result = fetch_user_behaviour_for_page_of_users(sample_users_for_batch)
+
+    fetch_from_table_patch.assert_called_once()
+    assert "group by `user_behaviour`.`user_id`" in fetch_from_table_patch.call_args[0][0]
+    assert len(result) == 2
+    assert result[0]["userAccountInfo"] == { "userId": sample_user_id, "accountId": sample_account_id }
+    assert result[0]["countOfSavingEventsGreaterThanHundredThousand"] == 1
+    assert result[1]["userAccountInfo"] == { "userId": sample_other_user_id, "accountId": sample_account_id }
+    assert result[1]["countOfSavingEventsGreaterThanHundredThousand"] == 0
+    assert result[1]["latestSavingEvent"] == DEFAULT_COUNT_FOR_RULE
+
+@patch('main.fetch_user_behaviour_for_page_of_users')
+def test_fetch_user_behaviour_for_users_based_on_rules(fetch_user_behaviour_for_page_of_users_patch):
+    fetch_user_behaviour_for_page_of_users_patch.return_value = [{ "userAccountInfo": {} }]
+
+    first_page = fetch_user_behaviour_for_users_based_on_rules(
+        SampleHttpRequestObjectWithPayload({ "users": sample_users_for_batch, "pageSize": 1 })
+    )
+    assert first_page == (json.dumps({ "results": [{ "userAccountInfo": {} }], "nextPageToken": "1" }), 200)
+    fetch_user_behaviour_for_page_of_users_patch.assert_called_once_with([sample_users_for_batch[0]])
+
+    last_page = fetch_user_behaviour_for_users_based_on_rules(
+        SampleHttpRequestObjectWithPayload({ "users": sample_users_for_batch, "pageSize": 1, "pageToken": "1" })
+    )
+    assert last_page == (json.dumps({ "results": [{ "userAccountInfo": {} }], "nextPageToken": None }), 200)
+
+@patch('main.fetch_user_behaviour_for_page_of_users')
+def test_fetch_user_behaviour_for_users_based_on_rules_evaluates_duplicate_user_once(fetch_user_behaviour_for_page_of_users_patch):
+    fetch_user_behaviour_for_page_of_users_patch.return_value = [{ "userAccountInfo": {} }, { "userAccountInfo": {} }]
+    duplicateUser = { **sample_users_for_batch[0], "ruleCutOffTimes": { "single_very_large_saving_event": cutoff_time_rule1 } }
+
+    result = fetch_user_behaviour_for_users_based_on_rules(
+        SampleHttpRequestObjectWithPayload({ "users": sample_users_for_batch + [duplicateUser], "pageSize": 2 })
+    )
+
+    fetch_user_behaviour_for_page_of_users_patch.assert_called_once_with(sample_users_for_batch)
+    assert json.loads(result[0])["nextPageToken"] is None
+
+def test_fetch_user_behaviour_for_users_based_on_rules_rejects_invalid_request():
+    result = fetch_user_behaviour_for_users_based_on_rules(
+        SampleHttpRequestObjectWithPayload({ "users": [{ "userId": sample_user_id }] })
+    )
+    assert result[1] == 500
+
+def test_assemble_config_for_rule():
+    sample_rule_definition = RULE_DEFINITIONS[0]
+    sample_cut_off_times = { sample_rule_definition["label"]: cutoff_time_rule1 }
+
+    assert assemble_config_for_rule(sample_rule_definition, sample_cut_off_times) == {
+        **sample_rule_definition,
+        "latestFlagTime": cutoff_time_rule1
+    }
+
+def test_plan_rule_queries_groups_rules_sharing_a_window():
+    sample_rule_configs = [assemble_config_for_rule(rule_definition, {}) for rule_definition in RULE_DEFINITIONS]
+
+    query_plans = plan_rule_queries(sample_rule_configs)
+
+    assert len(query_plans) == 3
+    assert [query_plan["kind"] for query_plan in query_plans] == ["aggregate", "aggregate", "transactions"]
+    assert query_plans[0]["window"] is None
+    assert [rule["fact"] for rule in query_plans[0]["rules"]] == ["countOfSavingEventsGreaterThanHundredThousand", "latestSavingEvent"]
+    assert query_plans[1]["window"] == { "months": SIX_MONTHS_INTERVAL }
+    assert [rule["fact"] for rule in query_plans[1]["rules"]] == [
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod",
+        "sixMonthAverageSavingEventMultipliedByN"
+    ]
+    assert len(query_plans[2]["rules"]) == 2
+
+def test_construct_query_for_aggregate_plan():
+    sample_query_plan = {
+        "kind": "aggregate",
+        "window": None,
+        "rules": [assemble_config_for_rule(RULE_DEFINITIONS[0], sample_rule_cut_off_times)]
+    }
+
+    query, query_params = construct_query_for_aggregate_plan(sample_user_id, sample_query_plan)
+
+    assert "countif(`transaction_type` = @transactionType0 and `time_transaction_occurred` > @latestFlagTime0 and `amount` > @benchmark0)" in query
+    assert "@givenTime" not in query
+    assert query_params == [
+        bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id),
+        bigquery.ScalarQueryParameter("transactionType0", "STRING", SAVING_EVENT_TRANSACTION_TYPE),
+        bigquery.ScalarQueryParameter("latestFlagTime0", "INT64", DEFAULT_LATEST_FLAG_TIME),
+        bigquery.ScalarQueryParameter(
+            "benchmark0",
+            "INT64",
+            convert_amount_from_given_unit_to_hundredth_cent(FIRST_BENCHMARK_SAVING_EVENT, 'WHOLE_CURRENCY')
+        ),
+    ]
+
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+def test_execute_aggregate_plan(fetch_from_table_patch):
+    fetch_from_table_patch.return_value = [
+        { "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 2, "sixMonthAverageSavingEventMultipliedByN": sample_amount }
+    ]
+    sample_query_plan = {
+        "kind": "aggregate",
+        "window": { "months": SIX_MONTHS_INTERVAL },
+        "rules": [assemble_config_for_rule(rule_definition, {}) for rule_definition in RULE_DEFINITIONS[1:4:2]]
+    }
+
+    assert execute_aggregate_plan(sample_user_id, sample_query_plan) == {
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 2,
+        "sixMonthAverageSavingEventMultipliedByN": convert_amount_from_hundredth_cent_to_whole_currency(sample_amount) * MULTIPLIER_OF_SIX_MONTHS_AVERAGE_SAVING_EVENT
+    }
+    fetch_from_table_patch.assert_called_once()
+    assert "and `time_transaction_occurred` >= @givenTime" in fetch_from_table_patch.call_args[0][0]
+
+@patch('main.execute_query_plan')
+def test_generic_rule_executor_only_runs_rules_to_execute(execute_query_plan_patch):
+    execute_query_plan_patch.return_value = { "countOfSavingEventsGreaterThanHundredThousand": 0 }
+
+    result = generic_rule_executor(sample_user_id, sample_rule_cut_off_times, ["single_very_large_saving_event"])
+
+    assert result == { "countOfSavingEventsGreaterThanHundredThousand": 0 }
+    execute_query_plan_patch.assert_called_once()
+
+@patch('main.RULE_EXECUTION_MODE', RULE_EXECUTION_MODES["rule_engine"])
+@patch('main.generic_rule_executor')
+def test_fetch_user_behaviour_based_on_rules_in_rule_engine_mode(generic_rule_executor_patch):
+    generic_rule_executor_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    result = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert result[1] == 200
+    generic_rule_executor_patch.assert_called_once_with(sample_user_id, sample_rule_cut_off_times, None)
+
+def test_fetch_user_behaviour_concurrently_isolates_rule_errors():
+    def failing_fetcher(userId, ruleCutOffTimes):
+        raise Exception("Query timed out")
+
+    sampleFetchers = {
+        "single_very_large_saving_event": lambda userId, ruleCutOffTimes: { "countOfSavingEventsGreaterThanHundredThousand": 1 },
+        "latest_saving_event": failing_fetcher
+    }
+
+    with patch.dict('main.RULE_FACT_FETCHERS', sampleFetchers, clear=True):
+        result = fetch_user_behaviour_concurrently(sample_user_id, sample_rule_cut_off_times)
+
+    assert result == {
+        "countOfSavingEventsGreaterThanHundredThousand": 1,
+        "ruleErrors": { "latest_saving_event": "Query timed out" }
+    }
+
+@patch('main.RULE_EXECUTION_MODE', RULE_EXECUTION_MODES["concurrent"])
+@patch('main.fetch_user_behaviour_concurrently')
+def test_fetch_user_behaviour_based_on_rules_in_concurrent_mode(fetch_user_behaviour_concurrently_patch):
+    fetch_user_behaviour_concurrently_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    result = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert result[1] == 200
+    assert json.loads(result[0])["latestSavingEvent"] == 1.0
+    fetch_user_behaviour_concurrently_patch.assert_called_once_with(sample_user_id, sample_rule_cut_off_times)
+
+
+def test_calculate_first_month_start_on_or_after():
+    startOfJanuary2020 = 1577836800000
+    startOfFebruary2020 = 1580515200000
+
+    assert calculate_first_month_start_on_or_after(startOfJanuary2020) == startOfJanuary2020
+    assert calculate_first_month_start_on_or_after(startOfJanuary2020 + 1) == startOfFebruary2020
+    assert calculate_first_month_start_on_or_after(startOfJanuary2020 - 1) == startOfJanuary2020
+
+@patch('main.fetch_saving_event_aggregates_since')
+@patch('main.fetch_withdrawals_within_hours_of_saving_events_facts')
+def test_fetch_user_behaviour_from_monthly_aggregates(
+        fetch_withdrawals_facts_patch,
+        fetch_saving_event_aggregates_since_patch
+):
+    fetch_saving_event_aggregates_since_patch.return_value = {
+        "transactionCount": 4,
+        "amountSum": 200000000,
+        "countAboveFirstBenchmark": 1,
+        "countAboveSecondBenchmark": 2,
+        "latestTransactionAmount": 80000000
+    }
+    fetch_withdrawals_facts_patch.return_value = {
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": 0,
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": 0
+    }
+
+    result = fetch_user_behaviour_from_monthly_aggregates(sample_user_id, {})
+
+    assert result == {
+        "countOfSavingEventsGreaterThanHundredThousand": 1,
+        "countOfSavingEventsGreaterThanBenchmarkWithinSixMonthPeriod": 2,
+        "latestSavingEvent": 8000.0,
+        "sixMonthAverageSavingEventMultipliedByN": 50000.0,
+        "countOfWithdrawalsWithin48HoursOfSavingEventDuringA30DayCycle": 0,
+        "countOfWithdrawalsWithin24HoursOfSavingEventDuringA7DayCycle": 0
+    }
+    # without cut off times the all time rules and the six month rules each share one query
+    assert fetch_saving_event_aggregates_since_patch.call_count == 2
+
+def fetch_sample_latest_saving_event_facts(userId, ruleCutOffTimes):
+    bigQueryResponse = fetch_data_as_list_from_user_behaviour_table("select `amount` from table", [])
+    return { "latestSavingEvent": bigQueryResponse[0]["amount"] }
+
+@pytest.mark.parametrize("executionMode", [RULE_EXECUTION_MODES["sequential"], RULE_EXECUTION_MODES["concurrent"]])
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+@patch('main.client')
+def test_fetch_user_behaviour_based_on_rules_includes_diagnostics(client_patch, executionMode):
+    client_patch.query.return_value = SampleQueryJob([{ "amount": 1.0 }])
+
+    with patch('main.RULE_EXECUTION_MODE', executionMode), \
+            patch.dict('main.RULE_FACT_FETCHERS', { "latest_saving_event": fetch_sample_latest_saving_event_facts }, clear=True):
+        result = fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload({ **sample_request_payload, "includeDiagnostics": True }))
+
+    assert result[1] == 200
+    diagnostics = json.loads(result[0])["diagnostics"]
+    assert diagnostics["executionMode"] == executionMode
+    assert diagnostics["totalTimeInMilliseconds"] >= 0
+
+    queryDiagnostics = diagnostics["rules"]["latest_saving_event"]["queries"]
+    assert len(queryDiagnostics) == 1
+    assert queryDiagnostics[0]["jobId"] == "sample-job-id"
+    assert queryDiagnostics[0]["totalBytesProcessed"] == 2048
+    assert queryDiagnostics[0]["slotMillis"] == 35
+    assert queryDiagnostics[0]["cacheHit"] == False
+
+@patch('main.log_fetch_user_behaviour_diagnostics')
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_logs_diagnostics_without_returning_them(
+        fetch_user_behaviour_rule_by_rule_patch,
+        log_diagnostics_patch
+):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    result = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert "diagnostics" not in json.loads(result[0])
+    log_diagnostics_patch.assert_called_once()
+    assert log_diagnostics_patch.call_args[0][0] == sample_user_id
+
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+def test_fetch_latest_write_time_for_user(fetch_from_table_patch):
+    fetch_from_table_patch.return_value = [{ "latestWriteTime": sample_time_transaction_occurred }]
+
+    assert fetch_latest_write_time_for_user(sample_user_id) == sample_time_transaction_occurred
+    assert "max(`created_at`)" in fetch_from_table_patch.call_args[0][0]
+
+@patch('main.LATEST_WRITE_TIME_TTL_IN_SECONDS', 60)
+@patch('main.latestWriteTimeCache', cachetools.TTLCache(maxsize=10, ttl=60))
+@patch('main.fetch_data_as_list_from_user_behaviour_table')
+def test_fetch_latest_write_time_for_user_uses_cached_time(fetch_from_table_patch):
+    fetch_from_table_patch.return_value = [{ "latestWriteTime": sample_time_transaction_occurred }]
+
+    fetch_latest_write_time_for_user(sample_user_id)
+
+    assert fetch_latest_write_time_for_user(sample_user_id) == sample_time_transaction_occurred
+    fetch_from_table_patch.assert_called_once()
+
+@patch('main.RECENT_WRITES_TTL_IN_SECONDS', 600)
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_recomputes_after_recent_write(fetch_user_behaviour_rule_by_rule_patch):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+    main.remember_recent_writes([{ **sample_formatted_payload_list[0], "created_at": sample_time_transaction_occurred + 1 }])
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert fetch_user_behaviour_rule_by_rule_patch.call_count == 2
+
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_serves_unchanged_user_from_cache(fetch_user_behaviour_rule_by_rule_patch):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    firstResult = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+    secondResult = fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert firstResult == secondResult
+    fetch_user_behaviour_rule_by_rule_patch.assert_called_once()
+
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_recomputes_after_new_transaction(
+        fetch_user_behaviour_rule_by_rule_patch,
+        fetch_latest_write_time_for_user_patch
+):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+    fetch_latest_write_time_for_user_patch.return_value = sample_time_transaction_occurred + 1
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert fetch_user_behaviour_rule_by_rule_patch.call_count == 2
+
+@patch('main.fetch_user_behaviour_concurrently')
+@patch('main.RULE_EXECUTION_MODE', RULE_EXECUTION_MODES["concurrent"])
+def test_fetch_user_behaviour_based_on_rules_does_not_cache_partial_results(fetch_user_behaviour_concurrently_patch):
+    fetch_user_behaviour_concurrently_patch.return_value = { "ruleErrors": { "latest_saving_event": "Query timed out" } }
+
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObject())
+
+    assert fetch_user_behaviour_concurrently_patch.call_count == 2
+
+def test_merge_recent_writes_into_query():
+    sample_query = "select `amount` from `{}` where `user_id` = @userId".format(FULL_TABLE_URL)
+    sample_params = [bigquery.ScalarQueryParameter("userId", "STRING", sample_user_id)]
+    remember_recent_writes(sample_formatted_payload_list)
+    remember_recent_writes(sample_formatted_payload_list)
+
+    query, query_params = merge_recent_writes_into_query(sample_query, sample_params)
+
+    assert "from (select * from `{}` union distinct select * from unnest(@recentlyInsertedRows))".format(FULL_TABLE_URL) in query
+    assert query_params[0] == sample_params[0]
+    assert query_params[1] == bigquery.ArrayQueryParameter(
+        "recentlyInsertedRows",
+        "STRUCT",
+        [
+            bigquery.StructQueryParameter(
+                None,
+                *[bigquery.ScalarQueryParameter(column, columnType, sample_formatted_payload_list[0][column]) for column, columnType in main.USER_BEHAVIOUR_TABLE_COLUMNS]
+            )
+        ]
+    )
+
+def test_merge_recent_writes_into_query_leaves_query_of_other_users_unchanged():
+    sample_query = "select `amount` from `{}` where `user_id` = @userId".format(FULL_TABLE_URL)
+    sample_params = [bigquery.ScalarQueryParameter("userId", "STRING", sample_other_user_id)]
+    remember_recent_writes(sample_formatted_payload_list)
+
+    assert merge_recent_writes_into_query(sample_query, sample_params) == (sample_query, sample_params)
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_uses_forwarded_recent_transactions_only_for_its_request(fetch_user_behaviour_rule_by_rule_patch):
+    recentWritesSeenByRules = []
+    def fetch_user_behaviour_rule_by_rule(userId, ruleCutOffTimes):
+        recentWritesSeenByRules.append(main.fetch_recent_writes_for_user(userId))
+        return { "latestSavingEvent": 1.0 }
+    fetch_user_behaviour_rule_by_rule_patch.side_effect = fetch_user_behaviour_rule_by_rule
+    otherUserRow = { **sample_formatted_payload_list[0], "user_id": sample_other_user_id }
+    sample_payload = { **sample_request_payload, "recentTransactions": json.dumps(sample_formatted_payload_list + [otherUserRow]) }
+
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_payload))
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_request_payload))
+
+    assert recentWritesSeenByRules == [sample_formatted_payload_list, []]
+    assert main.fetch_recent_writes_for_user(sample_user_id) == []
+    assert main.fetch_recent_writes_for_user(sample_other_user_id) == []
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_does_not_cache_results_computed_with_forwarded_recent_transactions(
+        fetch_user_behaviour_rule_by_rule_patch
+):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+    sample_payload = { **sample_request_payload, "recentTransactions": json.dumps(sample_formatted_payload_list) }
+
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_payload))
+    fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_request_payload))
+
+    assert fetch_user_behaviour_rule_by_rule_patch.call_count == 2
+    assert len(main.userBehaviourCache) == 1
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_reads_no_watermark_for_check_triggered_by_fraud_detector(
+        fetch_user_behaviour_rule_by_rule_patch,
+        fetch_latest_write_time_for_user_patch
+):
+    fetch_user_behaviour_rule_by_rule_patch.return_value = { "latestSavingEvent": 1.0 }
+    sample_payload = { **sample_request_payload, "recentTransactions": json.dumps(sample_formatted_payload_list) }
+
+    result, statusCode = fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_payload))
+
+    assert statusCode == 200
+    fetch_latest_write_time_for_user_patch.assert_not_called()
+
+def test_extract_valid_recent_transactions_drops_rows_not_shaped_like_the_table():
+    validRow = sample_formatted_payload_list[0]
+    invalidRows = [
+        "not a row",
+        { **validRow, "user_id": sample_other_user_id },
+        { **validRow, "account_id": "another-account-id" },
+        { **validRow, "unknown_column": 1 },
+        { column: value for column, value in validRow.items() if column != "created_at" },
+        { **validRow, "amount": "a lot" },
+        { **validRow, "time_transaction_occurred": True },
+    ]
+
+    assert extract_valid_recent_transactions(invalidRows + [validRow], sample_user_id, sample_account_id) == [validRow]
+    assert extract_valid_recent_transactions({ "user_id": sample_user_id }, sample_user_id, sample_account_id) == []
+
+@patch('main.extract_params_from_fetch_user_behaviour_request', extract_params_from_fetch_user_behaviour_request)
+@patch('main.fetch_user_behaviour_rule_by_rule')
+def test_fetch_user_behaviour_based_on_rules_ignores_malformed_recent_transactions(fetch_user_behaviour_rule_by_rule_patch):
+    recentWritesSeenByRules = []
+    def fetch_user_behaviour_rule_by_rule(userId, ruleCutOffTimes):
+        recentWritesSeenByRules.append(main.fetch_recent_writes_for_user(userId))
+        return { "latestSavingEvent": 1.0 }
+    fetch_user_behaviour_rule_by_rule_patch.side_effect = fetch_user_behaviour_rule_by_rule
+    sample_payload = { **sample_request_payload, "recentTransactions": json.dumps([{ "amount": sample_amount }]) }
+
+    result, statusCode = fetch_user_behaviour_based_on_rules(SampleHttpRequestObjectWithPayload(sample_payload))
+
+    assert statusCode == 200
+    assert recentWritesSeenByRules == [[]]
+
+def construct_sample_timeline_row(hoursAfterStart):
+    return {
+        "account_id": sample_account_id,
+        "transaction_type": WITHDRAWAL_TRANSACTION_TYPE,
+        "amount": sample_amount,
+        "unit": sample_unit,
+        "currency": sample_currency,
+        "time_transaction_occurred": sample_time_transaction_occurred + hoursAfterStart * one_hour_in_milliseconds,
+        "created_at": time_in_milliseconds_now,
+        "row_key": hoursAfterStart,
+        "duplicate_number": 1
+    }
+
+def construct_streamed_timeline_row(row):
+    return { column: value for column, value in row.items() if column not in ["row_key", "duplicate_number"] }
+
+def read_streamed_timeline_lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
 
+@patch('main.client')
+def test_fetch_user_transaction_timeline_streams_page_and_keyset_token(client_patch):
+    sampleRows = [construct_sample_timeline_row(hours) for hours in range(3)]
+    client_patch.query.return_value.result.return_value = iter(sampleRows)
+
+    response, status = main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload({ "userId": sample_user_id, "pageSize": 2 }))
+
+    assert status == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = read_streamed_timeline_lines(response)
+    assert lines[:2] == [construct_streamed_timeline_row(row) for row in sampleRows[:2]]
+    assert main.decode_transaction_timeline_page_token(lines[2]["nextPageToken"]) == {
+        "timeTransactionOccurred": sampleRows[1]["time_transaction_occurred"],
+        "createdAt": sampleRows[1]["created_at"],
+        "rowKey": sampleRows[1]["row_key"],
+        "duplicateNumber": sampleRows[1]["duplicate_number"]
+    }
+
+    query = client_patch.query.call_args[0][0]
+    query_params = client_patch.query.call_args[1]["job_config"].query_parameters
+    assert "order by `time_transaction_occurred`, `created_at`, `row_key`, `duplicate_number`" in query
+    assert "farm_fingerprint(to_json_string(`transactions`)) as `row_key`" in query
+    assert "row_number() over (partition by `row_key`) as `duplicate_number`" in query
+    assert "offset" not in query.lower()
+    assert bigquery.ScalarQueryParameter("rowLimit", "INT64", 3) in query_params
+
+@patch('main.client')
+def test_fetch_user_transaction_timeline_continues_after_keyset_with_type_filter(client_patch):
+    lastRow = construct_sample_timeline_row(1)
+    client_patch.query.return_value.result.return_value = iter([construct_sample_timeline_row(2)])
+    sample_payload = {
+        "userId": sample_user_id,
+        "transactionType": WITHDRAWAL_TRANSACTION_TYPE,
+        "pageToken": main.encode_transaction_timeline_page_token(lastRow)
+    }
+
+    response, status = main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload(sample_payload))
+
+    assert status == 200
+    assert read_streamed_timeline_lines(response) == [construct_streamed_timeline_row(construct_sample_timeline_row(2)), { "nextPageToken": None }]
+
+    query = client_patch.query.call_args[0][0]
+    query_params = client_patch.query.call_args[1]["job_config"].query_parameters
+    assert "transaction_type = @transactionType" in query
+    assert "(time_transaction_occurred = @lastTimeTransactionOccurred and created_at = @lastCreatedAt and row_key > @lastRowKey)" in query
+    assert bigquery.ScalarQueryParameter("lastTimeTransactionOccurred", "INT64", lastRow["time_transaction_occurred"]) in query_params
+    assert bigquery.ScalarQueryParameter("lastCreatedAt", "INT64", lastRow["created_at"]) in query_params
+    assert bigquery.ScalarQueryParameter("lastRowKey", "INT64", lastRow["row_key"]) in query_params
+    assert bigquery.ScalarQueryParameter("lastDuplicateNumber", "INT64", lastRow["duplicate_number"]) in query_params
+
+@patch('main.client')
+def test_fetch_user_transaction_timeline_pages_between_identical_rows(client_patch):
+    firstCopy = construct_sample_timeline_row(1)
+    secondCopy = { **firstCopy, "duplicate_number": 2 }
+    client_patch.query.return_value.result.return_value = iter([firstCopy, secondCopy])
+
+    response, status = main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload({ "userId": sample_user_id, "pageSize": 1 }))
+
+    lines = read_streamed_timeline_lines(response)
+    assert lines[0] == construct_streamed_timeline_row(firstCopy)
+    assert main.decode_transaction_timeline_page_token(lines[1]["nextPageToken"])["duplicateNumber"] == 1
+
+    client_patch.query.return_value.result.return_value = iter([secondCopy])
+    main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload({ "userId": sample_user_id, "pageToken": lines[1]["nextPageToken"] }))
+
+    query = client_patch.query.call_args[0][0]
+    query_params = client_patch.query.call_args[1]["job_config"].query_parameters
+    assert "row_key = @lastRowKey and duplicate_number > @lastDuplicateNumber" in query
+    assert bigquery.ScalarQueryParameter("lastDuplicateNumber", "INT64", 1) in query_params
+
+@patch('main.client')
+def test_fetch_user_transaction_timeline_ends_stream_with_error_when_reading_rows_fails(client_patch):
+    def read_rows_then_fail():
+        yield construct_sample_timeline_row(0)
+        raise Exception("Connection reset")
+    client_patch.query.return_value.result.return_value = read_rows_then_fail()
+
+    response, status = main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload({ "userId": sample_user_id }))
+
+    lines = read_streamed_timeline_lines(response)
+    assert lines[0] == construct_streamed_timeline_row(construct_sample_timeline_row(0))
+    assert "Connection reset" in lines[1]["error"]
+    assert "nextPageToken" not in lines[1]
+
+@patch('main.client')
+def test_fetch_user_transaction_timeline_rejects_invalid_params(client_patch):
+    for sample_payload in [
+        {},
+        { "userId": sample_user_id, "transactionType": "DEPOSIT" },
+        { "userId": sample_user_id, "pageSize": 0 },
+        { "userId": sample_user_id, "pageToken": "not-a-token" },
+    ]:
+        result = main.fetch_user_transaction_timeline(SampleHttpRequestObjectWithPayload(sample_payload))
+        assert result[1] == 500
+
+    client_patch.query.assert_not_called()
 
 '''
 =========== END OF FETCH USER BEHAVIOUR Tests ===========
@@ -744,6 +1546,8 @@ def test_missing_parameter_in_payload():
     assert missing_parameter_in_payload(payload_without_saved_amount) == True
 
     full_payload = {
+        "user_id": sample_user_id,
+        "event_type": sample_transaction_type,
         "time_transaction_occurred": sample_time_transaction_occurred,
         "context": {
             "accountId": sample_account_id,
@@ -752,6 +1556,14 @@ def test_missing_parameter_in_payload():
     }
     assert missing_parameter_in_payload(full_payload) == False
 
+    payload_without_user_id = { key: value for key, value in full_payload.items() if key != "user_id" }
+    assert missing_parameter_in_payload(payload_without_user_id) == True
+
+    payload_without_event_type = { key: value for key, value in full_payload.items() if key != "event_type" }
+    assert missing_parameter_in_payload(payload_without_event_type) == True
+
+    assert missing_parameter_in_payload("not an event") == True
+
 def test_extract_amount_unit_and_currency():
     expected_result = {
         "amount": sample_amount,
@@ -771,8 +1583,6 @@ def test_fetch_current_time_in_milliseconds():
 def test_format_payload_for_user_behaviour_table():
 
     expected_response = {
-        "userId": sample_user_id,
-        "accountId": sample_account_id,
         "formattedPayloadList": sample_formatted_payload_list
     }
     assert format_payload_for_user_behaviour_table(sample_event_message_list, time_in_milliseconds_now) == expected_response
@@ -787,7 +1597,7 @@ def test_insert_rows_into_user_behaviour_table_success(mock_big_query):
     assert main.client.insert_rows.call_count == 1
     assert result is None
 
-    query_args = mock_big_query.insert_rows.call_args.args
+    query_args = mock_big_query.insert_rows.call_args[0]
     assert query_args[0] == table
     assert query_args[1] == sample_formatted_payload_list
 
@@ -804,12 +1614,13 @@ def test_insert_rows_throws_exception_on_empty_list():
 def test_construct_payload_for_fraud_detector():
     expected_response = {
         "userId": sample_user_id,
-        "accountId": sample_account_id
+        "accountId": sample_account_id,
+        "recentTransactions": json.dumps(sample_formatted_payload_list)
     }
     assert construct_payload_for_fraud_detector(sample_response_from_payload_formatter) == expected_response
 
-@patch('requests.post')
-def test_trigger_fraud_detector(post_request_patch):
+@patch('main.fetch_fraud_detector_session')
+def test_trigger_fraud_detector(fetch_fraud_detector_session_patch):
     sample_payload = {
         "userId": sample_user_id,
         "accountId": sample_account_id
@@ -817,27 +1628,225 @@ def test_trigger_fraud_detector(post_request_patch):
 
     result = trigger_fraud_detector(sample_payload)
     assert result is None
-    post_request_patch.assert_called_once_with(
-        url = FRAUD_DETECTOR_ENDPOINT, data = sample_payload
+    fetch_fraud_detector_session_patch.return_value.post.assert_called_once_with(
+        url = FRAUD_DETECTOR_ENDPOINT,
+        data = sample_payload,
+        timeout = (main.FRAUD_DETECTOR_CONNECT_TIMEOUT_IN_SECONDS, main.FRAUD_DETECTOR_READ_TIMEOUT_IN_SECONDS)
     )
 
 def test_decode_pub_sub_message():
     assert decode_pub_sub_message(sample_raw_event_from_pub_sub) == sample_event_message_list
 
-@patch('main.decode_pub_sub_message')
 @patch('main.format_payload_for_user_behaviour_table')
 @patch('main.insert_rows_into_user_behaviour_table')
 def test_format_payload_and_log_account_transaction(
         insert_rows_patch,
-        format_payload_patch,
-        decode_pub_sub_message_patch
+        format_payload_patch
 ):
-    format_payload_and_log_account_transaction(sample_raw_event_from_pub_sub)
+    format_payload_and_log_account_transaction(sample_event_message_list)
 
-    decode_pub_sub_message_patch.assert_called()
-    format_payload_patch.assert_called()
+    format_payload_patch.assert_called_once()
+    assert format_payload_patch.call_args[0][0] == sample_event_message_list
     insert_rows_patch.assert_called()
 
+def test_format_payload_for_all_user_events_table_keeps_every_event():
+    unsupportedEvent = { **sample_event_message, "event_type": "PASSWORD_SET" }
+
+    rows = format_payload_for_all_user_events_table([sample_event_message, unsupportedEvent, "not an event"], 5)
+
+    assert [row["event_type"] for row in rows] == [sample_transaction_type, "PASSWORD_SET"]
+    assert all(row["created_at"] == 5 and row["updated_at"] == 5 and row["source_of_event"] == "INTERNAL_SERVICES" for row in rows)
+    assert "created_at" not in sample_event_message
+
+def test_all_user_events_row_id_ignores_time_received_and_time_sent_as_string():
+    row = format_payload_for_all_user_events_table(sample_event_message_list, 1)[0]
+    redeliveredRow = format_payload_for_all_user_events_table(sample_event_message_list, 2)[0]
+    stringTimeRow = format_payload_for_all_user_events_table([{ **sample_event_message, "time_transaction_occurred": str(sample_time_transaction_occurred) }], 1)[0]
+
+    assert all_user_events_writer.construct_row_id(row) == all_user_events_writer.construct_row_id(redeliveredRow)
+    assert all_user_events_writer.construct_row_id(row) == all_user_events_writer.construct_row_id(stringTimeRow)
+    assert all_user_events_writer.construct_row_id(row) != all_user_events_writer.construct_row_id({ **row, "context": "{}" })
+
+# `pubsub-to-big-query-for-sns` is deployed from its own directory, so the writer it shares with router mode is copied
+def test_all_user_events_writer_is_identical_to_copy_of_pubsub_to_big_query_for_sns():
+    functionDirectory = os.path.dirname(os.path.abspath(__file__))
+    pubsubFunctionDirectory = os.path.join(functionDirectory, "..", "pubsub-to-big-query-for-sns")
+    for sharedFile in ["all_user_events_writer.py", "schema_validator.py", os.path.join("schemas", "all_user_events-table.json")]:
+        assert filecmp.cmp(os.path.join(functionDirectory, sharedFile), os.path.join(pubsubFunctionDirectory, sharedFile), shallow=False), sharedFile
+
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.all_user_events_table', 'all_user_events')
+@patch('main.INGEST_ROUTER_MODE', True)
+@patch('main.client')
+def test_update_user_behaviour_and_trigger_fraud_detector_writes_all_user_events_first(client_patch, format_payload_and_log_account_transaction_patch):
+    client_patch.insert_rows.return_value = []
+
+    def insert_into_user_behaviour_table(messageFromPubSub):
+        client_patch.insert_rows(main.table, [])
+        return { "formattedPayloadList": [] }
+    format_payload_and_log_account_transaction_patch.side_effect = insert_into_user_behaviour_table
+
+    update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    insertedTables = [insertCall[0][0] for insertCall in client_patch.insert_rows.call_args_list]
+    assert insertedTables == ['all_user_events', main.table]
+    allUserEventsCall = client_patch.insert_rows.call_args_list[0]
+    assert [row["user_id"] for row in allUserEventsCall[0][1]] == [sample_user_id]
+    assert allUserEventsCall[1]["row_ids"] == [all_user_events_writer.construct_row_id(row) for row in allUserEventsCall[0][1]]
+
+@patch('all_user_events_writer.calculate_insert_backoff_in_seconds', Mock(return_value=0))
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.all_user_events_table', 'all_user_events')
+@patch('main.INGEST_ROUTER_MODE', True)
+@patch('main.client')
+def test_update_user_behaviour_and_trigger_fraud_detector_raises_when_all_user_events_write_fails(
+        client_patch,
+        format_payload_and_log_account_transaction_patch
+):
+    client_patch.insert_rows.return_value = [{ "index": 0, "errors": [{ "reason": "backendError" }] }]
+
+    with pytest.raises(Exception, match="Rows not inserted"):
+        update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    assert client_patch.insert_rows.call_count == all_user_events_writer.INSERT_MAX_ATTEMPTS
+    format_payload_and_log_account_transaction_patch.assert_not_called()
+
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.all_user_events_table', 'all_user_events')
+@patch('main.INGEST_ROUTER_MODE', True)
+@patch('main.client')
+def test_update_user_behaviour_and_trigger_fraud_detector_decodes_message_once_in_router_mode(client_patch, format_payload_and_log_account_transaction_patch):
+    client_patch.insert_rows.return_value = []
+    format_payload_and_log_account_transaction_patch.return_value = { "formattedPayloadList": [] }
+
+    with patch('main.decode_pub_sub_message', side_effect=decode_pub_sub_message) as decode_pub_sub_message_patch:
+        update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    decode_pub_sub_message_patch.assert_called_once_with(sample_raw_event_from_pub_sub)
+    format_payload_and_log_account_transaction_patch.assert_called_once_with(sample_event_message_list)
+    assert [row["user_id"] for row in client_patch.insert_rows.call_args[0][1]] == [sample_user_id]
+
+@patch('main.format_payload_and_log_account_transaction', Mock(return_value={ "formattedPayloadList": [] }))
+@patch('main.insert_rows_into_all_user_events_table')
+def test_update_user_behaviour_and_trigger_fraud_detector_does_not_route_outside_router_mode(insert_rows_into_all_user_events_table_patch):
+    update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    insert_rows_into_all_user_events_table_patch.assert_not_called()
+
+@patch('main.fetch_current_time_in_milliseconds', Mock(return_value=sample_time_transaction_occurred))
+@patch('main.client')
+def test_refresh_monthly_aggregates(client_patch):
+    assert refresh_monthly_aggregates({}, {}) == ('OK', 200)
+
+    client_patch.query.assert_called_once()
+    query = client_patch.query.call_args[0][0]
+    assert "merge `{}`".format(main.MONTHLY_AGGREGATES_TABLE_URL) in query
+    # recomputed from the table rather than incremented, so a repeated run does not double count
+    assert "`transaction_count` = `recomputed`.`transaction_count`" in query
+    assert "`aggregates`.`transaction_count` +" not in query
+    assert "select coalesce(max(`computed_through`), 0) from `{}`".format(main.MONTHLY_AGGREGATES_TABLE_URL) in query
+
+    query_params = { param.name: param.value for param in client_patch.query.call_args[1]["job_config"].query_parameters }
+    assert query_params["computedThrough"] == sample_time_transaction_occurred - main.MONTHLY_AGGREGATES_REFRESH_DELAY_IN_SECONDS * 1000
+    assert query_params["updatedAt"] == sample_time_transaction_occurred
+
+@patch('main.client')
+def test_refresh_monthly_aggregates_logs_failed_run(client_patch):
+    client_patch.query.return_value.result.side_effect = Exception("Could not serialize access to table")
+
+    assert refresh_monthly_aggregates({}, {}) is None
+
+# An in-memory `user_behaviour` that answers the queries of the `SEQUENTIAL` rule helpers, and of
+# `fetch_saving_event_aggregates_since` from the months `refresh_monthly_aggregates` would have written at `computedThrough`
+class InMemoryUserBehaviourTable:
+    def __init__(self, rows, computedThrough):
+        self.rows = rows
+        self.monthlyAggregates = {}
+        for row in rows:
+            if row["created_at"] <= computedThrough:
+                monthKey = (row["user_id"], row["transaction_type"], main.calculate_month_start_in_milliseconds(row["time_transaction_occurred"]))
+                self.monthlyAggregates.setdefault(monthKey, []).append(row)
+        self.computedThrough = computedThrough
+
+    def rows_of(self, params, transactionType=None):
+        return [
+            row for row in self.rows
+            if row["user_id"] == params["userId"] and row["transaction_type"] == (transactionType or params["transactionType"])
+        ]
+
+    def fetch(self, query, query_params):
+        params = { param.name: param.value for param in query_params }
+        if "as `transactionCount`" in query:
+            return [self.fetch_saving_event_aggregates_since(params)]
+
+        rows = [row for row in self.rows_of(params, SAVING_EVENT_TRANSACTION_TYPE) if row["time_transaction_occurred"] > params["latestFlagTime"]]
+        rows = [row for row in rows if row["time_transaction_occurred"] >= params.get("givenTime", row["time_transaction_occurred"])]
+        if "as `latestSavingEvent`" in query:
+            return [{ "latestSavingEvent": max(rows, key=lambda row: row["time_transaction_occurred"])["amount"] }] if rows else []
+        if "as `averageSavingEventDuringPastPeriodInMonths`" in query:
+            return [{ "averageSavingEventDuringPastPeriodInMonths": sum(row["amount"] for row in rows) / len(rows) if rows else None }]
+
+        countAlias = "countOfTransactionsGreaterThanBenchmarkWithinMonthsPeriod" if "givenTime" in params else "countOfSavingEventsGreaterThanBenchMarkSavingEvent"
+        return [{ countAlias: len([row for row in rows if row["amount"] > params["benchmark"]]) }]
+
+    def fetch_saving_event_aggregates_since(self, params):
+        countedRows = []
+        for (userId, transactionType, monthStart), monthRows in self.monthlyAggregates.items():
+            if userId == params["userId"] and transactionType == params["transactionType"] and monthStart >= params["firstWholeMonthStart"]:
+                countedRows += monthRows
+        for row in self.rows_of(params):
+            monthKey = (row["user_id"], row["transaction_type"], main.calculate_month_start_in_milliseconds(row["time_transaction_occurred"]))
+            if row["time_transaction_occurred"] >= params["lowerBound"] and (
+                row["time_transaction_occurred"] < params["firstWholeMonthStart"]
+                or monthKey not in self.monthlyAggregates
+                or row["created_at"] > self.computedThrough
+            ):
+                countedRows.append(row)
+
+        return {
+            "transactionCount": len(countedRows),
+            "amountSum": sum(row["amount"] for row in countedRows),
+            "countAboveFirstBenchmark": len([row for row in countedRows if row["amount"] > params["firstBenchmark"]]),
+            "countAboveSecondBenchmark": len([row for row in countedRows if row["amount"] > params["secondBenchmark"]]),
+            "latestTransactionAmount": max(countedRows, key=lambda row: row["time_transaction_occurred"])["amount"] if countedRows else None
+        }
+
+# the withdrawal rules are read from `user_behaviour` in both modes
+@patch('main.fetch_withdrawals_within_hours_of_saving_events_facts', Mock(return_value={}))
+@patch.dict('main.RULE_FACT_FETCHERS', { "withdrawals_within_hours_of_saving_events": Mock(return_value={}) })
+def test_fetch_user_behaviour_from_monthly_aggregates_matches_sequential_mode_on_the_same_rows():
+    timeNow = int(time.time() * 1000)
+    millisecondsInADay = 24 * 3600 * 1000
+    computedThrough = timeNow - 3600 * 1000
+    def construct_row(daysAgo, amountInWholeCurrency, createdAt=None):
+        timeTransactionOccurred = timeNow - daysAgo * millisecondsInADay
+        return {
+            **sample_formatted_payload_list[0],
+            "amount": amountInWholeCurrency * 10000,
+            "time_transaction_occurred": timeTransactionOccurred,
+            "created_at": createdAt or timeTransactionOccurred
+        }
+
+    rows = [
+        construct_row(1, 60000, createdAt=timeNow - 60 * 1000),
+        construct_row(1, 60000, createdAt=timeNow - 60 * 1000),
+        construct_row(20, 500),
+        construct_row(45, 120000),
+        construct_row(45, 120000),
+        construct_row(100, 400),
+        # arrives late, after its month was last recomputed
+        construct_row(100, 70000, createdAt=timeNow - 10 * 60 * 1000),
+        construct_row(170, 300),
+        construct_row(200, 150000),
+        construct_row(400, 80000),
+        { **construct_row(30, 90000), "transaction_type": WITHDRAWAL_TRANSACTION_TYPE },
+    ]
+    table = InMemoryUserBehaviourTable(rows, computedThrough)
+
+    for ruleCutOffTimes in [{}, { "single_very_large_saving_event": timeNow - 50 * millisecondsInADay, "latest_saving_event_greater_than_six_months_average": timeNow - 150 * millisecondsInADay }]:
+        with patch('main.fetch_data_as_list_from_user_behaviour_table', table.fetch):
+            assert fetch_user_behaviour_from_monthly_aggregates(sample_user_id, ruleCutOffTimes) == main.fetch_user_behaviour_rule_by_rule(sample_user_id, ruleCutOffTimes)
+
 @patch('main.format_payload_and_log_account_transaction')
 @patch('main.construct_payload_for_fraud_detector')
 @patch('main.trigger_fraud_detector')
@@ -846,6 +1855,9 @@ def test_update_user_behaviour_and_trigger_fraud_detector(
     construct_payload_for_fraud_detector_patch,
     format_payload_and_log_account_transaction_patch
 ):
+    format_payload_and_log_account_transaction_patch.return_value = sample_response_from_payload_formatter
+    trigger_fraud_detector_patch.return_value = None
+
     result = update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
     assert result == ('OK', 200)
 
@@ -853,6 +1865,215 @@ def test_update_user_behaviour_and_trigger_fraud_detector(
     construct_payload_for_fraud_detector_patch.assert_called()
     trigger_fraud_detector_patch.assert_called()
 
+@patch('main.post_to_fraud_detector')
+@patch('main.fetch_fraud_detector_trigger_publisher')
+def test_trigger_fraud_detector_asynchronously_publishes_trigger(fetch_fraud_detector_trigger_publisher_patch, post_to_fraud_detector_patch):
+    samplePayload = construct_payload_for_fraud_detector(sample_response_from_payload_formatter)
+    publisher = fetch_fraud_detector_trigger_publisher_patch.return_value
+    publisher.topic_path.return_value = "projects/sample/topics/fraud-detector-triggers"
+
+    with patch('main.FRAUD_DETECTOR_TRIGGER_MODE', FRAUD_DETECTOR_TRIGGER_MODES["async"]):
+        pendingTrigger = trigger_fraud_detector(samplePayload)
+
+    assert pendingTrigger is publisher.publish.return_value
+    publisher.topic_path.assert_called_once_with(main.project_id, main.FRAUD_DETECTOR_TRIGGER_TOPIC)
+    assert publisher.publish.call_args[0][0] == "projects/sample/topics/fraud-detector-triggers"
+    assert json.loads(publisher.publish.call_args[0][1].decode('utf-8')) == samplePayload
+    post_to_fraud_detector_patch.assert_not_called()
+
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.fetch_fraud_detector_trigger_publisher')
+def test_update_user_behaviour_waits_for_triggers_to_be_published_up_to_deadline(
+        fetch_fraud_detector_trigger_publisher_patch,
+        format_payload_and_log_account_transaction_patch
+):
+    otherUserRow = { **sample_formatted_payload_list[0], "user_id": sample_other_user_id, "account_id": sample_other_account_id }
+    format_payload_and_log_account_transaction_patch.return_value = { "formattedPayloadList": sample_formatted_payload_list + [otherUserRow] }
+    publishedTrigger = Mock()
+    unpublishedTrigger = Mock()
+    unpublishedTrigger.result.side_effect = Exception("Timed out publishing")
+    fetch_fraud_detector_trigger_publisher_patch.return_value.publish.side_effect = [publishedTrigger, unpublishedTrigger]
+
+    with patch('main.FRAUD_DETECTOR_TRIGGER_MODE', FRAUD_DETECTOR_TRIGGER_MODES["async"]):
+        result = update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    assert result == ('OK', 200)
+    assert publishedTrigger.result.call_args[1]["timeout"] <= main.FRAUD_DETECTOR_TRIGGER_PUBLISH_TIMEOUT_IN_SECONDS
+    unpublishedTrigger.result.assert_called_once()
+
+@patch('main.fetch_fraud_detector_session')
+def test_post_fraud_detector_trigger_posts_published_trigger(fetch_fraud_detector_session_patch):
+    samplePayload = { "userId": sample_user_id, "accountId": sample_account_id }
+    fetch_fraud_detector_session_patch.return_value.post.return_value.status_code = 200
+    event = { "data": base64.b64encode(json.dumps(samplePayload).encode('utf-8')) }
+
+    assert main.post_fraud_detector_trigger(event, {}) == ('OK', 200)
+    assert fetch_fraud_detector_session_patch.return_value.post.call_args[1]["data"] == samplePayload
+
+    fetch_fraud_detector_session_patch.return_value.post.return_value.status_code = 503
+    with pytest.raises(Exception, match="status: 503"):
+        main.post_fraud_detector_trigger(event, {})
+
+def test_fetch_fraud_detector_session_is_shared_and_retries_connection_failures():
+    with patch('main.fraudDetectorSession', None):
+        session = main.fetch_fraud_detector_session()
+        assert main.fetch_fraud_detector_session() is session
+
+    adapter = session.get_adapter("https://fraud-detector")
+    assert adapter.max_retries.connect == main.FRAUD_DETECTOR_CONNECTION_RETRIES
+    assert adapter.max_retries.read == 0
+
+def test_format_payload_for_user_behaviour_table_skips_invalid_events_in_multi_user_batch():
+    otherUserEventMessage = {
+        **sample_event_message,
+        "user_id": sample_other_user_id,
+        "context": json.dumps({ **context_json, "accountId": sample_other_account_id })
+    }
+    unsupportedEventMessage = { **sample_event_message, "event_type": "USER_LOGGED_IN" }
+    eventMissingTime = { "user_id": sample_user_id, "event_type": sample_transaction_type, "context": json.dumps(context_json) }
+    eventWithMalformedAmount = { **sample_event_message, "context": json.dumps({ **context_json, "savedAmount": "a lot" }) }
+    eventMissingUserId = { key: value for key, value in sample_event_message.items() if key != "user_id" }
+    eventMissingEventType = { key: value for key, value in sample_event_message.items() if key != "event_type" }
+
+    result = format_payload_for_user_behaviour_table(
+        [sample_event_message, unsupportedEventMessage, eventMissingTime, eventWithMalformedAmount, eventMissingUserId, eventMissingEventType, "not an event", otherUserEventMessage],
+        time_in_milliseconds_now
+    )
+
+    assert [row["user_id"] for row in result["formattedPayloadList"]] == [sample_user_id, sample_other_user_id]
+    assert result["formattedPayloadList"][1]["account_id"] == sample_other_account_id
+
+def test_extract_unique_users_from_formatted_payload():
+    otherUserRow = { **sample_formatted_payload_list[0], "user_id": sample_other_user_id, "account_id": sample_other_account_id }
+    otherAccountRow = { **sample_formatted_payload_list[0], "account_id": sample_other_account_id }
+    formattedPayloadList = sample_formatted_payload_list + [otherUserRow, otherAccountRow]
+
+    assert extract_unique_users_from_formatted_payload(formattedPayloadList) == [
+        { "userId": sample_user_id, "accountId": sample_other_account_id, "formattedPayloadList": sample_formatted_payload_list + [otherAccountRow] },
+        { "userId": sample_other_user_id, "accountId": sample_other_account_id, "formattedPayloadList": [otherUserRow] }
+    ]
+
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.trigger_fraud_detector')
+def test_update_user_behaviour_triggers_fraud_detector_once_per_user(
+    trigger_fraud_detector_patch,
+    format_payload_and_log_account_transaction_patch
+):
+    otherUserRow = { **sample_formatted_payload_list[0], "user_id": sample_other_user_id, "account_id": sample_other_account_id }
+    format_payload_and_log_account_transaction_patch.return_value = {
+        "formattedPayloadList": sample_formatted_payload_list * 2 + [otherUserRow]
+    }
+    # a failed trigger for one user does not stop the others
+    trigger_fraud_detector_patch.side_effect = [Exception("Fraud detector unavailable"), None]
+
+    result = update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {})
+
+    assert result == ('OK', 200)
+    assert trigger_fraud_detector_patch.call_count == 2
+    assert [call[0][0]["userId"] for call in trigger_fraud_detector_patch.call_args_list] == [sample_user_id, sample_other_user_id]
+    assert json.loads(trigger_fraud_detector_patch.call_args_list[0][0][0]["recentTransactions"]) == sample_formatted_payload_list * 2
+
+
+def construct_sample_window_transaction(transactionType, amountInWholeCurrency, hoursAgo):
+    return {
+        "transaction_type": transactionType,
+        "amount": amountInWholeCurrency * FACTOR_TO_CONVERT_WHOLE_CURRENCY_TO_HUNDREDTH_CENT,
+        "time_transaction_occurred": time_in_milliseconds_now - hoursAgo * one_hour_in_milliseconds,
+        "created_at": time_in_milliseconds_now
+    }
+
+def test_find_flag_candidate_rules_for_ordinary_saver():
+    transactionWindow = [
+        construct_sample_window_transaction("SAVING_EVENT", 1000, 500),
+        construct_sample_window_transaction("SAVING_EVENT", 1200, 100),
+        construct_sample_window_transaction("WITHDRAWAL", 500, 50),
+        construct_sample_window_transaction("SAVING_EVENT", 900, 1),
+    ]
+
+    assert find_flag_candidate_rules(sample_user_id, transactionWindow) == []
+
+def test_find_flag_candidate_rules_for_suspicious_transactions():
+    transactionWindow = [
+        construct_sample_window_transaction("SAVING_EVENT", 1000, 500),
+        construct_sample_window_transaction("SAVING_EVENT", 60000, 30),
+        construct_sample_window_transaction("WITHDRAWAL", 59000, 29),
+        construct_sample_window_transaction("SAVING_EVENT", 60000, 20),
+        construct_sample_window_transaction("WITHDRAWAL", 58000, 19),
+        construct_sample_window_transaction("SAVING_EVENT", 150000, 1),
+    ]
+
+    assert find_flag_candidate_rules(sample_user_id, transactionWindow) == [
+        "single_very_large_saving_event",
+        "saving_events_greater_than_benchmark_within_six_months",
+        "latest_saving_event_greater_than_six_months_average",
+        "withdrawals_within_two_days_of_saving_events_during_one_month",
+        "withdrawals_within_one_day_of_saving_events_during_one_week"
+    ]
+
+@patch('main.fetch_transactions_for_rule_window')
+def test_find_flag_candidate_rules_for_transactions_when_only_saving_event_is_older_than_six_months(fetch_transactions_for_rule_window_patch):
+    fetch_transactions_for_rule_window_patch.return_value = [construct_sample_window_transaction("SAVING_EVENT", 1000, 24 * 200)]
+    withdrawal = { **sample_formatted_payload_list[0], **construct_sample_window_transaction("WITHDRAWAL", 500, 0) }
+
+    assert find_flag_candidate_rules_for_transactions(sample_user_id, [withdrawal]) == ["latest_saving_event_greater_than_six_months_average"]
+
+@patch('main.fetch_transactions_for_rule_window')
+def test_find_flag_candidate_rules_for_transactions_when_very_large_saving_event_is_older_than_six_months(fetch_transactions_for_rule_window_patch):
+    fetch_transactions_for_rule_window_patch.return_value = [
+        construct_sample_window_transaction("SAVING_EVENT", 150000, 24 * 300),
+        construct_sample_window_transaction("SAVING_EVENT", 1000, 48)
+    ]
+    withdrawal = { **sample_formatted_payload_list[0], **construct_sample_window_transaction("WITHDRAWAL", 500, 0) }
+
+    assert find_flag_candidate_rules_for_transactions(sample_user_id, [withdrawal]) == ["single_very_large_saving_event"]
+    assert len(main.userTransactionWindows[sample_user_id]) == 3
+
+@patch('main.fetch_transactions_for_rule_window')
+def test_update_user_transaction_window_seeds_window_once(fetch_transactions_for_rule_window_patch):
+    seededTransaction = construct_sample_window_transaction("SAVING_EVENT", 1000, 500)
+    firstTransaction = construct_sample_window_transaction("SAVING_EVENT", 1200, 2)
+    secondTransaction = construct_sample_window_transaction("WITHDRAWAL", 500, 1)
+    fetch_transactions_for_rule_window_patch.return_value = [seededTransaction, firstTransaction]
+
+    update_user_transaction_window(sample_user_id, [firstTransaction])
+    transactionWindow = update_user_transaction_window(sample_user_id, [secondTransaction])
+
+    assert transactionWindow == [seededTransaction, firstTransaction, secondTransaction]
+    fetch_transactions_for_rule_window_patch.assert_called_once_with(sample_user_id)
+
+@patch('main.EVALUATE_RULES_ON_INGEST', True)
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.find_flag_candidate_rules_for_transactions')
+@patch('main.trigger_fraud_detector')
+def test_update_user_behaviour_skips_fraud_detector_for_users_that_are_not_flag_candidates(
+    trigger_fraud_detector_patch,
+    find_flag_candidate_rules_patch,
+    format_payload_and_log_account_transaction_patch
+):
+    format_payload_and_log_account_transaction_patch.return_value = sample_response_from_payload_formatter
+    find_flag_candidate_rules_patch.return_value = []
+
+    assert update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {}) == ('OK', 200)
+
+    find_flag_candidate_rules_patch.assert_called_once_with(sample_user_id, sample_formatted_payload_list)
+    trigger_fraud_detector_patch.assert_not_called()
+
+@patch('main.EVALUATE_RULES_ON_INGEST', True)
+@patch('main.format_payload_and_log_account_transaction')
+@patch('main.find_flag_candidate_rules_for_transactions')
+@patch('main.trigger_fraud_detector')
+def test_update_user_behaviour_triggers_fraud_detector_when_rules_cannot_be_evaluated(
+    trigger_fraud_detector_patch,
+    find_flag_candidate_rules_patch,
+    format_payload_and_log_account_transaction_patch
+):
+    format_payload_and_log_account_transaction_patch.return_value = sample_response_from_payload_formatter
+    find_flag_candidate_rules_patch.side_effect = Exception("Query timed out")
+    trigger_fraud_detector_patch.return_value = None
+
+    assert update_user_behaviour_and_trigger_fraud_detector(sample_raw_event_from_pub_sub, {}) == ('OK', 200)
+
+    trigger_fraud_detector_patch.assert_called_once()
 
 '''
 =========== END OF UPDATE USER BEHAVIOUR Tests ===========
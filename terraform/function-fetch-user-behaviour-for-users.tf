@@ -0,0 +1,20 @@
+resource "google_cloudfunctions_function" "fetch-user-behaviour-for-users-based-on-rules-function" {
+  
+  name = "fetch-user-behaviour-for-users-based-on-rules"
+  description = "Fetch User Behaviour for a batch of users based on predefined rules"
+
+  entry_point = "fetch_user_behaviour_for_users_based_on_rules"
+  
+  runtime = "python37"  
+  available_memory_mb = 256
+  timeout = 300
+  
+  source_archive_bucket = google_storage_bucket.function_code.name
+  source_archive_object = "user_behaviour/${var.deploy_code_commit_hash}.zip"
+  
+  trigger_http = true
+
+  environment_variables = {
+    "BIG_QUERY_DATASET_LOCATION" = var.gcp_default_continent[terraform.workspace]
+  }
+}
@@ -0,0 +1,20 @@
+resource "google_cloudfunctions_function" "fetch-user-transaction-timeline-function" {
+  
+  name = "fetch-user-transaction-timeline"
+  description = "Fetch the transaction timeline of a user for fraud investigations"
+
+  entry_point = "fetch_user_transaction_timeline"
+  
+  runtime = "python37"  
+  available_memory_mb = 256
+  timeout = 300
+  
+  source_archive_bucket = google_storage_bucket.function_code.name
+  source_archive_object = "user_behaviour/${var.deploy_code_commit_hash}.zip"
+  
+  trigger_http = true
+
+  environment_variables = {
+    "BIG_QUERY_DATASET_LOCATION" = var.gcp_default_continent[terraform.workspace]
+  }
+}
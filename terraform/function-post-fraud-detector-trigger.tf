@@ -0,0 +1,24 @@
+resource "google_cloudfunctions_function" "post-fraud-detector-trigger-function" {
+
+  name = "post-fraud-detector-trigger"
+  description = "Posts the fraud detector triggers published by update-user-behaviour to the fraud detector"
+
+  entry_point = "post_fraud_detector_trigger"
+
+  runtime = "python37"
+  available_memory_mb = 128
+  timeout = 60
+
+  source_archive_bucket = google_storage_bucket.function_code.name
+  source_archive_object = "user_behaviour/${var.deploy_code_commit_hash}.zip"
+
+  event_trigger {
+    event_type = "google.pubsub.topic.publish"
+    resource = google_pubsub_topic.fraud_detector_triggers_topic.id
+
+    # a failed post is raised, so the trigger is redelivered
+    failure_policy {
+      retry = true
+    }
+  }
+}
@@ -1,5 +1,7 @@
 resource "google_cloudfunctions_function" "pubsub-to-big-query-for-sns-function" {
   
+  count = var.ingest_router_mode ? 0 : 1
+
   name = "pubsub-to-big-query-for-sns"
   description = "Fetch Data from Pub/Sub and load into Big Query"
   
@@ -16,4 +18,35 @@ resource "google_cloudfunctions_function" "pubsub-to-big-query-for-sns-function"
     event_type = "google.pubsub.topic.publish"
     resource = google_pubsub_topic.sns_transfer_topic.id
   }
+
+  environment_variables = {
+    "STAGED_EVENTS_CLOUD_STORAGE_BUCKET" = google_storage_bucket.staged_events.name
+    "DEAD_LETTER_CLOUD_STORAGE_BUCKET" = google_storage_bucket.staged_events.name
+  }
+}
+
+resource "google_cloudfunctions_function" "load-staged-events-into-all-user-events-function" {
+  
+  name = "load-staged-events-into-all-user-events"
+  description = "Load sns events staged in cloud storage into Big Query with one load job"
+  
+  runtime = "python37"
+  available_memory_mb = 128
+  timeout = 300
+  
+  source_archive_bucket = google_storage_bucket.function_code.name
+  source_archive_object = "pubsub_to_big_query_for_sns/${var.deploy_code_commit_hash}.zip"
+  
+  entry_point = "load_staged_events_into_all_user_events"
+  # one run at a time, so two runs never load the same staged files
+  max_instances = 1
+
+  event_trigger {
+    event_type = "google.pubsub.topic.publish"
+    resource = google_pubsub_topic.staged_events_load_topic.id
+  }
+
+  environment_variables = {
+    "STAGED_EVENTS_CLOUD_STORAGE_BUCKET" = google_storage_bucket.staged_events.name
+  }
 }
@@ -0,0 +1,25 @@
+resource "google_cloudfunctions_function" "refresh-monthly-aggregates-function" {
+
+  name = "refresh-monthly-aggregates"
+  description = "Recomputes the months of the user behaviour monthly aggregates written since the last run"
+
+  entry_point = "refresh_monthly_aggregates"
+
+  runtime = "python37"
+  available_memory_mb = 128
+  timeout = 300
+  # one MERGE on the table at a time
+  max_instances = 1
+
+  source_archive_bucket = google_storage_bucket.function_code.name
+  source_archive_object = "user_behaviour/${var.deploy_code_commit_hash}.zip"
+
+  event_trigger {
+    event_type = "google.pubsub.topic.publish"
+    resource = google_pubsub_topic.monthly_aggregates_refresh_topic.id
+  }
+
+  environment_variables = {
+    "BIG_QUERY_DATASET_LOCATION" = var.gcp_default_continent[terraform.workspace]
+  }
+}
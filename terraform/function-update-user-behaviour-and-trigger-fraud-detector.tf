@@ -15,5 +15,18 @@ resource "google_cloudfunctions_function" "update-user-behaviour-and-trigger-fra
   event_trigger {
     event_type = "google.pubsub.topic.publish"
     resource = google_pubsub_topic.sns_transfer_topic.id
+
+    # in router mode a failed write to all_user_events is raised, so the message is redelivered
+    dynamic "failure_policy" {
+      for_each = var.ingest_router_mode ? [1] : []
+      content {
+        retry = true
+      }
+    }
+  }
+
+  environment_variables = {
+    "INGEST_ROUTER_MODE" = var.ingest_router_mode
+    "FRAUD_DETECTOR_TRIGGER_TOPIC" = google_pubsub_topic.fraud_detector_triggers_topic.name
   }
 }
@@ -87,3 +87,52 @@ resource "google_cloud_scheduler_job" "daily_training_job" {
       data = base64encode("{}")
     }
 }
+
+# Helper topic for loading the events staged by pubsub-to-big-query-for-sns (when INSERT_SINK is LOAD_JOB)
+resource "google_pubsub_topic" "staged_events_load_topic" {
+    name = "staged_events_load"
+
+    labels = {
+        environment = terraform.workspace
+    }
+}
+
+resource "google_cloud_scheduler_job" "staged_events_load_job" {
+    name = "staged_events_load_job"
+    description = "Loads staged sns events into all_user_events every five minutes, within the daily load job quota"
+    schedule = "*/5 * * * *"
+
+    pubsub_target {
+      topic_name = google_pubsub_topic.staged_events_load_topic.id
+      data = base64encode("{}")
+    }
+}
+
+# Fraud detector triggers published by update-user-behaviour (when FRAUD_DETECTOR_TRIGGER_MODE is ASYNC)
+resource "google_pubsub_topic" "fraud_detector_triggers_topic" {
+    name = "fraud-detector-triggers"
+
+    labels = {
+        environment = terraform.workspace
+    }
+}
+
+# Helper topic for recomputing the months of user_behaviour_monthly_aggregates written since the last run
+resource "google_pubsub_topic" "monthly_aggregates_refresh_topic" {
+    name = "monthly_aggregates_refresh"
+
+    labels = {
+        environment = terraform.workspace
+    }
+}
+
+resource "google_cloud_scheduler_job" "monthly_aggregates_refresh_job" {
+    name = "monthly_aggregates_refresh_job"
+    description = "Recomputes the months of user_behaviour_monthly_aggregates written since the last run, once an hour"
+    schedule = "0 * * * *"
+
+    pubsub_target {
+      topic_name = google_pubsub_topic.monthly_aggregates_refresh_topic.id
+      data = base64encode("{}")
+    }
+}
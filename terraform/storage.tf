@@ -31,3 +31,12 @@ resource "google_storage_bucket" "boost_ml_datasets" {
     name = "${terraform.workspace == "master" ? "prod" : "staging"}_boost_ml_datasets"
     location = var.gcp_default_continent[terraform.workspace]
 }
+
+# Staging storage bucket for sns events loaded into big query with load jobs
+
+resource "google_storage_bucket" "staged_events" {
+    name = "jupiter_staged_events_${terraform.workspace}"
+    location = var.gcp_default_continent[terraform.workspace]
+
+    force_destroy = false
+}
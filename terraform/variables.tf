@@ -34,3 +34,9 @@ variable "gcp_default_zone" {
 
 variable "deploy_code_commit_hash" {
 }
+
+# when true, update-user-behaviour also writes sns events to all_user_events and pubsub-to-big-query-for-sns is not deployed
+variable "ingest_router_mode" {
+  type = bool
+  default = false
+}